@@ -0,0 +1,104 @@
+"""
+Benchmark: bytes on the wire and CPU cost of response compression
+
+Encodes a list of 100 and 10,000 accounts as a JSON array, the way the
+account list sends it, and compresses it with gzip at levels 1, 6 and 9
+and with brotli at qualities 1, 4 and 11 when brotli is installed. Reports
+the compressed size, the ratio to the plain body and the CPU time of each
+compression, whole and as a stream of 1,000-account chunks. Nothing is
+read from the database:
+
+    python -m benchmarks.bench_compression --sizes 100 10000
+"""
+
+import argparse
+import itertools
+import time
+
+from benchmarks.common import report, summarize
+from service.common import compression
+from service.common.json_provider import make_provider
+from tests.factories import AccountFactory
+
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 4, 11)}
+
+
+def payload(count):
+    """Returns the JSON array body and its 1,000-account chunks"""
+    dumps = make_provider("auto").dumps
+    items = [
+        dumps({"id": number, **account.serialize()})
+        for number, account in enumerate(
+            AccountFactory.build_batch(count), start=1
+        )
+    ]
+    body = ("[" + ",".join(items) + "]").encode("utf-8")
+    chunks = []
+    remaining = iter(items)
+    while batch := list(itertools.islice(remaining, 1000)):
+        chunks.append(",".join(batch).encode("utf-8"))
+    return body, chunks
+
+
+def cpu_samples(func, repeat):
+    """Calls func repeat times and returns the CPU time of each call"""
+    samples = []
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        samples.append(time.process_time() - start)
+    return samples
+
+
+def run(count, repeat):
+    """Benchmarks every encoding and level on count accounts"""
+    body, chunks = payload(count)
+    results = {f"{count} accounts [identity]": {"bytes": len(body)}}
+    for encoding in compression.ENCODINGS:
+        for level in LEVELS[encoding]:
+            size = len(compression.compress(body, encoding, level))
+            streamed = sum(
+                map(len, compression.compress_stream(chunks, encoding, level))
+            )
+            summary = summarize(
+                cpu_samples(
+                    lambda: compression.compress(body, encoding, level),
+                    repeat,
+                )
+            )
+            stream_cpu = summarize(
+                cpu_samples(
+                    lambda: list(
+                        compression.compress_stream(chunks, encoding, level)
+                    ),
+                    repeat,
+                )
+            )
+            summary.update(
+                bytes=size,
+                ratio=round(size / len(body), 3),
+                stream_bytes=streamed,
+                stream_mean_ms=stream_cpu["mean_ms"],
+            )
+            results[f"{count} accounts [{encoding}-{level}]"] = summary
+    return results
+
+
+def main():
+    """Parses arguments and runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    if compression.brotli is None:
+        print("Skipping br: brotli is not installed")
+    results = {}
+    for count in args.sizes:
+        results.update(run(count, args.repeat))
+    report(results, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Shared helpers for the benchmark scripts
+"""
+
+import http.client
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+# Talisman redirects plain HTTP unless a proxy vouches for TLS
+HEADERS = {"X-Forwarded-Proto": "https"}
+
+
+def percentile(samples, pct):
+    """Returns the pct percentile of samples using nearest rank"""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Summarizes latency samples (in seconds) in milliseconds"""
+    count = len(samples)
+    return {
+        "count": count,
+        "mean_ms": round(sum(samples) / count * 1000, 3) if count else 0.0,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples, default=0.0) * 1000, 3),
+    }
+
+
+def time_calls(func, repeat):
+    """Calls func repeat times and returns the latency of each call"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def write_results(results, path):
+    """Writes benchmark results to path as JSON"""
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write("\n")
+
+
+def load_results(path):
+    """Reads benchmark results written by write_results()"""
+    with open(path, encoding="utf-8") as source:
+        return json.load(source)
+
+
+def compare(baseline, current, threshold, min_delta_ms=0.0):
+    """Lists the benchmarks whose p95 regressed against baseline
+
+    A benchmark regresses when its p95 grew by more than threshold percent
+    and by more than min_delta_ms, which keeps noise on sub-millisecond
+    timings from failing a run. Benchmarks missing from either side are
+    not compared.
+    """
+    regressions = []
+    for name, summary in sorted(current.items()):
+        before = baseline.get(name, {}).get("p95_ms")
+        after = summary.get("p95_ms")
+        if before is None or after is None:
+            continue
+        delta = after - before
+        if delta > min_delta_ms and delta > before * threshold / 100:
+            change = delta / before * 100 if before else float("inf")
+            regressions.append(
+                f"{name}: p95 {before}ms -> {after}ms (+{change:.1f}%)"
+            )
+    return regressions
+
+
+def report(results, as_json=False):
+    """Prints benchmark results as a table or as JSON"""
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, summary in results.items():
+        fields = "  ".join(f"{key}={value}" for key, value in summary.items())
+        print(f"{name:<40} {fields}")
+
+
+def start_gunicorn(port, env=None, app="wsgi:app", timeout=30.0):
+    """Starts gunicorn with gunicorn.conf.py and waits for /health
+
+    Returns the running process; stop it with stop_server().
+    """
+    server_env = dict(os.environ, PORT=str(port), **(env or {}))
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--config",
+            "gunicorn.conf.py",
+            app,
+        ],
+        env=server_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health", headers=HEADERS)
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError("gunicorn did not become healthy in time")
+
+
+def stop_server(process):
+    """Stops a server started by start_gunicorn()"""
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def http_load(port, paths, concurrency, duration, method="GET", body=None):
+    """Drives requests at a live server from concurrent clients
+
+    Each client keeps one connection alive and cycles through paths until
+    duration seconds have passed, sending body, when given, as JSON.
+    Returns the latency samples and the number of failed requests.
+    """
+    headers = dict(HEADERS)
+    if body is not None:
+        body = json.dumps(body)
+        headers["Content-Type"] = "application/json"
+    samples = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(offset):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local, failed = [], 0
+        index = offset
+        while time.monotonic() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection(
+                    "127.0.0.1", port, timeout=30
+                )
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            samples.extend(local)
+            errors.append(failed)
+
+    threads = [
+        threading.Thread(target=client, args=(number,))
+        for number in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, sum(errors)
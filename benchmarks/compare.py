@@ -0,0 +1,41 @@
+"""
+Compares two saved benchmark runs and fails on p95 regressions
+
+Reads the JSON results written with --output by a benchmark and lists
+every benchmark whose p95 latency grew by more than --threshold percent
+(and by more than --min-delta-ms) from the baseline to the current run.
+Exits with status 1 when there is any, so CI can gate on it:
+
+    python -m benchmarks.compare baseline.json bench.json --threshold 10
+"""
+
+import argparse
+import sys
+
+from benchmarks.common import compare, load_results
+
+
+def main():
+    """Parses arguments and compares the two runs"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--min-delta-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    regressions = compare(
+        load_results(args.baseline),
+        load_results(args.current),
+        args.threshold,
+        args.min_delta_ms,
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No p95 regressions")
+
+
+if __name__ == "__main__":
+    main()
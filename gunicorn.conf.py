@@ -0,0 +1,98 @@
+"""
+Gunicorn configuration for the Account Service
+
+Gunicorn loads this module automatically from the working directory. Every
+setting can be overridden from the environment:
+
+  GUNICORN_WORKER_CLASS        sync, gthread, gevent or eventlet
+  WEB_CONCURRENCY              worker processes
+  GUNICORN_THREADS             threads per gthread worker
+  GUNICORN_WORKER_CONNECTIONS  concurrent clients per gevent/eventlet worker
+  GUNICORN_TIMEOUT             seconds before a silent worker is restarted
+  GUNICORN_PRELOAD             load the app once in the master (true/false)
+  PORT                         port to bind on all interfaces
+  PROMETHEUS_MULTIPROC_DIR     directory the workers share their metrics in
+
+gthread is the default: a worker keeps serving other requests while one
+thread waits on Postgres, and it needs nothing beyond the standard library.
+Keep DB_POOL_SIZE + DB_MAX_OVERFLOW at or above GUNICORN_THREADS so threads
+do not queue for connections. gevent and eventlet need those packages plus
+psycogreen, which makes psycopg2 yield to other greenlets while it waits.
+Flask-SQLAlchemy scopes sessions per thread or greenlet, so each request
+keeps its own session under every worker class.
+
+With preloading the master imports and configures the app once and every
+worker forks from it, so workers boot faster and share memory. Booting
+never connects to the database, and each worker drops whatever engine it
+inherited after the fork. Preloading is off by default for gevent and
+eventlet, which must patch the standard library before the app loads.
+"""
+
+import glob
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(
+    os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1))
+)
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+preload_app = (
+    os.getenv(
+        "GUNICORN_PRELOAD",
+        "false" if worker_class in ("gevent", "eventlet") else "true",
+    ).lower()
+    == "true"
+)
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Empties the metrics directory of the workers before they start
+
+    Files left by the workers of an earlier run, such as a container
+    that restarted, would otherwise be added to the new workers' samples.
+    """
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for name in glob.glob(os.path.join(path, "*.db")):
+            os.remove(name)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Readies the database drivers and engines of a new worker
+
+    A preloaded app was created in the master, so the worker forgets the
+    connections of any engine it inherited instead of sharing them.
+    """
+    if server.cfg.preload_app:
+        from service.models import dispose_engines
+
+        dispose_engines(server.app.wsgi())
+    if worker_class in ("gevent", "eventlet"):
+        try:
+            if worker_class == "gevent":
+                from psycogreen.gevent import patch_psycopg
+            else:
+                from psycogreen.eventlet import patch_psycopg
+        except ImportError:
+            server.log.warning(
+                "psycogreen is not installed: database calls will block "
+                "the whole %s worker",
+                worker_class,
+            )
+        else:
+            patch_psycopg()
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Lets Prometheus drop the live gauges of a worker that exited"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
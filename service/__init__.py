@@ -7,12 +7,12 @@ This module creates and configures the Flask app using the factory pattern.
 import sys
 
 from flask import Flask
-from flask_cors import CORS  # ✅ Import CORS
 from flask_talisman import Talisman
 
 from service import config
 from service.common import log_handlers
 from service.common.error_handlers import init_error_handlers
+from service.common.json_provider import init_json
 from service.models import init_db
 
 # Global Talisman instance so it can be imported in tests
@@ -31,11 +31,16 @@ def create_app():
     talisman.init_app(app)
 
     # Enable CORS
+    from flask_cors import CORS
+
     CORS(app)
 
     # Register error handlers
     init_error_handlers(app)
 
+    # Choose the JSON encoder for account payloads
+    init_json(app)
+
     # Initialize the database
     try:
         init_db(app)
@@ -43,6 +48,38 @@ def create_app():
         app.logger.critical("%s: Cannot continue", error)
         sys.exit(4)
 
+    # Replay the responses of retried requests with an Idempotency-Key
+    from service.common.idempotency import init_idempotency
+
+    init_idempotency(app)
+
+    # Record request and database metrics
+    from service.common.metrics import init_metrics
+    from service.models import Account
+
+    init_metrics(
+        app,
+        caches={"account": Account.cache},
+        flights={"account": Account.flight},
+    )
+
+    # Profile the SQL of every request when SQL_PROFILING is set
+    from service.common.profiling import init_profiling
+
+    init_profiling(app)
+
+    # Turn away requests over their rate limit or while overloaded
+    from service.common.rate_limit import init_rate_limit
+
+    init_rate_limit(app)
+
+    # Compress large responses and apply the Cache-Control policies
+    from service.common.compression import init_compression
+    from service.common.http_caching import init_http_caching
+
+    init_compression(app)
+    init_http_caching(app)
+
     # Register routes
     from service.routes import api
 
@@ -0,0 +1,346 @@
+"""
+Cache Backends
+
+This module contains the read-through cache backends used by the models.
+Every backend offers the same get/set/delete/clear/stats interface, plus
+get_many/set_many for reading and filling many keys in one round trip.
+
+A reader that loaded a record just before a writer deleted its entry
+would put the old version back for a whole TTL. Fills are guarded
+against that: take generations(keys) before loading and pass it to set()
+or set_many() as since, and keys deleted in the meantime are not stored.
+
+The memory backend lives inside one worker process, so a change made by
+another worker or replica of the service never removes its entries; use
+it only with a single worker process, and redis anywhere else.
+"""
+
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class NullCache:
+    """Cache that never stores anything, used when caching is disabled"""
+
+    def get(self, key):  # pylint: disable=unused-argument
+        """Always misses"""
+        return None
+
+    def set(self, key, value, since=None):
+        """Discards the value"""
+
+    def get_many(self, keys):  # pylint: disable=unused-argument
+        """Always misses"""
+        return {}
+
+    def set_many(self, values, since=None):
+        """Discards the values"""
+
+    def generations(self, keys):  # pylint: disable=unused-argument
+        """Nothing is stored, so there is nothing to guard"""
+        return None
+
+    def delete(self, key):
+        """Nothing to delete"""
+
+    def clear(self):
+        """Nothing to clear"""
+
+    def stats(self):
+        """Returns empty counters"""
+        return {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+
+
+class LRUCache:
+    """In-process cache bounded by entry count and time to live
+
+    The least recently used entry is evicted once ``max_size`` is reached
+    and entries older than ``ttl`` seconds are treated as misses.
+    """
+
+    def __init__(self, max_size=10000, ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        # Tick of the last delete of each key, the max_size most recent
+        # only; fills that started at or before _floor are refused
+        self._invalidated = OrderedDict()
+        self._tick = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss"""
+        with self._lock:
+            return self._get(key, self._clock())
+
+    def set(self, key, value, since=None):
+        """Stores value under key, evicting the oldest entries if full
+
+        With since, from generations(), nothing is stored when key was
+        deleted after it was taken.
+        """
+        with self._lock:
+            if not self._stale(key, since):
+                self._set(key, value, self._clock())
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys that are cached"""
+        found = {}
+        with self._lock:
+            now = self._clock()
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    found[key] = value
+        return found
+
+    def set_many(self, values, since=None):
+        """Stores every key and value of the values dictionary"""
+        with self._lock:
+            now = self._clock()
+            for key, value in values.items():
+                if not self._stale(key, since):
+                    self._set(key, value, now)
+
+    def generations(self, keys):  # pylint: disable=unused-argument
+        """Returns the token to pass to set() for values loaded from now"""
+        with self._lock:
+            return self._tick
+
+    def _stale(self, key, since):
+        """True when key was deleted after the generations() since"""
+        if since is None:
+            return False
+        return since < self._floor or self._invalidated.get(key, 0) > since
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires = entry
+        if expires <= now:
+            del self._entries[key]
+            self.misses += 1
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _set(self, key, value, now):
+        self._entries[key] = (value, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        """Removes key from the cache if present"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._tick += 1
+            self._invalidated[key] = self._tick
+            self._invalidated.move_to_end(key)
+            if len(self._invalidated) > self.max_size:
+                _, self._floor = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._invalidated.clear()
+            self._tick += 1
+            self._floor = self._tick
+
+    def stats(self):
+        """Returns the hit, miss and eviction counters"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
+
+
+class SharedCache:
+    """Cache kept in a store shared by every worker and replica
+
+    ``client`` only needs the ``get``, ``mget``, ``setex``, ``pipeline``,
+    ``transaction``, ``delete`` and ``scan_iter`` methods of a Redis
+    client, so tests can hand in a local stand-in. Store errors are logged
+    and treated as misses so an outage of the cache never fails a request.
+
+    Every delete bumps a generation counter next to the key. A guarded
+    fill watches the counters and only stores the keys whose counter is
+    still the one read by generations() before the load.
+    """
+
+    def __init__(self, client, ttl=30.0, prefix="cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def _generation_key(self, key):
+        return f"{self.prefix}{key}:generation"
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Returns the cached value for key, or None on a miss"""
+        try:
+            raw = self.client.get(self._key(key))
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache get failed: %s", error)
+            raw = None
+        self._count(raw is not None)
+        return None if raw is None else pickle.loads(raw)
+
+    def set(self, key, value, since=None):
+        """Stores value under key for ttl seconds
+
+        With since, from generations(), nothing is stored when key was
+        deleted after it was taken.
+        """
+        self.set_many({key: value}, since)
+
+    def get_many(self, keys):
+        """Returns {key: value} for the keys that are cached"""
+        keys = list(keys)
+        try:
+            raws = self.client.mget([self._key(key) for key in keys])
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache get failed: %s", error)
+            raws = [None] * len(keys)
+        found = {
+            key: pickle.loads(raw)
+            for key, raw in zip(keys, raws)
+            if raw is not None
+        }
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, values, since=None):
+        """Stores every key and value of values for ttl seconds"""
+        if not values:
+            return
+        ttl = max(1, int(self.ttl))
+
+        def fill(pipe, entries):
+            pipe.multi()
+            for key, value in entries.items():
+                pipe.setex(self._key(key), ttl, pickle.dumps(value))
+
+        def guarded_fill(pipe):
+            current = pipe.mget([self._generation_key(key) for key in values])
+            fill(
+                pipe,
+                {
+                    key: value
+                    for (key, value), generation in zip(
+                        values.items(), current
+                    )
+                    if key in since and since[key] == generation
+                },
+            )
+
+        try:
+            if since is None:
+                pipe = self.client.pipeline(transaction=False)
+                fill(pipe, values)
+                pipe.execute()
+            else:
+                self.client.transaction(
+                    guarded_fill,
+                    *(self._generation_key(key) for key in values),
+                )
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache set failed: %s", error)
+
+    def generations(self, keys):
+        """Returns the token to pass to set() for values loaded from now
+
+        When the store cannot be read the token is empty, so nothing
+        loaded under it is stored.
+        """
+        keys = list(keys)
+        try:
+            current = self.client.mget(
+                [self._generation_key(key) for key in keys]
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache get failed: %s", error)
+            return {}
+        return dict(zip(keys, current))
+
+    def delete(self, key):
+        """Removes key from the cache and bumps its generation"""
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(self._key(key))
+            pipe.incr(self._generation_key(key))
+            pipe.expire(self._generation_key(key), max(1, int(self.ttl)))
+            pipe.execute()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache delete failed: %s", error)
+
+    def clear(self):
+        """Removes every entry under this cache's prefix"""
+        try:
+            for key in self.client.scan_iter(f"{self.prefix}*"):
+                self.client.delete(key)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache clear failed: %s", error)
+
+    def stats(self):
+        """Returns the hit and miss counters seen by this process
+
+        Evictions happen inside the shared store and are not counted here.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": 0,
+                "size": None,
+            }
+
+
+def make_cache(config, prefix):
+    """Builds the cache backend selected in the app configuration"""
+    backend = config.get("CACHE_BACKEND", "none")
+    ttl = config.get("CACHE_TTL", 30.0)
+    if backend == "memory":
+        return LRUCache(max_size=config.get("CACHE_MAX_SIZE", 10000), ttl=ttl)
+    if backend == "redis":
+        import redis  # pylint: disable=import-outside-toplevel
+
+        client = redis.Redis.from_url(config["CACHE_REDIS_URL"])
+        return SharedCache(client, ttl=ttl, prefix=prefix)
+    if backend == "none":
+        return NullCache()
+    raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
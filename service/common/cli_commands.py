@@ -2,7 +2,11 @@
 CLI Commands for Flask App
 """
 
+import sys
+from datetime import datetime, timedelta
+
 import click
+from flask import current_app
 from flask.cli import with_appcontext
 
 from service.models import db
@@ -16,6 +20,220 @@ def db_create():
     click.echo("Database created")
 
 
+@click.command("db-migrate")
+@click.option("--target", help="Stop after this migration version.")
+@click.option("--list", "show", is_flag=True, help="List migrations only.")
+@with_appcontext
+def db_migrate(target, show):
+    """Applies the pending schema migrations online"""
+    from service.common import migrations  # pylint: disable=C0415
+
+    migrator = migrations.make_migrator(current_app, progress=click.echo)
+    try:
+        if show:
+            applied = migrator.applied()
+            for migration in migrator.migrations:
+                state = applied.get(migration.version, "pending")
+                click.echo(f"{migration.version} {migration.name}: {state}")
+            return
+        done = migrator.migrate(target)
+    except migrations.MigrationError as error:
+        raise click.ClickException(str(error)) from error
+    click.echo(f"Applied {len(done)} migrations")
+
+
+@click.command("outbox-relay")
+@click.option("--once", is_flag=True, help="Drain what is there and exit.")
+@with_appcontext
+def outbox_relay(once):
+    """Publishes account change events from the outbox"""
+    from service.common.outbox import (  # pylint: disable=C0415
+        OutboxRelay,
+        make_sink,
+    )
+
+    config = current_app.config
+    relay = OutboxRelay(
+        make_sink(config["OUTBOX_SINK"]),
+        batch_size=config["OUTBOX_BATCH_SIZE"],
+        poll_interval=config["OUTBOX_POLL_INTERVAL"],
+        max_backoff=config["OUTBOX_MAX_BACKOFF"],
+    )
+    if once:
+        while relay.drain_once():
+            pass
+    else:
+        click.echo(f"Relaying outbox events to {config['OUTBOX_SINK']}")
+        try:
+            relay.run()
+        except KeyboardInterrupt:
+            pass
+    click.echo(f"Delivered {relay.delivered} events")
+
+
+@click.command("accounts-export")
+@click.argument(
+    "output", default="-", type=click.Path(dir_okay=False, allow_dash=True)
+)
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]))
+@click.option("--batch-size", type=int, help="Rows per fetch and write.")
+@click.option("--workers", default=1, help="Export id ranges in parallel.")
+@click.option("--checkpoint", type=click.Path(dir_okay=False))
+@click.option("--quiet", is_flag=True, help="Do not report progress.")
+@with_appcontext
+def accounts_export(  # pylint: disable=too-many-arguments
+    output, fmt, batch_size, workers, checkpoint, quiet
+):
+    """Exports every Account to OUTPUT as NDJSON or CSV"""
+    from service.common import transfer  # pylint: disable=C0415
+
+    fmt = transfer.format_for(output, fmt)
+    batch_size = batch_size or current_app.config["STREAM_BATCH_SIZE"]
+    progress = None if quiet else _progress("Exported")
+    if workers > 1:
+        if output == "-" or checkpoint:
+            raise click.UsageError(
+                "--workers needs an output file and no --checkpoint"
+            )
+        count = transfer.export_parallel(
+            output, fmt, workers, batch_size, progress
+        )
+    else:
+        if output == "-" and checkpoint:
+            raise click.UsageError("--checkpoint needs an output file")
+        state = transfer.Checkpoint(checkpoint)
+        mode = "a" if state.position else "w"
+        with _open(output, mode) as outfile:
+            count = transfer.export_accounts(
+                outfile, fmt, batch_size, state, progress=progress
+            )
+        state.clear()
+    click.echo(f"Exported {count} accounts", err=True)
+
+
+@click.command("accounts-import")
+@click.argument(
+    "source", default="-", type=click.Path(dir_okay=False, allow_dash=True)
+)
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]))
+@click.option("--chunk-size", type=int, help="Rows per transaction.")
+@click.option("--workers", default=1, help="Insert chunks in parallel.")
+@click.option("--checkpoint", type=click.Path(dir_okay=False))
+@click.option("--keep-ids", is_flag=True, help="Keep the ids of records.")
+@click.option("--no-copy", is_flag=True, help="Use INSERT, not COPY.")
+@click.option("--quiet", is_flag=True, help="Do not report progress.")
+@with_appcontext
+def accounts_import(  # pylint: disable=too-many-arguments
+    source, fmt, chunk_size, workers, checkpoint, keep_ids, no_copy, quiet
+):
+    """Imports Accounts from SOURCE, an NDJSON or CSV file
+
+    Imported Accounts get no outbox events, even with OUTBOX_ENABLED.
+    """
+    from service.common import transfer  # pylint: disable=C0415
+
+    if current_app.config["OUTBOX_ENABLED"] and not quiet:
+        click.echo("Imported accounts get no outbox events", err=True)
+    state = transfer.Checkpoint(checkpoint)
+    with _open(source, "r") as infile:
+        result = transfer.import_accounts(
+            infile,
+            transfer.format_for(source, fmt),
+            chunk_size=chunk_size or current_app.config["BULK_CHUNK_SIZE"],
+            workers=workers,
+            checkpoint=state,
+            keep_ids=keep_ids,
+            use_copy=not no_copy,
+            progress=None if quiet else _progress("Imported"),
+        )
+    state.clear()
+    for error in result.errors:
+        click.echo(f"Skipped {error}", err=True)
+    click.echo(
+        f"Imported {result.imported} accounts, skipped {result.skipped}",
+        err=True,
+    )
+
+
+@click.command("accounts-partition")
+@click.argument("layout", type=click.Choice(["range", "hash", "none"]))
+@click.option("--interval", type=click.Choice(["year", "month"]))
+@click.option("--count", type=int, help="Number of hash partitions.")
+@click.option("--drop-previous", is_flag=True, help="Drop the old table.")
+@with_appcontext
+def accounts_partition(layout, interval, count, drop_previous):
+    """Rebuilds the account table partitioned by LAYOUT, online"""
+    from service.common import partitioning  # pylint: disable=C0415
+
+    try:
+        partitioner = partitioning.make_partitioner(
+            current_app, progress=click.echo, interval=interval, count=count
+        )
+        partitioner.repartition(layout)
+        if drop_previous:
+            partitioner.drop_previous()
+    except partitioning.PartitioningError as error:
+        raise click.ClickException(str(error)) from error
+    click.echo(f"Accounts are partitioned by {layout}")
+
+
+@click.command("accounts-partitions")
+@click.option(
+    "--maintain", is_flag=True, help="Create upcoming range partitions."
+)
+@with_appcontext
+def accounts_partitions(maintain):
+    """Lists the partitions of the account table"""
+    from service.common import partitioning  # pylint: disable=C0415
+
+    try:
+        partitioner = partitioning.make_partitioner(
+            current_app, progress=click.echo
+        )
+    except partitioning.PartitioningError as error:
+        raise click.ClickException(str(error)) from error
+    if maintain:
+        partitioner.maintain()
+    click.echo(f"Accounts are partitioned by {partitioner.layout()}")
+    for name, bound, rows in partitioner.partitions():
+        click.echo(f"{name}: {bound} (~{rows} rows)")
+
+
+@click.command("idempotency-purge")
+@with_appcontext
+def idempotency_purge():
+    """Deletes the Idempotency-Keys older than IDEMPOTENCY_TTL"""
+    from service.models import IdempotencyKey  # pylint: disable=C0415
+
+    ttl = current_app.config["IDEMPOTENCY_TTL"]
+    count = IdempotencyKey.purge(datetime.utcnow() - timedelta(seconds=ttl))
+    click.echo(f"Purged {count} idempotency keys")
+
+
+def _open(path, mode):
+    """Opens path for the transfer commands, with - for stdin or stdout"""
+    if path == "-":
+        stream = sys.stdin if mode == "r" else sys.stdout
+        return click.utils.KeepOpenFile(stream)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _progress(verb):
+    """Returns a callback reporting a running count on stderr"""
+
+    def report(count):
+        click.echo(f"{verb} {count} accounts...", err=True)
+
+    return report
+
+
 def register_commands(app):
     """Register CLI commands with the Flask app"""
     app.cli.add_command(db_create)
+    app.cli.add_command(db_migrate)
+    app.cli.add_command(outbox_relay)
+    app.cli.add_command(accounts_export)
+    app.cli.add_command(accounts_import)
+    app.cli.add_command(idempotency_purge)
+    app.cli.add_command(accounts_partition)
+    app.cli.add_command(accounts_partitions)
@@ -0,0 +1,29 @@
+"""
+Clients
+
+This module tells apart the clients of requests, for the rate limits and
+for keeping a client that just wrote on the primary database. It depends
+on nothing but the request, so the persistence layer can use it without
+loading the HTTP middleware.
+"""
+
+from flask import request
+
+
+def client_key(header=None, proxy_hops=0):
+    """Returns what identifies the client of the current request
+
+    That is the value of header when the client sent it, and otherwise
+    its address. Behind proxy_hops proxies that each append the address
+    they saw to X-Forwarded-For, it is the entry the outermost one added;
+    entries to the left of it come from the client and are ignored. Only
+    pass a header that was authenticated before it got here.
+    """
+    if header:
+        key = request.headers.get(header)
+        if key:
+            return key
+    route = request.access_route
+    if proxy_hops and len(route) >= proxy_hops:
+        return route[-proxy_hops]
+    return request.remote_addr or "unknown"
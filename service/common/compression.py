@@ -0,0 +1,122 @@
+"""
+Response Compression
+
+This module compresses JSON, NDJSON and CSV responses with the best
+encoding the client accepts: brotli when the brotli package is installed,
+and gzip otherwise. Responses smaller than COMPRESS_MIN_SIZE go out as they
+are, since compressing them saves less than it costs.
+
+Streamed responses are compressed as they are produced. Every chunk is
+flushed through the compressor, so the client still receives each chunk
+as soon as it is written rather than when the stream ends.
+
+The compressed bytes differ from the uncompressed ones, so a strong ETag
+on a compressed response is weakened, and every compressible response
+carries Vary: Accept-Encoding so shared caches keep the encodings apart.
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings in order of preference when the client accepts several
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(data, encoding, level):
+    """Returns data compressed whole with encoding at level"""
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_stream(chunks, encoding, level):
+    """Yields chunks compressed, flushing the compressor after each"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class Compressor:
+    """Compresses the responses of an app as the client allows"""
+
+    def __init__(self, config):
+        self.min_size = config.get("COMPRESS_MIN_SIZE", 1024)
+        self.streams = config.get("COMPRESS_STREAMS", True)
+        self.levels = {
+            "gzip": config.get("COMPRESS_GZIP_LEVEL", 6),
+            "br": config.get("COMPRESS_BROTLI_QUALITY", 4),
+        }
+        self.mimetypes = set(
+            name.strip()
+            for name in config.get(
+                "COMPRESS_MIMETYPES",
+                "application/json,application/x-ndjson,text/csv",
+            ).split(",")
+        )
+
+    def negotiate(self):
+        """Returns the encoding to use for this request, or None"""
+        return request.accept_encodings.best_match(ENCODINGS)
+
+    def after_request(self, response):
+        """Compresses response when it is worth it"""
+        if response.mimetype not in self.mimetypes:
+            return response
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code < 200
+            or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        level = self.levels[encoding]
+
+        if response.is_streamed:
+            if not self.streams:
+                return response
+            response.response = compress_stream(
+                response.iter_encoded(), encoding, level
+            )
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(compress(data, encoding, level))
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def init_compression(app):
+    """Compresses responses when COMPRESS_ENABLED is set"""
+    if not app.config.get("COMPRESS_ENABLED", True):
+        return
+    compressor = Compressor(app.config)
+    app.extensions["compressor"] = compressor
+    app.after_request(compressor.after_request)
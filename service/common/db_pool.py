@@ -0,0 +1,188 @@
+"""
+Database Connection Pool
+
+This module builds the SQLAlchemy engine options from the app configuration
+and keeps per-process statistics about pool checkouts and waits, apart for
+the primary and for every replica.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.util.queue import Queue
+
+
+class PoolStats:
+    """Counters for connection pool activity in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Sets every counter back to zero"""
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_count = 0
+            self.wait_seconds = 0.0
+            self.wait_max_seconds = 0.0
+            self.last_wait_seconds = 0.0
+            self.last_wait_at = None
+
+    def increment(self, counter):
+        """Adds one to the named counter"""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe_wait(self, seconds, clock=time.monotonic):
+        """Records how long a checkout waited for a connection"""
+        with self._lock:
+            self.wait_count += 1
+            self.wait_seconds += seconds
+            self.wait_max_seconds = max(self.wait_max_seconds, seconds)
+            self.last_wait_seconds = seconds
+            self.last_wait_at = clock()
+
+    def recent_wait(self, window, clock=time.monotonic):
+        """Returns the last checkout wait if it ended within window seconds
+
+        Older waits count as zero, so a pool that has stopped being used,
+        for instance because requests are being shed, is seen as healthy
+        again once the window has passed.
+        """
+        with self._lock:
+            if self.last_wait_at is None:
+                return 0.0
+            if clock() - self.last_wait_at > window:
+                return 0.0
+            return self.last_wait_seconds
+
+    def snapshot(self):
+        """Returns the current counters as a dictionary"""
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checked_out": self.checkouts - self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_count": self.wait_count,
+                "wait_seconds": self.wait_seconds,
+                "wait_max_seconds": self.wait_max_seconds,
+                "last_wait_seconds": self.last_wait_seconds,
+            }
+
+
+# Statistics of the pools of the primary database in this process
+pool_stats = PoolStats()
+
+# Pool events and the counters they bump
+POOL_EVENTS = (
+    ("connect", "connects"),
+    ("checkout", "checkouts"),
+    ("checkin", "checkins"),
+    ("invalidate", "invalidations"),
+)
+
+
+class TimedQueue(Queue):
+    """Queue of idle connections that records how long a checkout waits"""
+
+    stats = pool_stats
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            self.stats.observe_wait(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records its activity in its stats
+
+    Only the time spent waiting for an idle connection counts as a wait;
+    opening a new connection and pre-pinging it do not, so slow connects
+    are not mistaken for an exhausted pool.
+    """
+
+    _queue_class = TimedQueue
+    stats = pool_stats
+
+    def __init__(self, creator, **kwargs):
+        super().__init__(creator, **kwargs)
+        self._pool.stats = self.stats
+        # A recreated pool inherits the listeners of the one it replaces
+        if "_dispatch" not in kwargs:
+            for name, counter in POOL_EVENTS:
+                event.listen(self, name, _counter(self.stats, counter))
+
+    def connect(self):
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            self.stats.increment("timeouts")
+            raise
+
+
+def _counter(stats, counter):
+    """Returns a pool event listener adding one to counter of stats"""
+
+    def count(*_):
+        stats.increment(counter)
+
+    return count
+
+
+def instrumented_pool(stats):
+    """Returns an InstrumentedQueuePool class recording into stats"""
+    return type(
+        "InstrumentedQueuePool", (InstrumentedQueuePool,), {"stats": stats}
+    )
+
+
+def engine_options(config, stats=None):
+    """Returns SQLALCHEMY_ENGINE_OPTIONS for the configured database
+
+    SQLite keeps SQLAlchemy's defaults. In PgBouncer mode pooling is left
+    to PgBouncer and no startup parameters are sent, since PgBouncer
+    rejects them in transaction pooling mode; psycopg2 never prepares
+    statements on the server, so nothing else has to change. Set the
+    statement timeout on the database role instead in that mode.
+
+    The pool records into stats, by default the pool_stats of the
+    primary, which load shedding watches; give other databases their own.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite":
+        return {}
+    if config.get("DB_PGBOUNCER"):
+        return {"poolclass": NullPool}
+
+    options = {
+        "poolclass": (
+            InstrumentedQueuePool
+            if stats is None
+            else instrumented_pool(stats)
+        ),
+        "pool_size": config.get("DB_POOL_SIZE", 5),
+        "max_overflow": config.get("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": config.get("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+    }
+    timeout = config.get("DB_STATEMENT_TIMEOUT_MS")
+    if timeout and url.get_backend_name() == "postgresql":
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={int(timeout)}"
+        }
+    return options
@@ -13,13 +13,13 @@ def init_error_handlers(app):
     @app.errorhandler(DataValidationError)
     def request_validation_error(error):
         """Handle DataValidationError with 400 response"""
-        current_app.logger.warning(f"Validation error: {str(error)}")
+        current_app.logger.info("Validation error: %s", error)
         return bad_request(error)
 
     @app.errorhandler(status.HTTP_400_BAD_REQUEST)
     def bad_request(error):
         """Handle 400 Bad Request"""
-        current_app.logger.warning(f"400 Bad Request: {str(error)}")
+        current_app.logger.info("400 Bad Request: %s", error)
         return (
             jsonify(
                 status=status.HTTP_400_BAD_REQUEST,
@@ -32,7 +32,7 @@ def init_error_handlers(app):
     @app.errorhandler(status.HTTP_404_NOT_FOUND)
     def not_found(error):
         """Handle 404 Not Found"""
-        current_app.logger.warning(f"404 Not Found: {str(error)}")
+        current_app.logger.info("404 Not Found: %s", error)
         return (
             jsonify(
                 status=status.HTTP_404_NOT_FOUND,
@@ -45,7 +45,7 @@ def init_error_handlers(app):
     @app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
     def method_not_supported(error):
         """Handle 405 Method Not Allowed"""
-        current_app.logger.warning(f"405 Method Not Allowed: {str(error)}")
+        current_app.logger.info("405 Method Not Allowed: %s", error)
         return (
             jsonify(
                 status=status.HTTP_405_METHOD_NOT_ALLOWED,
@@ -55,12 +55,36 @@ def init_error_handlers(app):
             status.HTTP_405_METHOD_NOT_ALLOWED,
         )
 
+    @app.errorhandler(status.HTTP_409_CONFLICT)
+    def resource_conflict(error):
+        """Handle 409 Conflict"""
+        current_app.logger.info("409 Conflict: %s", error)
+        return (
+            jsonify(
+                status=status.HTTP_409_CONFLICT,
+                error="Conflict",
+                message=str(error),
+            ),
+            status.HTTP_409_CONFLICT,
+        )
+
+    @app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+    def precondition_failed(error):
+        """Handle 412 Precondition Failed"""
+        current_app.logger.info("412 Precondition Failed: %s", error)
+        return (
+            jsonify(
+                status=status.HTTP_412_PRECONDITION_FAILED,
+                error="Precondition Failed",
+                message=str(error),
+            ),
+            status.HTTP_412_PRECONDITION_FAILED,
+        )
+
     @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
     def mediatype_not_supported(error):
         """Handle 415 Unsupported Media Type"""
-        current_app.logger.warning(
-            f"415 Unsupported Media Type: {str(error)}"
-        )
+        current_app.logger.info("415 Unsupported Media Type: %s", error)
         return (
             jsonify(
                 status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
@@ -70,10 +94,23 @@ def init_error_handlers(app):
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
         )
 
+    @app.errorhandler(status.HTTP_422_UNPROCESSABLE_ENTITY)
+    def unprocessable_entity(error):
+        """Handle 422 Unprocessable Entity"""
+        current_app.logger.info("422 Unprocessable Entity: %s", error)
+        return (
+            jsonify(
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                error="Unprocessable Entity",
+                message=str(error),
+            ),
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+
     @app.errorhandler(500)
     def internal_server_error(error):
         """Handle generic 500 Internal Server Error"""
-        current_app.logger.error(f"500 Internal Server Error: {str(error)}")
+        current_app.logger.error("500 Internal Server Error: %s", error)
         return (
             jsonify(
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -0,0 +1,55 @@
+"""
+HTTP Caching
+
+This module sets the Cache-Control and Vary headers of the routes. Each
+route declares its policy with the cache_control() decorator, and
+CACHE_CONTROL_OVERRIDES replaces the policy of any endpoint without
+touching the code, given as "endpoint=policy;..." since policies contain
+commas. Only successful and 304 responses get a policy; errors never do.
+"""
+
+import functools
+
+from flask import current_app, make_response, request
+
+
+def parse_policies(spec):
+    """Parses 'endpoint=policy;...' into {endpoint: policy}"""
+    policies = {}
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        endpoint, _, policy = item.partition("=")
+        policies[endpoint.strip()] = policy.strip()
+    return policies
+
+
+def cache_control(policy, vary=()):
+    """Decorates a view to send policy as its Cache-Control header
+
+    vary names the request headers the response depends on, beyond the
+    URL, for instance Accept when the body is negotiated.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            response = make_response(view(*args, **kwargs))
+            if response.status_code >= 400:
+                return response
+            overrides = current_app.extensions.get("cache_policies", {})
+            value = overrides.get(request.endpoint, policy)
+            if value and "Cache-Control" not in response.headers:
+                response.headers["Cache-Control"] = value
+            for header in vary:
+                response.vary.add(header)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def init_http_caching(app):
+    """Loads the Cache-Control overrides of the configuration"""
+    app.extensions["cache_policies"] = parse_policies(
+        app.config.get("CACHE_CONTROL_OVERRIDES", "")
+    )
@@ -0,0 +1,174 @@
+"""
+Idempotency Keys
+
+This module lets clients retry a POST safely by sending an Idempotency-Key
+header. The first request with a key runs as usual and its response is
+stored; a retry with the same key and body gets that response back
+without running the request again.
+
+Completed responses are kept in an in-process LRU in front of the
+IdempotencyKey table, which is shared by every replica. A duplicate that
+arrives while the first request is still running gets 409 Conflict, and
+reusing a key with a different body gets 422 Unprocessable Entity.
+
+The response is stored in a transaction of its own, after the request has
+committed its changes. Should the worker die between the two commits, the
+claim stays in progress until IDEMPOTENCY_LOCK_TIMEOUT and a retry after
+that runs the request again, so it can be applied twice.
+"""
+
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import Response, abort, current_app, request
+
+from service.common import status
+from service.common.cache import LRUCache
+from service.models import IdempotencyKey, db
+
+# Longest key accepted, matching the IdempotencyKey column
+MAX_KEY_LENGTH = 255
+
+# Attempts to claim a key whose previous holder expired meanwhile
+CLAIM_ATTEMPTS = 3
+
+
+class StoredResponse:
+    """A response replayed for requests that reuse its key"""
+
+    def __init__(self, fingerprint, status_code, body, etag=None):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.etag = etag
+
+    def to_response(self):
+        """Returns the stored response, marked as a replay"""
+        response = Response(
+            self.body, status=self.status_code, mimetype="application/json"
+        )
+        if self.etag:
+            response.headers["ETag"] = self.etag
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+
+class IdempotencyStore:
+    """Runs requests at most once per Idempotency-Key"""
+
+    def __init__(self, ttl=86400, lock_timeout=60, max_size=10000):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def handle(self, key, fingerprint, handler):
+        """Returns handler() the first time key is seen, then its replay
+
+        Only successful responses are stored. When handler fails, the
+        claim is released so the client can retry with the same key, after
+        rolling back whatever the handler left in the session.
+        """
+        stored = self.cache.get(key) or self._claim(key, fingerprint)
+        if stored is not None:
+            _check_fingerprint(stored.fingerprint, fingerprint)
+            return stored.to_response()
+
+        try:
+            response = handler()
+        except Exception:
+            db.session.rollback()
+            IdempotencyKey.release(key)
+            raise
+        if response.status_code >= 300:
+            IdempotencyKey.release(key)
+            return response
+        stored = StoredResponse(
+            fingerprint,
+            response.status_code,
+            response.get_data(as_text=True),
+            response.headers.get("ETag"),
+        )
+        IdempotencyKey.complete(
+            key, stored.status_code, stored.body, stored.etag
+        )
+        self.cache.set(key, stored)
+        return response
+
+    def _claim(self, key, fingerprint):
+        """Claims key, returning None or the response already stored"""
+        for _ in range(CLAIM_ATTEMPTS):
+            claimed, record = IdempotencyKey.claim(key, fingerprint)
+            if claimed:
+                return None
+            if record is None:
+                continue
+            if self._expired(record):
+                IdempotencyKey.release(key, record.created_at)
+                continue
+            _check_fingerprint(record.fingerprint, fingerprint)
+            if not record.completed:
+                abort(
+                    status.HTTP_409_CONFLICT,
+                    f"A request with Idempotency-Key [{key}] is in progress.",
+                )
+            stored = StoredResponse(
+                record.fingerprint,
+                record.status_code,
+                record.body,
+                record.etag,
+            )
+            self.cache.set(key, stored)
+            return stored
+        abort(
+            status.HTTP_409_CONFLICT,
+            f"Idempotency-Key [{key}] could not be claimed.",
+        )
+        return None
+
+    def _expired(self, record):
+        """True when a stored record should no longer be honored"""
+        lifetime = self.ttl if record.completed else self.lock_timeout
+        age = datetime.utcnow() - record.created_at
+        return age > timedelta(seconds=lifetime)
+
+
+def _check_fingerprint(stored, fingerprint):
+    """Aborts with 422 when a key is reused for a different request"""
+    if stored != fingerprint:
+        abort(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "Idempotency-Key was already used for a different request.",
+        )
+
+
+def request_fingerprint(method, path, body):
+    """Returns a digest identifying a request, to detect reused keys"""
+    digest = hashlib.sha256(f"{method} {path}\n".encode("utf-8"))
+    digest.update(body)
+    return digest.hexdigest()
+
+
+def init_idempotency(app):
+    """Installs the Idempotency-Key store on the app"""
+    app.extensions["idempotency"] = IdempotencyStore(
+        ttl=app.config["IDEMPOTENCY_TTL"],
+        lock_timeout=app.config["IDEMPOTENCY_LOCK_TIMEOUT"],
+        max_size=app.config["IDEMPOTENCY_CACHE_SIZE"],
+    )
+
+
+def idempotent(handler):
+    """Returns handler(), honoring the Idempotency-Key of the request"""
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return handler()
+    if not key or len(key) > MAX_KEY_LENGTH:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters.",
+        )
+    digest = request_fingerprint(
+        request.method, request.path, request.get_data()
+    )
+    store = current_app.extensions["idempotency"]
+    return store.handle(key, digest, handler)
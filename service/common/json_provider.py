@@ -0,0 +1,91 @@
+"""
+JSON Provider
+
+This module picks the JSON encoder used for Account payloads. orjson is used
+when it is installed and the standard library otherwise. Flask 2.1 has no
+pluggable JSON provider of its own, so the chosen provider is stored in
+app.extensions and the routes build their responses with json_response().
+"""
+
+import json
+from datetime import date, datetime
+
+from flask import Response, current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    """Encodes the types the standard library encoder does not know"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON")
+
+
+class StdlibJSONProvider:
+    """Encodes with the standard library json module"""
+
+    name = "stdlib"
+
+    @staticmethod
+    def dumps(obj):
+        """Returns obj encoded as compact JSON text"""
+        return json.dumps(obj, default=_default, separators=(",", ":"))
+
+    @staticmethod
+    def loads(data):
+        """Returns the object decoded from JSON text or bytes"""
+        return json.loads(data)
+
+
+class OrjsonProvider:
+    """Encodes with orjson, which handles dates natively"""
+
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj):
+        """Returns obj encoded as compact JSON text"""
+        return orjson.dumps(obj).decode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        """Returns the object decoded from JSON text or bytes"""
+        return orjson.loads(data)
+
+
+def make_provider(name="auto"):
+    """Returns the named provider; auto prefers orjson when installed"""
+    if name == "auto":
+        name = "stdlib" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("JSON_PROVIDER is orjson but it is missing")
+        return OrjsonProvider()
+    if name == "stdlib":
+        return StdlibJSONProvider()
+    raise ValueError(f"Unknown JSON_PROVIDER: {name}")
+
+
+def init_json(app):
+    """Installs the configured JSON provider on the app"""
+    provider = make_provider(app.config.get("JSON_PROVIDER", "auto"))
+    app.extensions["json_provider"] = provider
+    app.logger.info("Using the %s JSON provider", provider.name)
+
+
+def get_provider():
+    """Returns the JSON provider of the current app"""
+    return current_app.extensions["json_provider"]
+
+
+def json_response(payload, status_code):
+    """Returns a response with payload encoded by the app's provider"""
+    return Response(
+        get_provider().dumps(payload),
+        status=status_code,
+        mimetype="application/json",
+    )
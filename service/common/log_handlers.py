@@ -2,24 +2,272 @@
 Log Handlers
 
 This module contains utility functions to set up logging consistently.
+
+Records are handed to a queue and written by a background thread, so a
+request never waits on log I/O; when the queue is full, records are
+dropped rather than blocking the request. Each record carries the ID of
+the request that logged it, and every request gets one access record with
+its status and duration. Records are written as JSON lines or as text.
+
+Below WARNING, records are kept for a LOG_SAMPLE_RATE fraction of requests
+(every record of a sampled request is kept, so its story stays whole) and
+each message is written at most LOG_RATE_LIMIT times per second.
 """
 
+import json
 import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON"""
+
+    # Record attributes added with extra= that are written out
+    EXTRA_FIELDS = ("method", "path", "status", "duration_ms")
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The original text format, with the request ID"""
+
+    def __init__(self):
+        super().__init__(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] "
+            "[%(request_id)s] %(message)s",
+            "%Y-%m-%d %H:%M:%S %z",
+        )
+
+    def format(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = None
+        return super().format(record)
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps every record with the ID of the current request"""
+
+    def filter(self, record):
+        record.request_id = (
+            g.get("request_id") if has_request_context() else None
+        )
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Thins out records below WARNING by request and by message
+
+    Requests are sampled when they start; records logged outside of a
+    request are always kept. With a rate limit, each message template is
+    written at most rate_limit times per second.
+    """
+
+    def __init__(self, rate_limit=0.0, clock=time.monotonic):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.suppressed = 0
+        self._clock = clock
+        self._second = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if has_request_context() and not g.get("log_sampled", True):
+            return False
+        if self.rate_limit and not self._allow(record):
+            self.suppressed += 1
+            return False
+        return True
+
+    def _allow(self, record):
+        """Counts a record against the limit of its message per second"""
+        second = int(self._clock())
+        key = (record.name, record.msg)
+        with self._lock:
+            if second != self._second:
+                self._second, self._counts = second, {}
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+            return count < self.rate_limit
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of waiting for room"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        """Makes a record safe to queue, leaving the formatting to later
+
+        The message is merged with its arguments and a traceback is turned
+        into text, while the extra fields stay for the formatter.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+class LogPipeline:
+    """A queue of records drained into the handlers by a thread"""
+
+    def __init__(self, handlers, maxsize=10000):
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.handler = NonBlockingQueueHandler(queue.Queue(maxsize))
+        self.listener = None
+
+    def start(self):
+        """Starts the thread writing queued records"""
+        self.listener = QueueListener(
+            self.handler.queue, *self.handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self):
+        """Writes the records still queued and stops the thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart_after_fork(self):
+        """Gives a forked child a queue and thread of its own
+
+        Threads do not survive a fork, so a worker forked from a master
+        that preloaded the app would otherwise queue records forever.
+        """
+        self.handler.queue = queue.Queue(self.maxsize)
+        self.start()
+
+
+# The pipeline of this process, restarted in forked children
+_pipeline = None
+
+
+def _restart_pipeline():
+    if _pipeline is not None and _pipeline.listener is not None:
+        _pipeline.restart_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_pipeline)
 
 
 def init_logging(app, logger_name: str):
-    """Set up logging for production"""
-    app.logger.propagate = False
+    """Set up logging for production
+
+    The app logger and the "flask.app" logger of the models share the
+    handlers of logger_name, behind the queue when LOG_QUEUE is set.
+    """
+    global _pipeline  # pylint: disable=global-statement
+    config = app.config
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = list(gunicorn_logger.handlers)
+    loggers = [app.logger, logging.getLogger("flask.app")]
+    for logger in loggers:
+        logger.propagate = False
+        logger.setLevel(gunicorn_logger.level)
 
     # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s",
-        "%Y-%m-%d %H:%M:%S %z",
-    )
-    for handler in app.logger.handlers:
+    if config.get("LOG_FORMAT", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter()
+    for handler in handlers:
         handler.setFormatter(formatter)
 
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline = None
+    if handlers and config.get("LOG_QUEUE", True):
+        _pipeline = LogPipeline(handlers, config.get("LOG_QUEUE_SIZE", 10000))
+        _pipeline.start()
+        handlers = [_pipeline.handler]
+    sampling = SamplingFilter(config.get("LOG_RATE_LIMIT", 0.0))
+    for handler in handlers:
+        for old in handler.filters[:]:
+            if isinstance(old, (RequestContextFilter, SamplingFilter)):
+                handler.removeFilter(old)
+        handler.addFilter(RequestContextFilter())
+        handler.addFilter(sampling)
+    for logger in loggers:
+        logger.handlers = handlers
+    app.extensions["log_sampling"] = sampling
+
+    _init_request_logging(app)
     app.logger.info("Logging handler established")
+
+
+def _init_request_logging(app):
+    """Tags every request with an ID and logs it when it completes"""
+    header = app.config.get("LOG_REQUEST_ID_HEADER", "X-Request-ID")
+    sample_rate = app.config.get("LOG_SAMPLE_RATE", 1.0)
+    access = app.config.get("LOG_ACCESS", True)
+
+    @app.before_request
+    def _start_request():
+        g.request_id = request.headers.get(header) or uuid.uuid4().hex
+        g.log_sampled = sample_rate >= 1 or random.random() < sample_rate
+        g.log_start = time.perf_counter()
+
+    @app.after_request
+    def _finish_request(response):
+        response.headers.setdefault(header, g.get("request_id", ""))
+        start = g.pop("log_start", None)
+        if access and start is not None:
+            app.logger.log(
+                logging.WARNING
+                if response.status_code >= 500
+                else logging.INFO,
+                "%s %s %s",
+                request.method,
+                request.path,
+                response.status_code,
+                extra={
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "duration_ms": round(
+                        (time.perf_counter() - start) * 1000, 3
+                    ),
+                },
+            )
+        return response
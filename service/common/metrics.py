@@ -0,0 +1,223 @@
+"""
+Metrics
+
+This module records request and database metrics and exports them in the
+Prometheus text format on /metrics.
+
+When gunicorn runs several workers, set PROMETHEUS_MULTIPROC_DIR to an
+empty directory shared by them before the service starts. Every worker then
+writes its samples there and /metrics aggregates all of them, whichever
+worker answers the scrape.
+"""
+
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from service.common.db_pool import pool_stats
+
+# Fixed buckets keep each observation to a short scan and a counter bump
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUEST_COUNT = Counter(
+    "http_requests_total",
+    "HTTP requests handled",
+    ["method", "endpoint", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ["method", "endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_REJECTED = Counter(
+    "http_requests_rejected_total",
+    "HTTP requests turned away by rate limiting or load shedding",
+    ["reason"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Time spent executing SQL statements",
+    ["endpoint"],
+    buckets=QUERY_BUCKETS,
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request",
+    "SQL statements issued per HTTP request",
+    ["endpoint"],
+    buckets=QUERY_COUNT_BUCKETS,
+)
+DB_TIME_PER_REQUEST = Histogram(
+    "db_time_per_request_seconds",
+    "Time spent in SQL statements per HTTP request",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+class StatsCollector:
+    """Exports the in-process pool, cache and coalescing counters
+
+    These counters live in the worker answering the scrape, so they are
+    labelled with its pid rather than aggregated across workers.
+    """
+
+    def __init__(self, caches, flights=None):
+        self.caches = caches
+        self.flights = flights or {}
+
+    def collect(self):
+        """Yields a metric family for every pool and cache counter"""
+        pid = str(os.getpid())
+        stats = pool_stats.snapshot()
+        for name in ("checked_out", "last_wait_seconds", "wait_max_seconds"):
+            gauge = GaugeMetricFamily(
+                f"db_pool_{name}", f"Connection pool {name}", labels=["pid"]
+            )
+            gauge.add_metric([pid], stats[name])
+            yield gauge
+        for name in ("connects", "checkouts", "invalidations", "timeouts"):
+            counter = CounterMetricFamily(
+                f"db_pool_{name}", f"Connection pool {name}", labels=["pid"]
+            )
+            counter.add_metric([pid], stats[name])
+            yield counter
+
+        for field in ("hits", "misses", "evictions"):
+            counter = CounterMetricFamily(
+                f"cache_{field}", f"Cache {field}", labels=["cache", "pid"]
+            )
+            for cache_name, cache in self.caches.items():
+                counter.add_metric([cache_name, pid], cache.stats()[field])
+            yield counter
+
+        yield from self._collect_flights(pid)
+
+    def _collect_flights(self, pid):
+        """Yields the single-flight counters and their coalescing ratio"""
+        stats = {name: flight.stats() for name, flight in self.flights.items()}
+        for field in ("leaders", "followers"):
+            counter = CounterMetricFamily(
+                f"single_flight_{field}",
+                f"Lookups that were single-flight {field}",
+                labels=["flight", "pid"],
+            )
+            for name, counts in stats.items():
+                counter.add_metric([name, pid], counts[field])
+            yield counter
+        ratio = GaugeMetricFamily(
+            "single_flight_coalescing_ratio",
+            "Share of lookups served by another lookup already in flight",
+            labels=["flight", "pid"],
+        )
+        for name, counts in stats.items():
+            total = counts["leaders"] + counts["followers"]
+            ratio.add_metric(
+                [name, pid], counts["followers"] / total if total else 0.0
+            )
+        yield ratio
+
+
+def init_metrics(app, caches=None, flights=None):
+    """Records metrics for every request and serves them on /metrics"""
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+    _listen_for_queries()
+    collector = StatsCollector(caches or {}, flights)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        g.db_queries = 0
+        g.db_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        REQUEST_COUNT.labels(
+            request.method, endpoint, str(response.status_code)
+        ).inc()
+        REQUEST_LATENCY.labels(request.method, endpoint).observe(
+            time.perf_counter() - start
+        )
+        DB_QUERIES_PER_REQUEST.labels(endpoint).observe(g.db_queries)
+        DB_TIME_PER_REQUEST.labels(endpoint).observe(g.db_seconds)
+        return response
+
+    def export_metrics():
+        """Returns every metric in the Prometheus text format"""
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            output = generate_latest(registry)
+        else:
+            output = generate_latest(REGISTRY)
+        local = CollectorRegistry()
+        local.register(collector)
+        output += generate_latest(local)
+        return Response(output, mimetype=CONTENT_TYPE_LATEST)
+
+    app.add_url_rule("/metrics", "metrics", export_metrics)
+
+
+######################################################################
+#  S Q L A L C H E M Y   E V E N T S
+######################################################################
+
+
+def _listen_for_queries():
+    """Times the SQL statements of every engine, once per process
+
+    Engines are created lazily and again whenever their URI changes, so
+    the listeners go on the Engine class rather than on engines that
+    exist when the app starts. Nothing is timed unless metrics are on.
+    """
+    if event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+def _before_cursor_execute(conn, *_):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, *_):
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if has_request_context() and "db_queries" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+        DB_QUERY_LATENCY.labels(request.endpoint or "unmatched").observe(
+            elapsed
+        )
+    else:
+        DB_QUERY_LATENCY.labels("none").observe(elapsed)
+
+
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("query_start")
+        if starts:
+            starts.pop()
@@ -0,0 +1,572 @@
+"""
+Schema Migrations
+
+This module brings an existing database up to the schema of the models
+without taking the account table offline. db.create_all() only creates
+missing tables, so every later change to a table ships as a numbered
+Migration in MIGRATIONS, applied in order by the db-migrate command and
+recorded in the schema_migration table.
+
+Migrations run online, so each step is safe to repeat and to run while the
+service is taking traffic:
+
+* Indexes are built with CREATE INDEX CONCURRENTLY on Postgres, which does
+  not block writes. A build that fails leaves an INVALID index behind; it
+  is dropped and built again on the next run.
+* Columns are added nullable, which Postgres does without rewriting the
+  table, then filled by a batched backfill that commits every batch and
+  pauses between batches, and only then made NOT NULL through a validated
+  CHECK constraint instead of a full-table scan under an exclusive lock.
+  They get a non-volatile server default, so rows that pods still running
+  the previous release insert meanwhile are never NULL.
+* Every DDL statement runs under lock_timeout. One stuck behind a long
+  transaction gives up instead of queueing every other query on the table
+  behind it, and is retried with a backoff.
+
+A Postgres advisory lock keeps two migrators, for instance two pods
+starting at once, from running side by side. Run migrations against the
+database directly rather than through PgBouncer in transaction pooling
+mode, since they rely on session settings and locks.
+"""
+
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.schema import CreateIndex as CreateIndexDDL
+
+from service.models import db, transaction_time
+
+logger = logging.getLogger("flask.app")
+
+# Postgres error code for a lock that could not be taken in time
+LOCK_NOT_AVAILABLE = "55P03"
+
+# Key of the advisory lock held while migrating
+ADVISORY_LOCK_KEY = 7_024_024
+
+metadata = db.MetaData()
+
+schema_migration = db.Table(
+    "schema_migration",
+    metadata,
+    db.Column("version", db.String(32), primary_key=True),
+    db.Column("name", db.String(128), nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+
+class MigrationError(Exception):
+    """Raised when migrations cannot be applied as asked"""
+
+
+def _lock_timed_out(error):
+    """True when error is a Postgres lock_timeout"""
+    return getattr(error.orig, "pgcode", None) == LOCK_NOT_AVAILABLE
+
+
+######################################################################
+#  S T E P S
+######################################################################
+class CreateTables:
+    """Creates the tables of the models that do not exist yet"""
+
+    def __init__(self, *names):
+        self.names = names
+
+    def __str__(self):
+        return f"create tables {', '.join(self.names)}"
+
+    def run(self, migrator):
+        """Creates each missing table along with its indexes"""
+        for name in self.names:
+            table = db.metadata.tables[name]
+            migrator.guarded(lambda conn, t=table: t.create(conn, True))
+
+
+class AddColumn:
+    """Adds a column to a table unless it is already there
+
+    Add columns nullable and without a volatile default, so Postgres only
+    changes the catalog; fill them with a Backfill and tighten them with
+    SetNotNull afterwards. SQLite only adds columns with a constant
+    default, so an expression default is left out there.
+    """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def __str__(self):
+        return f"add column {self.table}.{self.column.name}"
+
+    def run(self, migrator):
+        """Adds the column under lock_timeout"""
+        if migrator.column(self.table, self.column.name):
+            return
+        column = self.column
+        default = column.server_default
+        if (
+            migrator.dialect.name == "sqlite"
+            and default is not None
+            and not isinstance(default.arg, str)
+        ):
+            column = column._copy()  # pylint: disable=protected-access
+            column.server_default = None
+        spec = CreateColumn(column).compile(dialect=migrator.dialect)
+        migrator.execute(f"ALTER TABLE {self.table} ADD COLUMN {spec}")
+
+
+class Backfill:
+    """Sets columns on the rows matching where, one batch at a time
+
+    Each batch is the next batch_size keys in order and commits on its
+    own, so no transaction holds row locks for long, and the migrator
+    pauses between batches to leave the database room for live traffic.
+    assignments is SQL text, or {column: expression} for values that are
+    compiled for the database.
+    """
+
+    def __init__(self, table, assignments, where, key="id"):
+        self.table = table
+        self.assignments = assignments
+        self.where = where
+        self.key = key
+
+    def __str__(self):
+        assignments = self.assignments
+        if isinstance(assignments, dict):
+            assignments = ", ".join(assignments)
+        return f"backfill {self.table} set {assignments}"
+
+    def run(self, migrator):
+        """Updates the matching rows in batches until none are left"""
+        assignments = self.assignments
+        if isinstance(assignments, dict):
+            assignments = ", ".join(
+                f"{name} = {value.compile(dialect=migrator.dialect)}"
+                for name, value in assignments.items()
+            )
+        update = text(
+            f"UPDATE {self.table} SET {assignments} WHERE "
+            f"{self.key} > :after AND {self.key} <= :upto AND ({self.where})"
+        )
+        total = 0
+        for after, upto in migrator.batches(self.table, self.where, self.key):
+            total += migrator.guarded(
+                lambda conn, after=after, upto=upto: conn.execute(
+                    update, {"after": after, "upto": upto}
+                ).rowcount
+            )
+            migrator.report(f"Backfilled {total} {self.table} rows")
+
+
+class SetNotNull:
+    """Makes a backfilled column NOT NULL
+
+    On Postgres a NOT VALID check constraint is added and then validated,
+    which scans the table without blocking writes; SET NOT NULL can then
+    trust the constraint instead of scanning under an exclusive lock.
+    SQLite cannot alter a column, so there the step is skipped.
+    """
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+
+    def __str__(self):
+        return f"set {self.table}.{self.column} not null"
+
+    def run(self, migrator):
+        """Validates the column holds no NULLs and marks it NOT NULL"""
+        info = migrator.column(self.table, self.column)
+        if info is None or not info["nullable"]:
+            return
+        if migrator.dialect.name != "postgresql":
+            logger.warning("Cannot alter columns on %s", migrator.dialect.name)
+            return
+        check = f"{self.table}_{self.column}_not_null"
+        migrator.execute(
+            f"ALTER TABLE {self.table} DROP CONSTRAINT IF EXISTS {check}",
+            f"ALTER TABLE {self.table} ADD CONSTRAINT {check} "
+            f"CHECK ({self.column} IS NOT NULL) NOT VALID",
+        )
+        migrator.execute(
+            f"ALTER TABLE {self.table} VALIDATE CONSTRAINT {check}"
+        )
+        migrator.execute(
+            f"ALTER TABLE {self.table} "
+            f"ALTER COLUMN {self.column} SET NOT NULL",
+            f"ALTER TABLE {self.table} DROP CONSTRAINT {check}",
+        )
+
+
+class CreateIndex:
+    """Builds an index declared on a model, without blocking writes
+
+    The index is looked up by name among the indexes of the table in the
+    models, so the migration builds exactly what the model declares. On a
+    partitioned table, each partition is indexed concurrently instead.
+    """
+
+    def __init__(self, table, name):
+        self.table = table
+        self.name = name
+
+    def __str__(self):
+        return f"create index {self.name}"
+
+    def run(self, migrator):
+        """Builds the index concurrently on Postgres, plainly elsewhere"""
+        index = next(
+            index
+            for index in db.metadata.tables[self.table].indexes
+            if index.name == self.name
+        )
+        ddl = str(
+            CreateIndexDDL(index, if_not_exists=True).compile(
+                dialect=migrator.dialect
+            )
+        )
+        if migrator.dialect.name != "postgresql":
+            migrator.execute(ddl)
+            return
+        ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+        migrator.guarded(lambda conn: self._build(conn, ddl), autocommit=True)
+
+    def _build(self, conn, ddl):
+        """Drops a leftover INVALID build, then builds the index"""
+        if _index_valid(conn, self.name):
+            return
+        partitions = conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass(:table) ORDER BY c.relname"
+            ),
+            {"table": self.table},
+        ).scalars()
+        partitions = list(partitions)
+        if not partitions:
+            _drop_invalid(conn, self.name)
+            conn.execute(text(ddl))
+            return
+        # A partitioned table cannot be indexed concurrently. The parent
+        # index is created ON ONLY the parent, which builds nothing, and
+        # becomes valid once every partition's index, each built
+        # concurrently, is attached to it.
+        target = f" {self.name} ON {self.table} "
+        conn.execute(
+            text(
+                ddl.replace(" CONCURRENTLY", "", 1).replace(
+                    target, f" {self.name} ON ONLY {self.table} ", 1
+                )
+            )
+        )
+        for partition in partitions:
+            name = f"{partition}_{self.name}"[:63]
+            _drop_invalid(conn, name)
+            conn.execute(
+                text(ddl.replace(target, f" {name} ON {partition} ", 1))
+            )
+            conn.execute(
+                text(f"ALTER INDEX {self.name} ATTACH PARTITION {name}")
+            )
+
+
+def _index_valid(conn, name):
+    """Returns whether index name is valid, or None if there is none"""
+    return conn.execute(
+        text(
+            "SELECT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+        ),
+        {"name": name},
+    ).scalar()
+
+
+def _drop_invalid(conn, name):
+    """Drops index name if an interrupted concurrent build left it INVALID"""
+    if _index_valid(conn, name) is False:
+        logger.warning("Rebuilding invalid index %s", name)
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+class RunSql:
+    """Runs SQL statements in one transaction under lock_timeout"""
+
+    def __init__(self, *statements):
+        self.statements = statements
+
+    def __str__(self):
+        return f"run {len(self.statements)} statements"
+
+    def run(self, migrator):
+        """Runs the statements"""
+        migrator.execute(*self.statements)
+
+
+class Migration:
+    """A numbered schema change made of steps run in order"""
+
+    def __init__(self, version, name, *steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+    def __repr__(self):
+        return f"<Migration {self.version} {self.name}>"
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+MIGRATIONS = (
+    Migration("0001", "create account table", CreateTables("account")),
+    Migration(
+        "0002",
+        "add account search indexes",
+        CreateIndex("account", "ix_account_name"),
+        CreateIndex("account", "ix_account_name_lower"),
+        CreateIndex("account", "ix_account_email_lower"),
+    ),
+    Migration(
+        "0003",
+        "add account version",
+        AddColumn(
+            "account", db.Column("version", db.Integer, server_default="1")
+        ),
+        Backfill("account", "version = 1", "version IS NULL"),
+        SetNotNull("account", "version"),
+    ),
+    Migration("0004", "add outbox", CreateTables("outbox_event")),
+    Migration(
+        "0005",
+        "add account change feed",
+        AddColumn(
+            "account",
+            db.Column(
+                "updated_at", db.DateTime, server_default=transaction_time()
+            ),
+        ),
+        Backfill(
+            "account", {"updated_at": transaction_time()}, "updated_at IS NULL"
+        ),
+        SetNotNull("account", "updated_at"),
+        CreateIndex("account", "ix_account_updated_at_id"),
+        CreateTables("tombstone"),
+    ),
+    Migration("0006", "add idempotency keys", CreateTables("idempotency_key")),
+)
+
+
+######################################################################
+#  M I G R A T O R
+######################################################################
+class Migrator:  # pylint: disable=too-many-instance-attributes
+    """Applies the pending migrations to a database"""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        engine,
+        migrations=MIGRATIONS,
+        lock_timeout_ms=2000,
+        lock_retries=5,
+        retry_delay=1.0,
+        batch_size=1000,
+        batch_pause=0.0,
+        progress=None,
+    ):
+        versions = [migration.version for migration in migrations]
+        if versions != sorted(set(versions)):
+            raise MigrationError("Migration versions must increase")
+        self.engine = engine
+        self.dialect = engine.dialect
+        self.migrations = migrations
+        self.lock_timeout_ms = lock_timeout_ms
+        self.lock_retries = lock_retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.progress = progress
+
+    def report(self, message):
+        """Passes a progress message to the progress callback"""
+        if self.progress:
+            self.progress(message)
+
+    def applied(self):
+        """Returns {version: applied_at} for the migrations already run"""
+        metadata.create_all(self.engine)
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                db.select(
+                    schema_migration.c.version, schema_migration.c.applied_at
+                )
+            )
+            return dict(rows.all())
+
+    def pending(self, target=None):
+        """Returns the migrations still to run, up to target"""
+        if target is not None and target not in {
+            migration.version for migration in self.migrations
+        }:
+            raise MigrationError(f"Unknown migration version {target}")
+        applied = self.applied()
+        return [
+            migration
+            for migration in self.migrations
+            if migration.version not in applied
+            and (target is None or migration.version <= target)
+        ]
+
+    def migrate(self, target=None):
+        """Runs the pending migrations in order and returns them
+
+        The advisory lock is held by a session outside any transaction,
+        since CREATE INDEX CONCURRENTLY waits for every open transaction,
+        including its own migrator's, to finish.
+        """
+        with self.engine.connect() as lock:
+            lock = lock.execution_options(isolation_level="AUTOCOMMIT")
+            if self.dialect.name == "postgresql":
+                lock.execute(
+                    text("SELECT pg_advisory_lock(:key)"),
+                    {"key": ADVISORY_LOCK_KEY},
+                )
+            try:
+                migrations = self.pending(target)
+                for migration in migrations:
+                    self._apply(migration)
+            finally:
+                if self.dialect.name == "postgresql":
+                    lock.execute(
+                        text("SELECT pg_advisory_unlock(:key)"),
+                        {"key": ADVISORY_LOCK_KEY},
+                    )
+        return migrations
+
+    def _apply(self, migration):
+        """Runs the steps of migration and records it"""
+        self.report(f"Applying {migration.version} {migration.name}")
+        for step in migration.steps:
+            logger.info("Migration %s: %s", migration.version, step)
+            step.run(self)
+        with self.engine.begin() as conn:
+            conn.execute(
+                schema_migration.insert(),
+                {
+                    "version": migration.version,
+                    "name": migration.name,
+                    "applied_at": datetime.utcnow(),
+                },
+            )
+
+    def column(self, table, name):
+        """Returns the reflected column of table called name, or None"""
+        columns = inspect(self.engine).get_columns(table)
+        return next((col for col in columns if col["name"] == name), None)
+
+    def batches(self, table, where="1 = 1", key="id"):
+        """Yields (after, upto) key ranges holding batch_size matching rows
+
+        The caller processes the rows with after < key <= upto; the next
+        range is only looked up once it has, after a pause of batch_pause
+        seconds. Keys must be positive.
+        """
+        bound = text(
+            f"SELECT MAX({key}) FROM (SELECT {key} FROM {table} "
+            f"WHERE {key} > :after AND ({where}) "
+            f"ORDER BY {key} LIMIT :limit) AS batch"
+        )
+        after = 0
+        while True:
+            upto = self.guarded(
+                lambda conn, after=after: conn.execute(
+                    bound, {"after": after, "limit": self.batch_size}
+                ).scalar()
+            )
+            if upto is None:
+                return
+            yield after, upto
+            after = upto
+            time.sleep(self.batch_pause)
+
+    def execute(self, *statements):
+        """Runs statements in one transaction under lock_timeout"""
+
+        def work(conn):
+            for statement in statements:
+                conn.execute(text(statement))
+
+        self.guarded(work)
+
+    def guarded(self, work, autocommit=False):
+        """Calls work(conn) under lock_timeout, retrying when it expires
+
+        work runs in a transaction, or with autocommit for statements such
+        as CREATE INDEX CONCURRENTLY that cannot run in one. Each retry
+        waits twice as long as the one before.
+        """
+        attempt = 0
+        while True:
+            try:
+                if autocommit:
+                    return self._run_autocommit(work)
+                with self.engine.begin() as conn:
+                    self._set_timeouts(conn, "LOCAL")
+                    return work(conn)
+            except OperationalError as error:
+                if not _lock_timed_out(error) or attempt >= self.lock_retries:
+                    raise
+                delay = self.retry_delay * 2**attempt
+                attempt += 1
+                logger.warning(
+                    "Lock timeout, retry %d in %.1fs: %s",
+                    attempt,
+                    delay,
+                    error.statement,
+                )
+                time.sleep(delay)
+
+    def _run_autocommit(self, work):
+        """Calls work(conn) on an autocommit connection"""
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            self._set_timeouts(conn, "SESSION")
+            try:
+                return work(conn)
+            finally:
+                if self.dialect.name == "postgresql":
+                    conn.execute(text("RESET lock_timeout"))
+                    conn.execute(text("RESET statement_timeout"))
+
+    def _set_timeouts(self, conn, scope):
+        """Bounds lock waits and lifts the statement timeout on Postgres
+
+        Backfill batches and index builds may legitimately take longer
+        than the DB_STATEMENT_TIMEOUT_MS applied to the service.
+        """
+        if self.dialect.name != "postgresql":
+            return
+        conn.execute(
+            text(f"SET {scope} lock_timeout = {int(self.lock_timeout_ms)}")
+        )
+        conn.execute(text(f"SET {scope} statement_timeout = 0"))
+
+
+def make_migrator(app, progress=None):
+    """Builds a Migrator for the database of app from its configuration"""
+    config = app.config
+    return Migrator(
+        db.get_engine(app),
+        lock_timeout_ms=config.get("MIGRATION_LOCK_TIMEOUT_MS", 2000),
+        lock_retries=config.get("MIGRATION_LOCK_RETRIES", 5),
+        batch_size=config.get("MIGRATION_BATCH_SIZE", 1000),
+        batch_pause=config.get("MIGRATION_BATCH_PAUSE", 0.1),
+        progress=progress,
+    )
@@ -0,0 +1,151 @@
+"""
+Outbox Relay
+
+This module publishes the OutboxEvents written alongside every change to
+the accounts. The relay drains the outbox in batches and only deletes a
+batch once its sink has accepted it, so every event is delivered at least
+once. Consumers should de-duplicate on the event id.
+
+When a sink fails or pushes back, the relay stops reading and retries with
+an exponential backoff instead of piling up events in memory.
+"""
+
+import json
+import logging
+import queue
+import threading
+import urllib.request
+
+from service.models import OutboxEvent, db
+
+logger = logging.getLogger("flask.app")
+
+
+class SinkUnavailable(Exception):
+    """Raised by a sink that cannot accept events right now"""
+
+
+class FileSink:
+    """Appends events to a file as newline-delimited JSON"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, messages):
+        """Writes every message as one line and flushes the file"""
+        with open(self.path, "a", encoding="utf-8") as outfile:
+            for message in messages:
+                outfile.write(json.dumps(message) + "\n")
+            outfile.flush()
+
+
+class QueueSink:
+    """Puts events on a bounded in-process queue
+
+    Stands in for a message broker locally and in tests. A full queue
+    raises SinkUnavailable, which makes the relay back off.
+    """
+
+    def __init__(self, maxsize=10000, timeout=1.0):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.timeout = timeout
+
+    def send(self, messages):
+        """Queues every message, failing if the queue stays full"""
+        if self.queue.maxsize and (
+            self.queue.qsize() + len(messages) > self.queue.maxsize
+        ):
+            raise SinkUnavailable("queue is full")
+        for message in messages:
+            self.queue.put(message, timeout=self.timeout)
+
+
+class WebhookSink:
+    """POSTs each batch of events to a URL as a JSON array"""
+
+    def __init__(self, url, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, messages):
+        """Posts the batch, failing on any non-2xx response"""
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(messages).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+                if not 200 <= resp.status < 300:
+                    raise SinkUnavailable(f"webhook returned {resp.status}")
+        except OSError as error:
+            raise SinkUnavailable(f"webhook failed: {error}") from error
+
+
+def make_sink(spec):
+    """Builds a sink from file:<path>, queue[:<size>] or webhook:<url>"""
+    kind, _, target = spec.partition(":")
+    if kind == "file" and target:
+        return FileSink(target)
+    if kind == "queue":
+        return QueueSink(maxsize=int(target or 10000))
+    if kind == "webhook" and target:
+        return WebhookSink(target)
+    raise ValueError(f"Unknown OUTBOX_SINK: {spec}")
+
+
+class OutboxRelay:
+    """Moves events from the outbox table to a sink"""
+
+    def __init__(
+        self, sink, batch_size=500, poll_interval=1.0, max_backoff=30
+    ):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.delivered = 0
+
+    def drain_once(self):
+        """Publishes one batch of events and returns how many were sent
+
+        The batch is deleted in the same transaction that locked it, and
+        only after the sink accepted it.
+        """
+        events = OutboxEvent.next_batch(self.batch_size)
+        if not events:
+            db.session.commit()
+            return 0
+        try:
+            self.sink.send([event.to_message() for event in events])
+            for event in events:
+                db.session.delete(event)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.delivered += len(events)
+        return len(events)
+
+    def run(self, stop=None):
+        """Drains the outbox until stop is set, backing off on failures"""
+        stop = stop or threading.Event()
+        backoff = 0.0
+        while not stop.is_set():
+            try:
+                sent = self.drain_once()
+            except Exception as error:  # pylint: disable=broad-except
+                backoff = min(
+                    max(backoff * 2, self.poll_interval), self.max_backoff
+                )
+                logger.warning(
+                    "Outbox relay failed, retrying in %.1fs: %s",
+                    backoff,
+                    error,
+                )
+                stop.wait(backoff)
+                continue
+            backoff = 0.0
+            if sent < self.batch_size:
+                stop.wait(self.poll_interval)
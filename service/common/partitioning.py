@@ -0,0 +1,436 @@
+"""
+Account Partitioning
+
+This module partitions the account table natively in Postgres, by range
+of date_joined or by hash of id, and keeps a range layout's partitions
+ahead of the calendar.
+
+* Range partitions each hold a year or a month of date_joined, and a
+  DEFAULT partition catches anything outside them. Queries bounded on
+  date_joined, such as the joined_from and joined_before filters of the
+  account list, only read the partitions in range. Old partitions stop
+  changing, so vacuum and index maintenance stay on the recent ones.
+  Postgres requires the partition key in the primary key, which becomes
+  (id, date_joined); ids still come from a single sequence, but a lookup
+  by id alone now probes every partition.
+* Hash partitions spread the ids evenly over a fixed number of tables. A
+  lookup by id reads one partition and each partition is vacuumed on its
+  own, but a date range still reads them all.
+
+repartition() rebuilds the table in a new layout while the service keeps
+running. Rows are copied in batches into a new table, the changes made in
+the meantime are replayed from updated_at and the tombstones, and the two
+tables swap names in one short transaction that holds off writes, but not
+reads, while the last changes are replayed. Replays start from the
+horizon of Account.changes_horizon(), before every transaction still open,
+so changes committed during the copy are not missed. The old table is
+kept as account_previous until it is dropped. Changes that bypass the
+models, and so leave updated_at alone, are not replayed: run no data
+migrations while repartitioning.
+"""
+
+import logging
+from datetime import date, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from service.common.migrations import make_migrator
+from service.models import Account, Tombstone
+
+logger = logging.getLogger("flask.app")
+
+TABLE = Account.__tablename__
+NEW_TABLE = f"{TABLE}_repartition"
+OLD_TABLE = f"{TABLE}_previous"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+LAYOUTS = ("range", "hash", "none")
+INTERVALS = ("year", "month")
+
+# Partitioning strategies as pg_partitioned_table records them
+STRATEGIES = {"r": "range", "h": "hash", "l": "list"}
+
+
+class PartitioningError(Exception):
+    """Raised when the account table cannot be partitioned as asked"""
+
+
+######################################################################
+#  P A R T I T I O N   L A Y O U T S
+######################################################################
+def period_start(day, interval):
+    """Returns the first day of the year or month holding day"""
+    if interval == "year":
+        return day.replace(month=1, day=1)
+    return day.replace(day=1)
+
+
+def next_period(day, interval):
+    """Returns the first day of the year or month after the one of day"""
+    day = period_start(day, interval)
+    if interval == "year":
+        return day.replace(year=day.year + 1)
+    return (day + timedelta(days=31)).replace(day=1)
+
+
+def range_bounds(start, end, interval, table=TABLE):
+    """Returns (name, lower, upper) for each period from start to end
+
+    Partitions are named after their table and the period they hold, for
+    instance account_p2024 or account_p2024_05.
+    """
+    bounds = []
+    lower = period_start(start, interval)
+    while lower <= end:
+        upper = next_period(lower, interval)
+        suffix = f"{lower:%Y}" if interval == "year" else f"{lower:%Y_%m}"
+        bounds.append((f"{table}_p{suffix}", lower, upper))
+        lower = upper
+    return bounds
+
+
+def table_statements(layout, bounds=(), count=0, table=NEW_TABLE):
+    """Returns the DDL creating table like account, partitioned by layout
+
+    bounds are the range partitions, from range_bounds(), and count the
+    number of hash partitions.
+    """
+    clause = {
+        "range": " PARTITION BY RANGE (date_joined)",
+        "hash": " PARTITION BY HASH (id)",
+        "none": "",
+    }[layout]
+    statements = [
+        f"CREATE TABLE {table} (LIKE {TABLE} INCLUDING DEFAULTS "
+        f"INCLUDING CONSTRAINTS){clause}"
+    ]
+    if layout == "range":
+        statements.extend(
+            f"CREATE TABLE {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+            for name, lower, upper in bounds
+        )
+        statements.append(
+            f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"
+        )
+    elif layout == "hash":
+        statements.extend(
+            f"CREATE TABLE {table}_h{remainder} PARTITION OF {table} "
+            f"FOR VALUES WITH (MODULUS {count}, REMAINDER {remainder})"
+            for remainder in range(count)
+        )
+    return statements
+
+
+def index_statements(layout, table=NEW_TABLE):
+    """Returns the DDL adding the keys and indexes of Account to table
+
+    The indexes get a _new suffix until the table takes over the name of
+    account.
+    """
+    key = "id, date_joined" if layout == "range" else "id"
+    statements = [
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({key})"
+    ]
+    for index in sorted(Account.__table__.indexes, key=lambda i: i.name):
+        ddl = str(CreateIndex(index).compile(dialect=postgresql.dialect()))
+        statements.append(
+            ddl.replace(
+                f" {index.name} ON {TABLE} ",
+                f" {index.name}_new ON {table} ",
+                1,
+            )
+        )
+    return statements
+
+
+######################################################################
+#  P A R T I T I O N E R
+######################################################################
+class Partitioner:
+    """Partitions the account table and maintains its partitions
+
+    Every statement runs through migrator, under its lock_timeout and
+    retries, and copies go in its batches.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, migrator, interval="year", count=8, premake=2, today=date.today
+    ):
+        if migrator.dialect.name != "postgresql":
+            raise PartitioningError("Partitioning needs PostgreSQL")
+        if interval not in INTERVALS:
+            raise PartitioningError(f"Unknown interval {interval}")
+        self.migrator = migrator
+        self.interval = interval
+        self.count = count
+        self.premake = premake
+        self.today = today
+
+    def _scalar(self, statement, **params):
+        """Returns the first column of the first row of a query"""
+        return self.migrator.guarded(
+            lambda conn: conn.execute(text(statement), params).scalar()
+        )
+
+    def layout(self):
+        """Returns how the account table is partitioned, or none"""
+        strategy = self._scalar(
+            "SELECT partstrat FROM pg_partitioned_table "
+            "WHERE partrelid = to_regclass(:table)",
+            table=TABLE,
+        )
+        return STRATEGIES.get(strategy, "none")
+
+    def partitions(self, table=TABLE):
+        """Returns (name, bound, estimated rows) for each partition"""
+        return self.migrator.guarded(
+            lambda conn: conn.execute(
+                text(
+                    "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), "
+                    "c.reltuples::bigint FROM pg_inherits i "
+                    "JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = to_regclass(:table) "
+                    "ORDER BY c.relname"
+                ),
+                {"table": table},
+            ).all()
+        )
+
+    def _exists(self, table):
+        """True when a table called table exists"""
+        return self._scalar("SELECT to_regclass(:table)", table=table)
+
+    def _horizon(self, interval):
+        """Returns the last day the premade range partitions must hold"""
+        end = self.today()
+        for _ in range(self.premake):
+            end = next_period(end, interval)
+        return end
+
+    def repartition(self, layout):
+        """Rebuilds the account table partitioned by layout, online"""
+        if layout not in LAYOUTS:
+            raise PartitioningError(f"Unknown layout {layout}")
+        if layout == "hash" and self.count < 2:
+            raise PartitioningError("Hash partitioning needs 2 partitions")
+        if self.migrator.pending():
+            raise PartitioningError("Apply the pending migrations first")
+        if self._exists(OLD_TABLE):
+            raise PartitioningError(f"Drop {OLD_TABLE} first")
+        started = self.migrator.guarded(Account.changes_horizon)
+        self.migrator.execute(f"DROP TABLE IF EXISTS {NEW_TABLE}")
+
+        bounds = ()
+        if layout == "range":
+            first = self._scalar(f"SELECT MIN(date_joined) FROM {TABLE}")
+            bounds = range_bounds(
+                first or self.today(),
+                self._horizon(self.interval),
+                self.interval,
+                table=NEW_TABLE,
+            )
+        self.migrator.execute(*table_statements(layout, bounds, self.count))
+        self._copy()
+        self.migrator.report("Building indexes")
+        self.migrator.execute(*index_statements(layout))
+
+        caught_up = self.migrator.guarded(Account.changes_horizon)
+        replayed = self.migrator.guarded(
+            lambda conn: self._replay(conn, started)
+        )
+        self.migrator.report(f"Replayed {replayed} changed accounts")
+        renames = self._renames(
+            TABLE, OLD_TABLE, "", "_previous"
+        ) + self._renames(NEW_TABLE, TABLE, "_new", "")
+        self.migrator.guarded(
+            lambda conn: self._swap(conn, caught_up, renames)
+        )
+        self.migrator.execute(f"ANALYZE {TABLE}")
+        logger.info("Repartitioned %s by %s", TABLE, layout)
+
+    def _copy(self):
+        """Copies the rows of account into the new table in batches"""
+        insert = text(
+            f"INSERT INTO {NEW_TABLE} SELECT * FROM {TABLE} "
+            "WHERE id > :after AND id <= :upto"
+        )
+        total = 0
+        for after, upto in self.migrator.batches(TABLE):
+            total += self.migrator.guarded(
+                lambda conn, after=after, upto=upto: conn.execute(
+                    insert, {"after": after, "upto": upto}
+                ).rowcount
+            )
+            self.migrator.report(f"Copied {total} accounts")
+
+    @staticmethod
+    def _replay(conn, since):
+        """Copies the accounts changed or deleted since, again"""
+        changed = (
+            conn.execute(
+                text(f"SELECT id FROM {TABLE} WHERE updated_at >= :since"),
+                {"since": since},
+            )
+            .scalars()
+            .all()
+        )
+        deleted = (
+            conn.execute(
+                text(
+                    f"SELECT record_id FROM {Tombstone.__tablename__} "
+                    "WHERE aggregate = :aggregate AND deleted_at >= :since"
+                ),
+                {"aggregate": TABLE, "since": since},
+            )
+            .scalars()
+            .all()
+        )
+        ids = sorted(set(changed) | set(deleted))
+        if ids:
+            params = {"ids": ids}
+            conn.execute(
+                text(f"DELETE FROM {NEW_TABLE} WHERE id = ANY(:ids)"), params
+            )
+            conn.execute(
+                text(
+                    f"INSERT INTO {NEW_TABLE} SELECT * FROM {TABLE} "
+                    "WHERE id = ANY(:ids)"
+                ),
+                params,
+            )
+        return len(ids)
+
+    def _swap(self, conn, since, renames):
+        """Replays the last changes and puts the new table in place
+
+        EXCLUSIVE mode holds off writes to account while reads go on,
+        until the renames take their brief exclusive lock at the end.
+        """
+        conn.execute(text(f"LOCK TABLE {TABLE} IN EXCLUSIVE MODE"))
+        self._replay(conn, since)
+        sequence = conn.execute(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"),
+            {"table": TABLE},
+        ).scalar()
+        for statement in renames:
+            conn.execute(text(statement))
+        if sequence:
+            conn.execute(
+                text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id")
+            )
+
+    def _renames(self, table, to, suffix, new_suffix):
+        """Returns the statements renaming table to to
+
+        Partitions keep what follows the table name in theirs, the primary
+        key follows the table, and the Account indexes trade suffix for
+        new_suffix.
+        """
+        statements = [
+            f"ALTER TABLE {name} RENAME TO {to}{name[len(table):]}"
+            for name, _, _ in self.partitions(table)
+        ]
+        statements.append(f"ALTER TABLE {table} RENAME TO {to}")
+        statements.append(
+            f"ALTER TABLE {to} RENAME CONSTRAINT {table}_pkey TO {to}_pkey"
+        )
+        statements.extend(
+            f"ALTER INDEX IF EXISTS {index.name}{suffix} "
+            f"RENAME TO {index.name}{new_suffix}"
+            for index in Account.__table__.indexes
+        )
+        return statements
+
+    def drop_previous(self):
+        """Drops the table left behind by repartition()"""
+        self.migrator.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+
+    def maintain(self):
+        """Creates the range partitions up to premake periods ahead
+
+        Accounts already in the DEFAULT partition for a new period are
+        moved into it. Returns the names of the partitions created.
+        """
+        if self.layout() != "range":
+            return []
+        existing = {name for name, _, _ in self.partitions()}
+        interval = self._interval(existing)
+        created = []
+        for name, lower, upper in range_bounds(
+            self.today(), self._horizon(interval), interval
+        ):
+            if name in existing:
+                continue
+            moved = self.migrator.guarded(
+                lambda conn, n=name, lo=lower, up=upper: self._add_partition(
+                    conn, n, lo, up, DEFAULT_PARTITION in existing
+                )
+            )
+            self.migrator.report(f"Created {name}, moved {moved} accounts")
+            created.append(name)
+        return created
+
+    def _interval(self, existing):
+        """Returns the interval of the existing range partitions"""
+        for name in existing:
+            suffix = name.replace(f"{TABLE}_p", "", 1)
+            if suffix.isdigit():
+                return "year"
+            if suffix.replace("_", "").isdigit():
+                return "month"
+        return self.interval
+
+    @staticmethod
+    def _add_partition(  # pylint: disable=too-many-arguments
+        conn, name, lower, upper, has_default
+    ):
+        """Creates one range partition, returning the accounts moved in"""
+        bound = f"FOR VALUES FROM ('{lower}') TO ('{upper}')"
+        params = {"lower": lower, "upper": upper}
+        in_range = "date_joined >= :lower AND date_joined < :upper"
+        moved = 0
+        if has_default:
+            moved = conn.execute(
+                text(
+                    f"SELECT COUNT(*) FROM {DEFAULT_PARTITION} "
+                    f"WHERE {in_range}"
+                ),
+                params,
+            ).scalar()
+        if not moved:
+            conn.execute(
+                text(f"CREATE TABLE {name} PARTITION OF {TABLE} {bound}")
+            )
+            return 0
+        conn.execute(
+            text(
+                f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS "
+                "INCLUDING CONSTRAINTS)"
+            )
+        )
+        conn.execute(
+            text(
+                f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                f"WHERE {in_range} RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"
+            ),
+            params,
+        )
+        conn.execute(
+            text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} {bound}")
+        )
+        return moved
+
+
+def make_partitioner(app, progress=None, interval=None, count=None):
+    """Builds a Partitioner for the database of app from its configuration"""
+    config = app.config
+    return Partitioner(
+        make_migrator(app, progress=progress),
+        interval=interval or config.get("ACCOUNT_PARTITION_INTERVAL", "year"),
+        count=count or config.get("ACCOUNT_PARTITION_COUNT", 8),
+        premake=config.get("ACCOUNT_PARTITION_PREMAKE", 2),
+    )
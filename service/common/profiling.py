@@ -0,0 +1,201 @@
+"""
+SQL Profiling
+
+This module records the SQL statements a block of code issues: how many,
+how long they took and which statements repeat. Repeating the same
+statement many times in one request is the signature of an N+1 query
+pattern, where a loop loads related rows one at a time.
+
+With SQL_PROFILING set, every request is profiled. Its totals go out in a
+Server-Timing header, which browser developer tools and most tracing
+proxies display, and statements repeated SQL_PROFILE_REPEAT_THRESHOLD
+times or more are logged as warnings. Profiling costs a little on every
+statement, so it is off by default.
+
+Tests use query_budget() to hold routes to a number of queries:
+
+    with query_budget(max_queries=1):
+        client.get("/accounts/1")
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+_PARAMETERS = re.compile(r"%\(\w+\)s|%s|\?")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\?(?:, \?)+\)")
+
+
+def normalize_sql(statement):
+    """Returns statement with its values replaced by placeholders
+
+    Statements that differ only in their parameters, literals or the
+    length of an IN list normalize to the same text.
+    """
+    sql = " ".join(statement.split())
+    sql = _PARAMETERS.sub("?", sql)
+    sql = _LITERALS.sub("?", sql)
+    return _LISTS.sub("(?, ...)", sql)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised by query_budget() when a block issues too many queries"""
+
+
+class QueryProfile:
+    """The statements a block of code sent to the database"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.durations = Counter()
+
+    def record(self, statement, seconds):
+        """Counts one execution of statement that took seconds"""
+        sql = normalize_sql(statement)
+        self.count += 1
+        self.seconds += seconds
+        self.statements[sql] += 1
+        self.durations[sql] += seconds
+
+    def repeated(self, threshold):
+        """Returns (count, sql) of statements run threshold times or more"""
+        return [
+            (count, sql)
+            for sql, count in self.statements.most_common()
+            if count >= threshold
+        ]
+
+    def report(self):
+        """Returns the statements, most frequent first, one per line"""
+        return "\n".join(
+            f"{count:>4} x {self.durations[sql] * 1000:8.3f} ms  {sql}"
+            for sql, count in self.statements.most_common()
+        )
+
+    def server_timing(self):
+        """Returns the Server-Timing entry for the database time"""
+        return f'db;desc="{self.count} queries";dur={self.seconds * 1000:.3f}'
+
+
+# The profiles recording in each thread, innermost last
+_active = threading.local()
+
+
+def _profiles():
+    if not hasattr(_active, "profiles"):
+        _active.profiles = []
+    return _active.profiles
+
+
+@contextmanager
+def profiling():
+    """Records the statements the block issues in a QueryProfile"""
+    profile = QueryProfile()
+    profiles = _profiles()
+    profiles.append(profile)
+    try:
+        yield profile
+    finally:
+        profiles.remove(profile)
+
+
+@contextmanager
+def query_budget(max_queries=None, max_repeats=None):
+    """Fails when the block issues more queries than budgeted
+
+    max_queries caps the statements in total and max_repeats how often any
+    one normalized statement may run. Raises QueryBudgetExceeded, an
+    AssertionError, listing what ran.
+    """
+    with profiling() as profile:
+        yield profile
+    problems = []
+    if max_queries is not None and profile.count > max_queries:
+        problems.append(f"{profile.count} queries, budget {max_queries}")
+    if max_repeats is not None:
+        for count, sql in profile.repeated(max_repeats + 1):
+            problems.append(f"{count} runs, budget {max_repeats}: {sql}")
+    if problems:
+        raise QueryBudgetExceeded(
+            "; ".join(problems) + "\n" + profile.report()
+        )
+
+
+def init_profiling(app):
+    """Profiles every request when SQL_PROFILING is set"""
+    if not app.config.get("SQL_PROFILING", False):
+        return
+    threshold = app.config.get("SQL_PROFILE_REPEAT_THRESHOLD", 5)
+
+    @app.before_request
+    def start_profile():
+        g.sql_profile = QueryProfile()
+        g.sql_profile_start = time.perf_counter()
+        _profiles().append(g.sql_profile)
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.get("sql_profile")
+        if profile is None:
+            return response
+        elapsed = time.perf_counter() - g.sql_profile_start
+        response.headers.add(
+            "Server-Timing",
+            f"{profile.server_timing()}, app;dur={elapsed * 1000:.3f}",
+        )
+        for count, sql in profile.repeated(threshold):
+            logger.warning(
+                "Possible N+1 in %s %s: %d runs of %s",
+                request.method,
+                request.path,
+                count,
+                sql,
+            )
+        return response
+
+    @app.teardown_request
+    def stop_profile(_):
+        profile = g.pop("sql_profile", None)
+        if profile is not None and profile in _profiles():
+            _profiles().remove(profile)
+
+
+######################################################################
+#  S Q L A L C H E M Y   E V E N T S
+######################################################################
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, *_):
+    if _profiles():
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, _cursor, statement, *_):
+    starts = conn.info.get("profile_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    for profile in _profiles():
+        profile.record(statement, elapsed)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("profile_start")
+        if starts:
+            starts.pop()
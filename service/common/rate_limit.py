@@ -0,0 +1,248 @@
+"""
+Rate Limiting and Load Shedding
+
+This module turns requests away before they reach a view, so a rejected
+request never opens a session or touches the database.
+
+Every client gets a token bucket per endpoint. A request takes a token,
+and a client whose bucket is empty gets 429 Too Many Requests with a
+Retry-After telling it when the next token arrives. Buckets live in this
+process by default, which gives a client the limit once per worker, or in
+Redis so the whole service enforces a single limit. Clients are told apart
+by address unless RATE_LIMIT_CLIENT_HEADER names a header that a gateway
+in front has authenticated; a header the client picks itself would let it
+escape its bucket by changing the value.
+
+Independently of any client, the worker sheds load with 503 Service
+Unavailable while it is overloaded: when requests have queued longer than
+SHED_QUEUE_TIME_MS in front of it, or when checkouts from the connection
+pool have lately waited longer than SHED_POOL_WAIT_MS. Endpoints in
+RATE_LIMIT_EXEMPT, such as the health check, are never turned away.
+"""
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+from service.common import status
+from service.common.clients import client_key
+from service.common.db_pool import pool_stats
+from service.common.metrics import REQUESTS_REJECTED
+
+logger = logging.getLogger("flask.app")
+
+# How long a slow pool checkout keeps the worker shedding, in seconds
+POOL_WAIT_WINDOW = 1.0
+
+# Keeps a bucket in Redis, refilling and taking a token atomically
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "at")
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class MemoryBucketStore:
+    """Token buckets kept in this process, bounded by bucket count
+
+    The least recently used bucket is dropped once ``max_keys`` is
+    reached; a dropped bucket comes back full.
+    """
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token, returning 0 or the seconds until one is free"""
+        with self._lock:
+            now = self._clock()
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+
+class SharedBucketStore:
+    """Token buckets kept in Redis and shared by every replica
+
+    Takes a Redis-like client offering ``eval``. Errors reaching the store
+    let the request through, so an outage of Redis does not take the
+    service down with it.
+    """
+
+    def __init__(self, client, prefix="ratelimit:", clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self._clock = clock
+
+    def take(self, key, rate, burst):
+        """Takes a token, returning 0 or the seconds until one is free"""
+        try:
+            return float(
+                self.client.eval(
+                    TOKEN_BUCKET_SCRIPT,
+                    1,
+                    f"{self.prefix}{key}",
+                    rate,
+                    burst,
+                    self._clock(),
+                )
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Rate limit store unavailable: %s", error)
+            return 0.0
+
+
+def make_bucket_store(config):
+    """Returns the bucket store selected by RATE_LIMIT_BACKEND"""
+    backend = config.get("RATE_LIMIT_BACKEND", "memory")
+    if backend == "memory":
+        return MemoryBucketStore(config.get("RATE_LIMIT_MAX_KEYS", 100000))
+    if backend == "redis":
+        import redis  # pylint: disable=import-outside-toplevel
+
+        client = redis.Redis.from_url(config["RATE_LIMIT_REDIS_URL"])
+        return SharedBucketStore(client)
+    raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+
+def parse_limits(spec):
+    """Parses 'endpoint=rate:burst,...' into {endpoint: (rate, burst)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        endpoint, _, limit = item.partition("=")
+        rate, _, burst = limit.partition(":")
+        limits[endpoint.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+def queue_time(header, now):
+    """Returns the seconds a request queued, from X-Request-Start
+
+    Proxies send the time the request arrived as ``t=<time>`` in seconds,
+    milliseconds or microseconds since the epoch. Returns 0 when the
+    header is missing or cannot be read.
+    """
+    if not header:
+        return 0.0
+    try:
+        started = float(header.strip().lstrip("t="))
+    except ValueError:
+        return 0.0
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, now - started)
+
+
+class RateLimiter:
+    """Decides whether the current request may proceed"""
+
+    def __init__(self, store, config, clock=time.time):
+        self.store = store
+        self.enabled = config.get("RATE_LIMIT_ENABLED", False)
+        self.default_limit = (
+            config.get("RATE_LIMIT_RATE", 50.0),
+            config.get("RATE_LIMIT_BURST", 100.0),
+        )
+        self.limits = parse_limits(config.get("RATE_LIMIT_OVERRIDES", ""))
+        self.exempt = set(
+            name.strip()
+            for name in config.get("RATE_LIMIT_EXEMPT", "").split(",")
+        )
+        self.client_header = config.get("RATE_LIMIT_CLIENT_HEADER")
+        self.proxy_hops = config.get("RATE_LIMIT_PROXY_HOPS", 0)
+        self.queue_limit = config.get("SHED_QUEUE_TIME_MS", 0) / 1000
+        self.pool_wait_limit = config.get("SHED_POOL_WAIT_MS", 0) / 1000
+        self._clock = clock
+
+    def check(self):
+        """Returns a 429 or 503 response, or None to let the request in"""
+        endpoint = request.endpoint or "unmatched"
+        if endpoint in self.exempt:
+            return None
+
+        if self.queue_limit and (
+            queue_time(request.headers.get("X-Request-Start"), self._clock())
+            > self.queue_limit
+        ):
+            return _reject("queue_time", status.HTTP_503_SERVICE_UNAVAILABLE)
+        if self.pool_wait_limit and (
+            pool_stats.recent_wait(POOL_WAIT_WINDOW) > self.pool_wait_limit
+        ):
+            return _reject(
+                "pool_wait",
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                POOL_WAIT_WINDOW,
+            )
+
+        if self.enabled:
+            rate, burst = self.limits.get(endpoint, self.default_limit)
+            retry_after = self.store.take(
+                f"{self.client_key()}:{endpoint}", rate, burst
+            )
+            if retry_after:
+                return _reject(
+                    "rate_limited",
+                    status.HTTP_429_TOO_MANY_REQUESTS,
+                    retry_after,
+                )
+        return None
+
+    def client_key(self):
+        """Returns what identifies the client making the request"""
+        return client_key(self.client_header, self.proxy_hops)
+
+
+def _reject(reason, status_code, retry_after=1.0):
+    """Returns the response turning a request away"""
+    REQUESTS_REJECTED.labels(reason).inc()
+    if status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+        error, message = "Too Many Requests", "Rate limit exceeded"
+    else:
+        error, message = "Service Unavailable", "Server is overloaded"
+    response = jsonify(status=status_code, error=error, message=message)
+    response.status_code = status_code
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def init_rate_limit(app):
+    """Checks every request against the rate limits and load"""
+    limiter = RateLimiter(make_bucket_store(app.config), app.config)
+    if limiter.enabled and app.config.get("RATE_LIMIT_BACKEND") == "memory":
+        logger.warning(
+            "Rate limit buckets are kept per worker: each client gets the "
+            "limit once per worker of every replica"
+        )
+    app.extensions["rate_limiter"] = limiter
+    app.before_request(limiter.check)
@@ -0,0 +1,206 @@
+"""
+Read Replicas
+
+This module sends the reads of the persistence layer to read replicas and
+everything else to the primary. Queries opt in by carrying the ``replica``
+execution option; the models add it to their read-only lookups.
+
+Replicas lag behind the primary, so a client must not read from them
+right after it wrote. A session goes to the primary for good once it has
+flushed a change, and the client that made the change keeps reading from
+the primary for REPLICA_STICKY_SECONDS. The sticky clients are remembered
+in this worker, or in Redis when CACHE_BACKEND is redis so every worker
+and replica of the service sees them.
+
+A replica that fails with a connection error is taken out of rotation for
+REPLICA_RETRY_SECONDS. When no replica is healthy, reads go to the primary.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+from flask import has_request_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+
+from service.common.cache import LRUCache, make_cache
+from service.common.clients import client_key
+from service.common.db_pool import PoolStats, engine_options
+
+logger = logging.getLogger("flask.app")
+
+STRATEGIES = ("round_robin", "least_loaded")
+
+
+class ReplicaRouter:
+    """Picks a healthy replica engine for each read"""
+
+    def __init__(
+        self,
+        engines,
+        strategy="round_robin",
+        retry_after=30.0,
+        sticky=None,
+        client_header=None,
+        proxy_hops=0,
+        clock=time.monotonic,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown REPLICA_STRATEGY: {strategy}")
+        self.engines = list(engines)
+        self.strategy = strategy
+        self.retry_after = retry_after
+        self.sticky = sticky or LRUCache(ttl=5.0)
+        self.client_header = client_header
+        self.proxy_hops = proxy_hops
+        self.failures = 0
+        self._clock = clock
+        self._down_until = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._on_error)
+
+    def pick(self):
+        """Returns the engine for the next read, or None for the primary"""
+        now = self._clock()
+        with self._lock:
+            healthy = [
+                engine
+                for engine in self.engines
+                if self._down_until.get(engine, 0) <= now
+            ]
+        if not healthy:
+            return None
+        if self.strategy == "least_loaded":
+            return min(healthy, key=_checked_out)
+        return healthy[next(self._turn) % len(healthy)]
+
+    def mark_down(self, engine):
+        """Takes a replica out of rotation for retry_after seconds"""
+        logger.warning("Replica %s is down", engine.url)
+        with self._lock:
+            self._down_until[engine] = self._clock() + self.retry_after
+            self.failures += 1
+
+    def stick(self):
+        """Keeps the client of this request on the primary for a while"""
+        if has_request_context():
+            self.sticky.set(self._client(), True)
+
+    def is_sticky(self):
+        """True when the client of this request wrote recently"""
+        if not has_request_context():
+            return False
+        return self.sticky.get(self._client()) is not None
+
+    def _client(self):
+        """Returns the key of the client of this request"""
+        return client_key(self.client_header, self.proxy_hops)
+
+    def dispose(self, close=True):
+        """Drops the pooled connections of every replica"""
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+    def _on_error(self, context):
+        """Marks a replica down when it cannot be reached
+
+        Only failed connects and dropped connections count; a statement
+        that failed on a live replica does not take it out of rotation.
+        """
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+
+def _checked_out(engine):
+    """Returns the connections an engine's pool has handed out"""
+    checkedout = getattr(engine.pool, "checkedout", None)
+    return checkedout() if checkedout else 0
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads marked for replicas to the replica router"""
+
+    def get_bind(self, mapper=None, clause=None):
+        router = self.app.extensions.get("replicas")
+        if (
+            router is not None
+            and clause is not None
+            and clause._execution_options.get("replica")
+            and not self.pinned()
+        ):
+            engine = router.pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def pinned(self):
+        """True when the reads of this session must see the latest writes
+
+        That is once the session wrote, or while its client is sticky.
+        Such reads go to the primary and must not be served from caches.
+        """
+        if self.info.get("primary"):
+            return True
+        router = self.app.extensions.get("replicas")
+        if router is None:
+            return False
+        if "sticky" not in self.info:
+            self.info["sticky"] = router.is_sticky()
+        return self.info["sticky"]
+
+    def reads_primary(self):
+        """True when reads marked for replicas go to the primary anyway"""
+        return self.pinned() or self.app.extensions.get("replicas") is None
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _after_flush(session, *_):
+    """Sends every later read of a session that wrote to the primary"""
+    if not session.info.get("primary"):
+        session.info["primary"] = True
+        router = session.app.extensions.get("replicas")
+        if router is not None:
+            router.stick()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions route reads to replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def make_router(config):
+    """Returns the router for REPLICA_URIS, or None when there are none"""
+    uris = [uri.strip() for uri in config.get("REPLICA_URIS", "").split(",")]
+    uris = [uri for uri in uris if uri]
+    if not uris:
+        return None
+    engines = [
+        create_engine(
+            uri,
+            **engine_options(
+                {**config, "SQLALCHEMY_DATABASE_URI": uri}, PoolStats()
+            ),
+        )
+        for uri in uris
+    ]
+    sticky_seconds = config.get("REPLICA_STICKY_SECONDS", 5.0)
+    if config.get("CACHE_BACKEND") == "redis":
+        sticky = make_cache(
+            {**config, "CACHE_TTL": sticky_seconds}, prefix="sticky:"
+        )
+    else:
+        sticky = LRUCache(ttl=sticky_seconds)
+    return ReplicaRouter(
+        engines,
+        strategy=config.get("REPLICA_STRATEGY", "round_robin"),
+        retry_after=config.get("REPLICA_RETRY_SECONDS", 30.0),
+        sticky=sticky,
+        client_header=config.get("RATE_LIMIT_CLIENT_HEADER"),
+        proxy_hops=config.get("RATE_LIMIT_PROXY_HOPS", 0),
+    )
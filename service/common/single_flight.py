@@ -0,0 +1,86 @@
+"""
+Single Flight
+
+This module collapses concurrent identical lookups into one. The first
+caller for a key runs the lookup while later callers for the same key wait
+for it and share its result, so a burst of requests for one hot record
+costs a single query. Coalescing only spans lookups that overlap in time
+within one worker process; nothing is remembered once the lookup returns.
+
+Results are handed to every waiting thread, so lookups must return values
+that are safe to share, never objects bound to a session.
+"""
+
+import threading
+
+
+class NullFlight:
+    """Runs every lookup itself, used when coalescing is disabled"""
+
+    def do(self, key, func):  # pylint: disable=unused-argument
+        """Returns func()"""
+        return func()
+
+    def stats(self):
+        """Returns empty counters"""
+        return {"leaders": 0, "followers": 0}
+
+
+class _Call:
+    """A lookup in flight and the result its followers wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Shares the result of a lookup with concurrent callers of its key"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, func):
+        """Returns func(), or the result of the call already running"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """Returns how many lookups ran and how many shared a result"""
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers}
+
+
+def make_flight(config):
+    """Returns the single flight configured by SINGLE_FLIGHT_ENABLED"""
+    if config.get("SINGLE_FLIGHT_ENABLED", True):
+        return SingleFlight()
+    return NullFlight()
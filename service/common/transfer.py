@@ -0,0 +1,432 @@
+"""
+Account Transfer
+
+This module moves Accounts in and out of the database as NDJSON or CSV for
+the accounts-export and accounts-import commands. Both directions stream:
+exports read through a server-side cursor one batch at a time and imports
+insert one chunk per transaction, so memory stays bounded however many
+Accounts are moved.
+
+A checkpoint file records how far a run got after every batch, so an
+interrupted run picks up where it stopped instead of starting over.
+"""
+
+import csv
+import io
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from service.common.json_provider import get_provider
+from service.models import Account, DataValidationError, db, transaction_time
+
+FORMATS = ("ndjson", "csv")
+
+# Invalid records reported in detail; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+
+def format_for(path, fmt=None):
+    """Returns fmt, or the format implied by the extension of path"""
+    if fmt:
+        return fmt
+    return "csv" if str(path).lower().endswith(".csv") else "ndjson"
+
+
+class Checkpoint:
+    """Remembers the position of a run in a small JSON file
+
+    An export also records the byte offset of its output file at that
+    position, and an import the ranges of records after it that other
+    workers had already committed. Without a path it only keeps them in
+    memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.position = 0
+        self.offset = None
+        self.done = []
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as infile:
+                state = json.load(infile)
+            self.position = state["position"]
+            self.offset = state.get("offset")
+            self.done = [tuple(span) for span in state.get("done", [])]
+
+    def save(self, position, offset=None, done=()):
+        """Records position, replacing the file atomically"""
+        self.position = position
+        self.offset = offset
+        self.done = [span for span in done if span[1] > position]
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as outfile:
+            json.dump(
+                {
+                    "position": position,
+                    "offset": offset,
+                    "done": self.done,
+                },
+                outfile,
+            )
+        os.replace(temp_path, self.path)
+
+    def skips(self, number):
+        """Tells whether record number was committed by an earlier run"""
+        return number <= self.position or any(
+            first <= number <= last for first, last in self.done
+        )
+
+    def clear(self):
+        """Removes the checkpoint file once a run has completed"""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportResult:
+    """Counts of an import, with details of the first invalid records"""
+
+    def __init__(self):
+        self.imported = 0
+        self.skipped = 0
+        self.errors = []
+
+    def reject(self, number, message):
+        """Records that record number was skipped"""
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"record {number}: {message}")
+
+
+######################################################################
+#  E X P O R T
+######################################################################
+
+
+def export_accounts(
+    outfile,
+    fmt,
+    batch_size=1000,
+    checkpoint=None,
+    id_range=(None, None),
+    header=True,
+    progress=None,
+):
+    """Writes Accounts to outfile in id order and returns how many
+
+    The checkpoint position is the last id written, so a resumed export
+    appends to the same file. Rows written after the last checkpoint
+    by a run that failed are cut off first, by truncating outfile to the
+    recorded offset. id_range bounds the ids exported as (after, up_to);
+    either end may be None.
+    """
+    checkpoint = checkpoint or Checkpoint()
+    if checkpoint.offset is not None:
+        outfile.truncate(checkpoint.offset)
+    after, up_to = id_range
+    after = max(after or 0, checkpoint.position) or None
+    query = Account.column_query()
+    if up_to is not None:
+        query = query.filter(Account.id <= up_to)
+    write = _row_writer(outfile, fmt, header and not checkpoint.position)
+
+    count = 0
+    batch = []
+    for row in Account.stream(after=after, batch_size=batch_size, query=query):
+        batch.append(row)
+        if len(batch) == batch_size:
+            count += _write_batch(write, outfile, batch, checkpoint)
+            if progress:
+                progress(count)
+            batch = []
+    if batch:
+        count += _write_batch(write, outfile, batch, checkpoint)
+        if progress:
+            progress(count)
+    return count
+
+
+def export_parallel(path, fmt, workers, batch_size=1000, progress=None):
+    """Exports Accounts to path with workers splitting the id range
+
+    Each worker streams its own slice of ids into a part file and the
+    parts are then joined in id order. Returns how many were written.
+    """
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    low, high = db.session.query(
+        db.func.min(Account.id), db.func.max(Account.id)
+    ).one()
+    if low is None:
+        with open(path, "w", encoding="utf-8", newline="") as outfile:
+            _row_writer(outfile, fmt, header=True)
+        return 0
+    span = -(-(high - low + 1) // workers)
+    ranges = [
+        (low - 1 + part * span, min(low - 1 + (part + 1) * span, high))
+        for part in range(workers)
+    ]
+    parts = [f"{path}.part{part}" for part in range(workers)]
+    totals = [0] * workers
+
+    def report(part):
+        def update(count):
+            totals[part] = count
+            if progress:
+                progress(sum(totals))
+
+        return update
+
+    def export_part(part):
+        with app.app_context():
+            try:
+                with open(
+                    parts[part], "w", encoding="utf-8", newline=""
+                ) as outfile:
+                    return export_accounts(
+                        outfile,
+                        fmt,
+                        batch_size=batch_size,
+                        id_range=ranges[part],
+                        header=part == 0,
+                        progress=report(part),
+                    )
+            finally:
+                db.session.remove()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            count = sum(executor.map(export_part, range(workers)))
+        with open(path, "wb") as outfile:
+            for part_path in parts:
+                with open(part_path, "rb") as infile:
+                    shutil.copyfileobj(infile, outfile)
+    finally:
+        for part_path in parts:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    return count
+
+
+def _row_writer(outfile, fmt, header):
+    """Returns a function writing one column_query() row to outfile"""
+    if fmt == "csv":
+        writer = csv.writer(outfile)
+        if header:
+            writer.writerow(Account.SERIALIZED_FIELDS)
+        return writer.writerow
+    dumps = get_provider().dumps
+
+    def write_ndjson(row):
+        outfile.write(dumps(Account.serialize_row(row)) + "\n")
+
+    return write_ndjson
+
+
+def _write_batch(write, outfile, batch, checkpoint):
+    """Writes a batch of rows, flushes them and moves the checkpoint"""
+    for row in batch:
+        write(row)
+    outfile.flush()
+    checkpoint.save(batch[-1].id, outfile.tell() if checkpoint.path else None)
+    return len(batch)
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+
+
+def import_accounts(
+    infile,
+    fmt,
+    chunk_size=1000,
+    workers=1,
+    checkpoint=None,
+    keep_ids=False,
+    use_copy=True,
+    progress=None,
+):
+    """Inserts the Accounts read from infile and returns an ImportResult
+
+    Every record is validated with Account.deserialize() and invalid ones
+    are skipped. Each chunk is inserted in its own transaction, with COPY
+    on Postgres and an executemany INSERT elsewhere. With several workers
+    the chunks are inserted side by side, and at most two chunks per
+    worker are held in memory.
+
+    The checkpoint position is the number of records read, so a resumed
+    import skips what an earlier run already committed. When a chunk
+    fails, the chunks after it that other workers committed are recorded
+    with the checkpoint and skipped on resume too. keep_ids keeps the id
+    of each record instead of assigning new ones.
+
+    The rows are inserted without the models, so no outbox events are
+    written for them even with OUTBOX_ENABLED. Consumers that need the
+    imported Accounts read them from the change feed.
+    """
+    app = current_app._get_current_object()  # pylint: disable=W0212
+    checkpoint = checkpoint or Checkpoint()
+    result = ImportResult()
+    use_copy = use_copy and db.engine.dialect.name == "postgresql"
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for rows, span in _read_chunks(
+            infile, fmt, chunk_size, checkpoint, keep_ids, result
+        ):
+            future = executor.submit(_insert_chunk, app, rows, use_copy)
+            pending.append((future, span))
+            _settle(pending, workers * 2 - 1, checkpoint, result, progress)
+        _settle(pending, 0, checkpoint, result, progress)
+
+    if keep_ids and db.engine.dialect.name == "postgresql":
+        db.session.execute(
+            db.text(
+                "SELECT setval(pg_get_serial_sequence('account', 'id'), "
+                "(SELECT MAX(id) FROM account))"
+            )
+        )
+        db.session.commit()
+    return result
+
+
+def _insert_chunk(app, rows, use_copy):
+    """Inserts rows in a transaction of their own and returns how many"""
+    with app.app_context():
+        try:
+            _insert_rows(rows, use_copy)
+        finally:
+            db.session.remove()
+    return len(rows)
+
+
+def _settle(pending, limit, checkpoint, result, progress):
+    """Waits for the oldest chunks until at most limit are pending
+
+    The checkpoint moves past each chunk in order. When one failed, the
+    chunks still pending that did commit are recorded before it raises.
+    """
+    while len(pending) > limit:
+        future, span = pending.popleft()
+        try:
+            result.imported += future.result()
+        except Exception:
+            spans = _committed(pending, checkpoint, result)
+            checkpoint.save(checkpoint.position, done=spans)
+            raise
+        checkpoint.save(span[1], done=checkpoint.done)
+        if progress:
+            progress(result.imported)
+
+
+def _committed(pending, checkpoint, result):
+    """Waits for the chunks still pending and returns the spans committed"""
+    spans = list(checkpoint.done)
+    for future, span in pending:
+        if future.exception() is None:
+            result.imported += future.result()
+            spans.append(span)
+    return spans
+
+
+def _read_chunks(infile, fmt, chunk_size, checkpoint, keep_ids, result):
+    """Yields (rows, span) chunks of the valid rows not yet committed
+
+    span is the (first, last) numbers of the records the chunk covers,
+    and last is the number of records read once the chunk is committed.
+    """
+    rows = []
+    first = checkpoint.position + 1
+    last = checkpoint.position
+    for number, data in enumerate(_read_records(infile, fmt), start=1):
+        if checkpoint.skips(number):
+            continue
+        last = number
+        try:
+            rows.append(_to_row(data, keep_ids))
+        except DataValidationError as error:
+            result.reject(number, str(error))
+        if len(rows) == chunk_size:
+            yield rows, (first, last)
+            rows = []
+            first = last + 1
+    if rows:
+        yield rows, (first, last)
+
+
+def _read_records(infile, fmt):
+    """Yields every record of infile as a dictionary"""
+    if fmt == "csv":
+        for record in csv.DictReader(infile):
+            yield {key: value or None for key, value in record.items()}
+        return
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def _to_row(data, keep_ids):
+    """Returns the validated column values of one imported record"""
+    account = Account().deserialize(data)
+    row = {
+        "name": account.name,
+        "email": account.email,
+        "address": account.address,
+        "phone_number": account.phone_number,
+        "date_joined": account.date_joined,
+        "version": 1,
+    }
+    if keep_ids:
+        try:
+            row["id"] = int(data["id"])
+        except (KeyError, TypeError, ValueError) as error:
+            raise DataValidationError("Invalid Account: bad id") from error
+    return row
+
+
+def _insert_rows(rows, use_copy):
+    """Inserts rows in one transaction, stamped with its transaction_time
+
+    COPY bypasses the column defaults, so the stamp is read first.
+    """
+    try:
+        if use_copy:
+            stamp = db.session.execute(db.select(transaction_time())).scalar()
+            _copy_rows([{**row, "updated_at": stamp} for row in rows])
+        else:
+            db.session.execute(Account.__table__.insert(), rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _copy_rows(rows):
+    """Streams rows into Postgres with COPY, its fastest bulk load"""
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(
+            ["\\N" if row[name] is None else row[name] for name in columns]
+        )
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY account ({', '.join(columns)}) FROM STDIN "
+            "WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+    finally:
+        cursor.close()
@@ -24,3 +24,147 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Number of rows flushed per INSERT batch by bulk account creation
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+
+# Page sizes for the keyset-paginated account list
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+
+# Rows fetched per round trip when streaming the account list
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Ids accepted by one POST /accounts/lookup, and ids per query it sends
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "1000"))
+FIND_MANY_CHUNK_SIZE = int(os.getenv("FIND_MANY_CHUNK_SIZE", "500"))
+
+# Read-through cache for single-record lookups: memory, redis or none. The
+# memory cache is not invalidated by other workers, so it only suits a
+# single worker process; redis is the default once CACHE_REDIS_URL is set
+CACHE_BACKEND = os.getenv(
+    "CACHE_BACKEND", "redis" if os.getenv("CACHE_REDIS_URL") else "none"
+)
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Connection pool for each worker process (ignored for SQLite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+
+# Schema migrations: how long DDL waits for a lock before retrying, how
+# often it retries, and the rows per backfill batch and pause between them
+MIGRATION_LOCK_TIMEOUT_MS = int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "2000"))
+MIGRATION_LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", "5"))
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.1"))
+
+# Partitioning of the account table: the period each range partition
+# holds (year or month), the number of hash partitions, and how many
+# periods ahead accounts-partitions --maintain creates range partitions
+ACCOUNT_PARTITION_INTERVAL = os.getenv("ACCOUNT_PARTITION_INTERVAL", "year")
+ACCOUNT_PARTITION_COUNT = int(os.getenv("ACCOUNT_PARTITION_COUNT", "8"))
+ACCOUNT_PARTITION_PREMAKE = int(os.getenv("ACCOUNT_PARTITION_PREMAKE", "2"))
+
+# Set when connecting through PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() == "true"
+
+# Export request and database metrics on /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# JSON encoder for account payloads: auto (orjson if installed), orjson
+# or stdlib
+JSON_PROVIDER = os.getenv("JSON_PROVIDER", "auto")
+
+# Transactional outbox for account changes, drained by `flask outbox-relay`
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "false").lower() == "true"
+OUTBOX_SINK = os.getenv("OUTBOX_SINK", "file:outbox.ndjson")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "30"))
+
+# Off PostgreSQL the change feed stops this many seconds in the past, so
+# rows written by transactions still open when it ran are not skipped; it
+# must exceed the longest transaction writing accounts. PostgreSQL stops
+# right before the oldest open transaction instead
+CHANGES_LAG_SECONDS = float(os.getenv("CHANGES_LAG_SECONDS", "60"))
+
+# Collapse concurrent identical account lookups into one query per worker
+SINGLE_FLIGHT_ENABLED = (
+    os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+)
+
+# Idempotency-Key responses are replayed for this many seconds; a claim
+# left in progress longer than the lock timeout is assumed abandoned
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "60"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+
+# Token-bucket rate limits per client and endpoint; overrides are given as
+# "endpoint=rate:burst,..." and buckets live in memory or in redis. Memory
+# buckets are per worker, so each client really gets the limit once per
+# worker of every replica; use redis for a limit shared by the service.
+# Clients are told apart by address; name a client header only when a
+# gateway in front authenticates it and drops the value clients send.
+# Behind proxies, set RATE_LIMIT_PROXY_HOPS to how many of them append to
+# X-Forwarded-For; the address the outermost one saw is then used
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "50"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "100"))
+RATE_LIMIT_OVERRIDES = os.getenv("RATE_LIMIT_OVERRIDES", "")
+RATE_LIMIT_EXEMPT = os.getenv("RATE_LIMIT_EXEMPT", "api.health,metrics")
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "")
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "0"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", CACHE_REDIS_URL)
+
+# Shed load with 503 when requests queue or wait on the pool this long;
+# 0 turns the check off
+SHED_QUEUE_TIME_MS = int(os.getenv("SHED_QUEUE_TIME_MS", "2000"))
+SHED_POOL_WAIT_MS = int(os.getenv("SHED_POOL_WAIT_MS", "1000"))
+
+# Read replicas: a comma-separated list of database URIs that serve reads,
+# picked round_robin or least_loaded
+REPLICA_URIS = os.getenv("REPLICA_URIS", "")
+REPLICA_STRATEGY = os.getenv("REPLICA_STRATEGY", "round_robin")
+REPLICA_RETRY_SECONDS = float(os.getenv("REPLICA_RETRY_SECONDS", "30"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Logging: json or text lines, written from a queue by a background thread;
+# below WARNING only a LOG_SAMPLE_RATE fraction of requests is logged and
+# each message at most LOG_RATE_LIMIT times per second (0 for no limit)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE = os.getenv("LOG_QUEUE", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "0"))
+LOG_ACCESS = os.getenv("LOG_ACCESS", "true").lower() == "true"
+LOG_REQUEST_ID_HEADER = os.getenv("LOG_REQUEST_ID_HEADER", "X-Request-ID")
+
+# Profile the SQL of every request, reporting it in a Server-Timing header
+# and warning about statements repeated this many times (N+1 queries)
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() == "true"
+SQL_PROFILE_REPEAT_THRESHOLD = int(
+    os.getenv("SQL_PROFILE_REPEAT_THRESHOLD", "5")
+)
+
+# Compress responses of these types with brotli (when installed) or gzip
+# once they reach COMPRESS_MIN_SIZE bytes; streams are compressed per chunk
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+COMPRESS_STREAMS = os.getenv("COMPRESS_STREAMS", "true").lower() == "true"
+COMPRESS_MIMETYPES = os.getenv(
+    "COMPRESS_MIMETYPES", "application/json,application/x-ndjson,text/csv"
+)
+
+# Cache-Control policies replacing those of the routes, given as
+# "endpoint=policy;..." (for example "api.list_accounts=no-store")
+CACHE_CONTROL_OVERRIDES = os.getenv("CACHE_CONTROL_OVERRIDES", "")
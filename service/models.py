@@ -3,32 +3,105 @@ Models for Account
 
 All of the models are stored in this module
 """
+import itertools
+import json
 import logging
-from datetime import date
+from datetime import date, datetime, timedelta
 
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.sql.expression import FunctionElement
+
+from service.common.cache import NullCache, make_cache
+from service.common.db_pool import engine_options
+from service.common.replicas import RoutingSQLAlchemy, make_router
+from service.common.single_flight import NullFlight, make_flight
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
     """Used for data validation errors when deserializing or updating"""
 
 
+class transaction_time(FunctionElement):  # pylint: disable=invalid-name
+    """The UTC time the current transaction started, by the database clock
+
+    Changes are stamped with it so the change feed can tell which of them
+    have surely committed (see Account.changes_horizon()). Only Postgres
+    keeps the transaction start; elsewhere it is the current time.
+    """
+
+    type = db.DateTime()
+    name = "transaction_time"
+    inherit_cache = True
+
+
+@compiles(transaction_time)
+def _transaction_time(*_, **__):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(transaction_time, "postgresql")
+def _transaction_time_postgresql(*_, **__):
+    return "timezone('utc', now())"
+
+
+@compiles(transaction_time, "sqlite")
+def _transaction_time_sqlite(*_, **__):
+    # Microseconds, as SQLAlchemy stores datetimes in SQLite
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Account.init_db(app)
 
 
+def _end_session(_exc=None):
+    """Ends the session of a request, with its routing state
+
+    A request served on the thread that pushed the global app context
+    reuses that context, whose teardown never runs. Without this its
+    session, pinned to the primary or not, would outlive the request.
+    """
+    db.session.remove()
+
+
+def dispose_engines(app):
+    """Forgets the connections a forked worker inherited from its parent
+
+    Connections must not be shared across processes. close=False leaves
+    them open for the parent, and the worker opens its own on demand.
+    """
+    with app.app_context():
+        db.get_engine(app).dispose(close=False)
+    router = app.extensions.get("replicas")
+    if router is not None:
+        router.dispose(close=False)
+
+
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
 ######################################################################
 class PersistentBase:
     """Base class adds persistent methods"""
 
+    # Read-through cache for find(), replaced in init_db()
+    cache = NullCache()
+
+    # Coalesces concurrent identical lookups, replaced in init_db()
+    flight = NullFlight()
+
+    # Write an OutboxEvent with every change, set in init_db()
+    outbox_enabled = False
+
     def __init__(self):
         self.id = None
 
@@ -36,42 +109,304 @@ class PersistentBase:
         """Creates an Account in the database"""
         logger.info("Creating %s", self.name)
         self.id = None
-        db.session.add(self)
-        db.session.commit()
+        try:
+            db.session.add(self)
+            if self.outbox_enabled:
+                db.session.flush()
+                self._record_event("created")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def create_many(cls, records, chunk_size=1000):
+        """Creates many records in a single transaction
+
+        Records are flushed in chunks so the driver can batch the INSERT
+        statements, and everything is committed once at the end.
+        """
+        logger.info(
+            "Creating %d records in chunks of %d", len(records), chunk_size
+        )
+        try:
+            for start in range(0, len(records), chunk_size):
+                end = start + chunk_size
+                chunk = records[start:end]
+                for record in chunk:
+                    record.id = None
+                db.session.add_all(chunk)
+                db.session.flush()
+                if cls.outbox_enabled:
+                    for record in chunk:
+                        record._record_event("created")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return records
 
     def update(self):
         """Updates an Account in the database"""
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         logger.info("Updating %s", self.name)
-        db.session.commit()
+        record_id = self.id
+        if self.outbox_enabled:
+            self._record_event("updated")
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            # Also drop the entry when the commit failed: a StaleDataError
+            # means the cached version is out of date
+            self.cache.delete(record_id)
 
     def delete(self):
         """Deletes an Account from the database"""
         logger.info("Deleting %s", self.name)
+        record_id = self.id
+        if self.outbox_enabled:
+            self._record_event("deleted", {"id": record_id})
+        db.session.add(
+            Tombstone(aggregate=self.__tablename__, record_id=record_id)
+        )
         db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            self.cache.delete(record_id)
+
+    def _record_event(self, event_type, payload=None):
+        """Adds an OutboxEvent for this change to the current transaction
+
+        The event commits or rolls back together with the change itself.
+        """
+        db.session.add(
+            OutboxEvent(
+                aggregate=self.__tablename__,
+                aggregate_id=self.id,
+                event_type=event_type,
+                payload=json.dumps(
+                    self.serialize() if payload is None else payload
+                ),
+            )
+        )
+
+    def _cache_values(self):
+        """Returns the column values stored in the cache for this record"""
+        return {
+            column.key: getattr(self, column.key)
+            for column in self.__table__.columns
+        }
+
+    @classmethod
+    def _from_cache(cls, values):
+        """Attaches a record rebuilt from cached values to the session
+
+        The record is merged without a load so a cache hit never issues
+        a query, while still behaving like any other persistent record.
+        """
+        record = cls(**values)
+        make_transient_to_detached(record)
+        return db.session.merge(record, load=False)
 
     @classmethod
     def init_db(cls, app):
-        """Initializes the database session"""
+        """Initializes the database session
+
+        Nothing connects to the database here, so workers boot without
+        touching it. The schema is created by the db-migrate command.
+        """
         logger.info("Initializing database")
         cls.app = app
+        cls.cache = make_cache(app.config, prefix=f"{cls.__tablename__}:")
+        cls.flight = make_flight(app.config)
+        cls.outbox_enabled = app.config.get("OUTBOX_ENABLED", False)
+        app.config.setdefault(
+            "SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config)
+        )
+        app.extensions["replicas"] = make_router(app.config)
         db.init_app(app)
+        app.teardown_request(_end_session)
         app.app_context().push()
-        db.create_all()
+
+    @classmethod
+    def read_query(cls):
+        """Returns a query for records that may be served by a replica"""
+        return cls.query.execution_options(replica=True)
+
+    @staticmethod
+    def use_primary():
+        """Sends every later read of this session to the primary
+
+        Call it before reading a record that is about to be changed, so
+        its version is not a stale one from a lagging replica.
+        """
+        db.session.info["primary"] = True
+
+    @staticmethod
+    def _read(func):
+        """Returns func(), retrying once if its replica went down
+
+        The router takes a replica that fails to connect out of rotation,
+        so the retry runs on another replica or on the primary.
+        """
+        router = db.get_app().extensions.get("replicas")
+        failures = router.failures if router else 0
+        try:
+            return func()
+        except OperationalError:
+            if router is None or router.failures == failures:
+                raise
+            db.session.rollback()
+            return func()
 
     @classmethod
     def all(cls):
         """Returns all records in the database"""
-        logger.info("Fetching all records")
-        return cls.query.all()
+        logger.debug("Fetching all records")
+        return cls._read(cls.read_query().all)
+
+    @classmethod
+    def page(cls, after=None, limit=100, query=None):
+        """Returns up to limit records with an ID greater than after
+
+        Seeking on the primary key keeps every page an index range scan,
+        however deep into the table the client has paged. Pages of plain
+        rows from column queries are immutable, so concurrent identical
+        requests share a single query, as long as it reads from the same
+        kind of database.
+        """
+        logger.debug("Fetching %d records after id %s", limit, after)
+        query = cls.read_query() if query is None else query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        query = query.order_by(cls.id).limit(limit)
+        if any(desc["expr"] is cls for desc in query.column_descriptions):
+            return cls._read(query.all)
+        statement = query.statement.compile()
+        key = (
+            "page",
+            str(statement),
+            tuple(sorted(statement.params.items())),
+            db.session().reads_primary(),
+        )
+        return cls._read(lambda: cls.flight.do(key, query.all))
+
+    @classmethod
+    def stream(cls, after=None, batch_size=1000, query=None):
+        """Yields records in ID order, loading batch_size rows at a time"""
+        logger.debug("Streaming records after id %s", after)
+        query = cls.read_query() if query is None else query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).yield_per(batch_size)
 
     @classmethod
     def find(cls, by_id):
-        """Finds a record by ID"""
-        logger.info("Looking up id %s ...", by_id)
-        return cls.query.get(by_id)
+        """Finds a record by ID, reading through the cache
+
+        Concurrent misses for the same ID share one query. Its column
+        values, rather than the record, are shared, and each caller gets
+        its own record attached to its own session. A session pinned to
+        the primary skips the cache, and only values read from the primary
+        are cached, since a lagging replica may return an old version.
+        """
+        logger.debug("Looking up id %s ...", by_id)
+        session = db.session()
+        values = None if session.pinned() else cls.cache.get(by_id)
+        if values is None:
+            fill = session.reads_primary()
+            values = cls._read(
+                lambda: cls.flight.do(
+                    ("find", by_id, fill), lambda: cls._load(by_id, fill)
+                )
+            )
+        if values is None:
+            return None
+        return cls._from_cache(values)
+
+    @classmethod
+    def find_latest(cls, by_id):
+        """Finds a record by ID on the primary, bypassing the cache
+
+        Use it for a record about to be changed: a cached copy, or one
+        from a lagging replica, may hold an old version, which would fail
+        the update as a concurrent change. Later reads of the session go
+        to the primary too.
+        """
+        logger.debug("Looking up latest id %s ...", by_id)
+        cls.use_primary()
+        return cls.query.populate_existing().get(by_id)
+
+    @classmethod
+    def _load(cls, by_id, fill=True):
+        """Loads a record, returning its column values
+
+        With fill, the values are also cached, unless the record changed
+        while it was loading, since they may predate the change.
+        """
+        since = cls.cache.generations([by_id]) if fill else None
+        record = cls.read_query().get(by_id)
+        if record is None:
+            return None
+        values = record._cache_values()
+        if fill:
+            cls.cache.set(by_id, values, since=since)
+        return values
+
+    @classmethod
+    def find_many(cls, ids, chunk_size=1000):
+        """Finds the records with the given IDs, in the order asked for
+
+        The cache is read first and only the misses are queried, up to
+        chunk_size IDs per query. Returns the record, or None when there
+        is none, for every ID in ids. The cache is used like in find().
+        """
+        ids = list(ids)
+        logger.debug("Looking up %d ids ...", len(ids))
+        unique = list(dict.fromkeys(ids))
+        session = db.session()
+        values = {} if session.pinned() else cls.cache.get_many(unique)
+        fill = session.reads_primary()
+        misses = (by_id for by_id in unique if by_id not in values)
+        while chunk := list(itertools.islice(misses, chunk_size)):
+            values.update(
+                cls._read(lambda ids=chunk: cls._load_many(ids, fill))
+            )
+        return [
+            cls._from_cache(values[by_id]) if by_id in values else None
+            for by_id in ids
+        ]
+
+    @classmethod
+    def _load_many(cls, ids, fill=True):
+        """Loads records, returning {id: column values}
+
+        With fill, they are also cached like in _load(). Postgres gets the
+        IDs as one array parameter, so every chunk size shares a single
+        prepared statement and plan.
+        """
+        if db.engine.dialect.name == "postgresql":
+            condition = cls.id == any_(
+                bindparam("ids", ids, type_=ARRAY(db.Integer))
+            )
+        else:
+            condition = cls.id.in_(ids)
+        since = cls.cache.generations(ids) if fill else None
+        loaded = {
+            record.id: record._cache_values()
+            for record in cls.read_query().filter(condition)
+        }
+        if fill:
+            cls.cache.set_many(loaded, since=since)
+        return loaded
 
 
 ######################################################################
@@ -82,13 +417,53 @@ class Account(db.Model, PersistentBase):
 
     app = None
 
+    # Columns returned by serialize() and column_query(), in order
+    SERIALIZED_FIELDS = (
+        "id",
+        "name",
+        "email",
+        "address",
+        "phone_number",
+        "date_joined",
+    )
+
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), index=True)
     email = db.Column(db.String(64))
     address = db.Column(db.String(256))
     phone_number = db.Column(db.String(32), nullable=True)
     date_joined = db.Column(db.Date(), nullable=False, default=date.today())
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=transaction_time(),
+        onupdate=transaction_time(),
+        server_default=transaction_time(),
+    )
+
+    # SQLAlchemy bumps version on every UPDATE and adds it to the WHERE
+    # clause, raising StaleDataError if someone else changed the row first
+    __mapper_args__ = {"version_id_col": version}
+
+    # Lower-case indexes serve case-insensitive equality and prefix search;
+    # text_pattern_ops lets Postgres use them for LIKE 'prefix%' under any
+    # collation
+    __table_args__ = (
+        db.Index(
+            "ix_account_name_lower",
+            db.func.lower(name).label("name_lower"),
+            postgresql_ops={"name_lower": "text_pattern_ops"},
+        ),
+        db.Index(
+            "ix_account_email_lower",
+            db.func.lower(email).label("email_lower"),
+            postgresql_ops={"email_lower": "text_pattern_ops"},
+        ),
+        # Serves the change feed, which seeks on (updated_at, id)
+        db.Index("ix_account_updated_at_id", updated_at, id),
+    )
 
     def __repr__(self):
         return f"<Account {self.name} id=[{self.id}]>"
@@ -104,11 +479,131 @@ class Account(db.Model, PersistentBase):
             "date_joined": self.date_joined.isoformat(),
         }
 
-    def deserialize(self, data):
-        """Deserializes an Account from a dictionary"""
+    @classmethod
+    def column_query(cls, fields=None):
+        """Returns a query for the serialized columns as plain row tuples
+
+        Rows skip ORM object construction and identity map bookkeeping,
+        which dominate the cost of serializing large listings. fields
+        narrows the SELECT to the named columns.
+        """
+        names = cls.SERIALIZED_FIELDS if fields is None else fields
+        query = db.session.query(*(getattr(cls, name) for name in names))
+        return query.execution_options(replica=True)
+
+    @classmethod
+    def check_fields(cls, fields):
+        """Validates a sparse fieldset requested by a client
+
+        Returns the fields in serialization order with id always first, so
+        rows can still be paged and the same fieldset is always spelled
+        the same way.
+        """
+        unknown = sorted(set(fields) - set(cls.SERIALIZED_FIELDS))
+        if unknown:
+            raise DataValidationError(f"Unknown fields: {', '.join(unknown)}")
+        return tuple(
+            name
+            for name in cls.SERIALIZED_FIELDS
+            if name == "id" or name in fields
+        )
+
+    @classmethod
+    def find_fields(cls, by_id, fields):
+        """Returns some fields of an Account, plus its version, as a dict
+
+        A cache hit is projected in memory; otherwise, or when the session
+        is pinned to the primary, only those columns are selected.
+        Returns None when the Account does not exist.
+        """
+        names = cls.check_fields(fields) + ("version",)
+        values = None if db.session().pinned() else cls.cache.get(by_id)
+        if values is None:
+            query = cls.column_query(names).filter(cls.id == by_id)
+            row = cls._read(query.one_or_none)
+            if row is None:
+                return None
+            values = row._asdict()
+        return {name: values[name] for name in names}
+
+    @classmethod
+    def find_version(cls, by_id):
+        """Returns the version of an Account without loading the row
+
+        The cache is checked first, unless the session is pinned to the
+        primary; otherwise only the version column is selected. Returns
+        None when the Account does not exist.
+        """
+        values = None if db.session().pinned() else cls.cache.get(by_id)
+        if values is not None:
+            return values["version"]
+        query = db.session.query(cls.version).filter(cls.id == by_id)
+        return cls._read(query.execution_options(replica=True).scalar)
+
+    @staticmethod
+    def serialize_row(row):
+        """Serializes a row from column_query() into a dictionary
+
+        date_joined is left as a date for the JSON provider to encode.
+        """
+        return row._asdict()
+
+    @classmethod
+    def changes(cls, since=None, until=None, batch_size=1000):
+        """Yields rows for the Accounts changed from since, before until
+
+        Rows come from column_query() plus updated_at, oldest change first.
+        Deleted Accounts are reported by Tombstone.changes() instead. The
+        primary is always read: a lagging replica could be missing changes
+        from before until, which the next sync would then skip.
+        """
+        logger.debug("Streaming changes between %s and %s", since, until)
+        query = cls.column_query(cls.SERIALIZED_FIELDS + ("updated_at",))
+        query = query.execution_options(replica=False)
+        if since is not None:
+            query = query.filter(cls.updated_at >= since)
+        if until is not None:
+            query = query.filter(cls.updated_at < until)
+        return query.order_by(cls.updated_at, cls.id).yield_per(batch_size)
+
+    @staticmethod
+    def changes_horizon(connection=None, lag=0.0):
+        """Returns the latest until a change feed can stop at
+
+        Every change is stamped with transaction_time(). On Postgres that
+        is the start of its transaction, so a change stamped before the
+        oldest transaction still open has surely committed, and the start
+        of that transaction is the horizon. pg_stat_activity hides the
+        transactions of other roles unless the role reading it is in
+        pg_read_all_stats, so every writer must use the service's role
+        or it must be granted that. Other databases stamp changes when
+        they are written, so the horizon is lag seconds before the time
+        on the database clock, and lag must be longer than any
+        transaction writing Accounts.
+        """
+        connection = db.session if connection is None else connection
+        if db.engine.dialect.name != "postgresql":
+            now = connection.execute(db.select(transaction_time())).scalar()
+            return now - timedelta(seconds=lag)
+        return connection.execute(
+            db.text(
+                "SELECT timezone('utc', LEAST(MIN(xact_start), now())) "
+                "FROM pg_stat_activity WHERE datname = current_database() "
+                "AND backend_type = 'client backend'"
+            )
+        ).scalar()
+
+    def deserialize(self, data, partial=False):
+        """Deserializes an Account from a dictionary
+
+        With partial=True, fields missing from data keep their current
+        values, as a PATCH requires.
+        """
         try:
             if not isinstance(data, dict):
                 raise TypeError("data is not a dictionary")
+            if partial:
+                data = {**self.serialize(), **data}
             self.name = data["name"]
             self.email = data["email"]
             self.address = data["address"]
@@ -126,13 +621,243 @@ class Account(db.Model, PersistentBase):
             raise DataValidationError(
                 "Invalid Account: body of request contained bad or no data"
             ) from error
+        except ValueError as error:
+            raise DataValidationError(f"Invalid Account: {error}") from error
         return self
 
     @classmethod
-    def find_by_name(cls, name):
+    def find_by_name(cls, name, query=None):
         """Returns all Accounts with the given name"""
-        logger.info("Searching for name: %s", name)
-        return cls.query.filter(cls.name == name)
+        logger.debug("Searching for name: %s", name)
+        query = cls.read_query() if query is None else query
+        return query.filter(cls.name == name)
+
+    @classmethod
+    def find_by_email(cls, email, query=None):
+        """Returns all Accounts with the given email, ignoring case"""
+        logger.debug("Searching for email: %s", email)
+        query = cls.read_query() if query is None else query
+        return query.filter(db.func.lower(cls.email) == email.lower())
+
+    @classmethod
+    def find_by_name_prefix(cls, prefix, query=None):
+        """Returns Accounts whose name starts with prefix, ignoring case"""
+        logger.debug("Searching for name prefix: %s", prefix)
+        query = cls.read_query() if query is None else query
+        return query.filter(
+            db.func.lower(cls.name).like(_prefix_pattern(prefix), escape="\\")
+        )
+
+    @classmethod
+    def find_by_email_prefix(cls, prefix, query=None):
+        """Returns Accounts whose email starts with prefix, ignoring case"""
+        logger.debug("Searching for email prefix: %s", prefix)
+        query = cls.read_query() if query is None else query
+        return query.filter(
+            db.func.lower(cls.email).like(_prefix_pattern(prefix), escape="\\")
+        )
+
+    @classmethod
+    def find_joined_from(cls, start, query=None):
+        """Returns Accounts that joined on or after start
+
+        Together with find_joined_before() this bounds date_joined, which
+        lets Postgres skip every partition outside the range when the
+        table is partitioned by date_joined.
+        """
+        logger.debug("Searching for joined from: %s", start)
+        query = cls.read_query() if query is None else query
+        return query.filter(cls.date_joined >= _as_date(start))
+
+    @classmethod
+    def find_joined_before(cls, end, query=None):
+        """Returns Accounts that joined before end"""
+        logger.debug("Searching for joined before: %s", end)
+        query = cls.read_query() if query is None else query
+        return query.filter(cls.date_joined < _as_date(end))
+
+
+def _as_date(value):
+    """Returns value as a date, parsing ISO 8601 strings"""
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid date: {value}") from error
+
+
+def _prefix_pattern(prefix):
+    """Returns a lower-case LIKE pattern matching values starting with prefix
+
+    The pattern is built here rather than in SQL so the database sees a
+    constant it can match against the text_pattern_ops indexes.
+    """
+    escaped = (
+        prefix.lower()
+        .replace("\\", "\\\\")
+        .replace("%", "\\%")
+        .replace("_", "\\_")
+    )
+    return f"{escaped}%"
+
+
+######################################################################
+#  O U T B O X   E V E N T   M O D E L
+######################################################################
+class OutboxEvent(db.Model):
+    """A change to a record, waiting to be published downstream
+
+    Events are written in the same transaction as the change and deleted
+    by the outbox relay once a sink has accepted them.
+    """
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True
+    )
+    aggregate = db.Column(db.String(64), nullable=False)
+    aggregate_id = db.Column(db.Integer, nullable=False)
+    event_type = db.Column(db.String(32), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow
+    )
+
+    def __repr__(self):
+        return f"<OutboxEvent {self.event_type} id=[{self.id}]>"
+
+    def to_message(self):
+        """Returns the message published for this event"""
+        return {
+            "id": self.id,
+            "type": f"{self.aggregate}.{self.event_type}",
+            "aggregate_id": self.aggregate_id,
+            "occurred_at": self.created_at.isoformat(),
+            "data": json.loads(self.payload),
+        }
+
+    @classmethod
+    def next_batch(cls, limit):
+        """Returns the oldest undelivered events, locking them
+
+        SKIP LOCKED lets several relays drain the outbox side by side on
+        Postgres; other databases ignore the locking clause.
+        """
+        return (
+            cls.query.order_by(cls.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+
+
+######################################################################
+#  T O M B S T O N E   M O D E L
+######################################################################
+class Tombstone(db.Model):
+    """Marks a deleted record so incremental syncs can see the delete"""
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True
+    )
+    aggregate = db.Column(db.String(64), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(
+        db.DateTime, nullable=False, default=transaction_time()
+    )
+
+    __table_args__ = (
+        db.Index("ix_tombstone_aggregate_deleted_at", aggregate, deleted_at),
+    )
+
+    def __repr__(self):
+        return f"<Tombstone {self.aggregate} id=[{self.record_id}]>"
+
+    @classmethod
+    def changes(cls, aggregate, since=None, until=None, batch_size=1000):
+        """Yields the tombstones of an aggregate from since, before until"""
+        query = db.session.query(cls.record_id, cls.deleted_at).filter(
+            cls.aggregate == aggregate
+        )
+        if since is not None:
+            query = query.filter(cls.deleted_at >= since)
+        if until is not None:
+            query = query.filter(cls.deleted_at < until)
+        return query.order_by(cls.deleted_at, cls.id).yield_per(batch_size)
+
+
+######################################################################
+#  I D E M P O T E N C Y   K E Y   M O D E L
+######################################################################
+class IdempotencyKey(db.Model):
+    """The outcome of a request sent with an Idempotency-Key header
+
+    A key is claimed with an empty status_code before the request runs and
+    completed with its response afterwards, so duplicates arriving in the
+    meantime, on any replica, can see it is still in progress.
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    etag = db.Column(db.String(128), nullable=True)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} status=[{self.status_code}]>"
+
+    @property
+    def completed(self):
+        """True once the response of the request has been stored"""
+        return self.status_code is not None
+
+    @classmethod
+    def claim(cls, key, fingerprint):
+        """Claims key for a new request
+
+        Returns (True, None) when the key was claimed, or (False, record)
+        when another request holds it. The record is None when that claim
+        was released before it could be read; the caller may try again.
+        The primary key makes the claim atomic.
+        """
+        db.session.add(cls(key=key, fingerprint=fingerprint))
+        try:
+            db.session.commit()
+            return True, None
+        except IntegrityError:
+            db.session.rollback()
+        return False, cls.query.populate_existing().get(key)
+
+    @classmethod
+    def complete(cls, key, status_code, body, etag=None):
+        """Stores the response of the request that claimed key"""
+        cls.query.filter(cls.key == key).update(
+            {"status_code": status_code, "body": body, "etag": etag}
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key, created_at=None):
+        """Deletes a claim so the key can be used again
+
+        With created_at, only that claim is deleted, in case another
+        request has replaced it since.
+        """
+        query = cls.query.filter(cls.key == key)
+        if created_at is not None:
+            query = query.filter(cls.created_at == created_at)
+        query.delete()
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, before):
+        """Deletes the keys created before a time and returns how many"""
+        count = cls.query.filter(cls.created_at < before).delete()
+        db.session.commit()
+        return count
 
 
 # temp
@@ -2,14 +2,44 @@
 Routes for the Account Service
 """
 
-from flask import Blueprint, abort, jsonify, request
+import base64
+import json
+from datetime import datetime, timezone
+
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    request,
+    stream_with_context,
+    url_for,
+)
+
+from sqlalchemy.orm.exc import StaleDataError
 
 from service.common import status
-from service.models import Account
+from service.common.http_caching import cache_control
+from service.common.idempotency import idempotent
+from service.common.json_provider import get_provider, json_response
+from service.models import Account, DataValidationError, Tombstone
 
 # Create the Blueprint for routes
 api = Blueprint("api", __name__)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Search parameters accepted by the account list, mapped to their finders
+SEARCH_FILTERS = {
+    "name": Account.find_by_name,
+    "email": Account.find_by_email,
+    "name_prefix": Account.find_by_name_prefix,
+    "email_prefix": Account.find_by_email_prefix,
+    "joined_from": Account.find_joined_from,
+    "joined_before": Account.find_joined_before,
+}
+
 
 ######################################################################
 # INDEX
@@ -17,6 +47,7 @@ api = Blueprint("api", __name__)
 
 
 @api.route("/", methods=["GET"])
+@cache_control("public, max-age=3600")
 def index():
     """Returns a simple greeting message for the root URL"""
     return (
@@ -31,6 +62,7 @@ def index():
 
 
 @api.route("/health", methods=["GET"])
+@cache_control("no-store")
 def health():
     """Health check endpoint"""
     return jsonify(status="OK"), status.HTTP_200_OK
@@ -54,12 +86,466 @@ def boom():
 
 @api.route("/accounts", methods=["POST"])
 def create_account():
-    """Creates a new Account"""
+    """Creates a new Account
+
+    Retries sent with the same Idempotency-Key get the original response
+    back instead of creating the Account again.
+    """
     if not request.is_json:
         abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    return idempotent(_create_account)
+
 
-    data = request.get_json()
+def _create_account():
+    """Creates the Account in the body of the request"""
     account = Account()
-    account.deserialize(data)
+    account.deserialize(request.get_json())
     account.create()
-    return jsonify(account.serialize()), status.HTTP_201_CREATED
+    return _account_response(account, status.HTTP_201_CREATED)
+
+
+######################################################################
+# LIST ALL ACCOUNTS
+######################################################################
+
+
+@api.route("/accounts", methods=["GET"])
+@cache_control("private, max-age=5", vary=("Accept",))
+def list_accounts():
+    """Lists Accounts one keyset page at a time
+
+    ``limit`` caps the page size and ``after`` takes the opaque cursor
+    returned in the ``X-Next-Cursor`` header of the previous page. Asking
+    for a stream (``stream=json``, ``stream=ndjson`` or an NDJSON Accept
+    header) returns every remaining Account in one chunked response.
+    Results can be narrowed with any of the SEARCH_FILTERS parameters and
+    ``fields`` selects a sparse fieldset, fetching only those columns.
+    """
+    after = _decode_cursor(request.args.get("after"))
+    query = _search_query(_requested_fields())
+    stream_format = _stream_format()
+    if stream_format:
+        return _stream_accounts(after, stream_format, query)
+
+    limit = request.args.get(
+        "limit", current_app.config["PAGE_SIZE_DEFAULT"], type=int
+    )
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+    limit = min(limit, current_app.config["PAGE_SIZE_MAX"])
+
+    # Fetch one extra row to learn whether there is a next page
+    rows = Account.page(after=after, limit=limit + 1, query=query)
+    response = json_response(
+        [Account.serialize_row(row) for row in rows[:limit]],
+        status.HTTP_200_OK,
+    )
+    if len(rows) > limit:
+        cursor = _encode_cursor(rows[limit - 1].id)
+        response.headers["X-Next-Cursor"] = cursor
+        args = request.args.to_dict()
+        args.update(after=cursor, limit=limit)
+        next_url = url_for("api.list_accounts", _external=True, **args)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def _search_query(fields):
+    """Returns the list row query narrowed by any search parameters"""
+    query = Account.column_query(fields)
+    for param, finder in SEARCH_FILTERS.items():
+        value = request.args.get(param)
+        if value:
+            query = finder(value, query=query)
+    return query
+
+
+def _encode_cursor(last_id):
+    """Returns an opaque cursor that resumes a listing after last_id"""
+    token = json.dumps({"id": last_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """Returns the last id encoded in a cursor, or None for no cursor"""
+    if not cursor:
+        return None
+    try:
+        last_id = json.loads(base64.urlsafe_b64decode(cursor))["id"]
+    except (ValueError, TypeError, KeyError) as error:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid cursor: {error}")
+    if not isinstance(last_id, int):
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid cursor")
+    return last_id
+
+
+def _stream_format():
+    """Returns the streaming format asked for, or None for a single page"""
+    stream = request.args.get("stream", "").lower()
+    if stream == "ndjson" or (
+        not stream and request.accept_mimetypes.best == NDJSON_MIMETYPE
+    ):
+        return "ndjson"
+    if stream in ("json", "true", "1"):
+        return "json"
+    return None
+
+
+def _stream_accounts(after, stream_format, query):
+    """Returns a chunked response with every Account after the cursor"""
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    rows = Account.stream(after=after, batch_size=batch_size, query=query)
+    return _stream_response(
+        (Account.serialize_row(row) for row in rows), stream_format
+    )
+
+
+def _stream_response(items, stream_format):
+    """Returns a chunked JSON array or NDJSON response of items
+
+    Encoded items are joined into chunks of STREAM_BATCH_SIZE so each
+    write to the socket carries many of them.
+    """
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    dumps = get_provider().dumps
+    ndjson = stream_format == "ndjson"
+
+    def generate():
+        if not ndjson:
+            yield "["
+        separator = ""
+        chunk = []
+        for item in items:
+            text = dumps(item)
+            if ndjson:
+                chunk.append(text + "\n")
+            else:
+                chunk.append(separator + text)
+                separator = ","
+            if len(chunk) == batch_size:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk)
+        if not ndjson:
+            yield "]"
+
+    return Response(
+        stream_with_context(generate()),
+        status=status.HTTP_200_OK,
+        mimetype=NDJSON_MIMETYPE if ndjson else "application/json",
+    )
+
+
+######################################################################
+# LIST CHANGES SINCE A WATERMARK
+######################################################################
+
+
+@api.route("/accounts/changes", methods=["GET"])
+@cache_control("no-store", vary=("Accept",))
+def list_account_changes():
+    """Streams the Accounts changed since a watermark
+
+    ``since`` takes the ``X-Watermark`` header of the previous sync (an
+    ISO 8601 timestamp). Changed Accounts come through as ``upsert``
+    entries, oldest change first, followed by a ``delete`` tombstone for
+    each Account deleted since. Without ``since`` every Account is sent,
+    which is how a client does its first full sync. The new watermark is
+    the horizon of Account.changes_horizon(), so changes still being
+    committed are left for the next sync rather than skipped.
+    """
+    since = _parse_watermark(request.args.get("since"))
+    until = Account.changes_horizon(
+        lag=current_app.config["CHANGES_LAG_SECONDS"]
+    )
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+
+    def changes():
+        for row in Account.changes(since, until, batch_size):
+            yield {"op": "upsert", **Account.serialize_row(row)}
+        if since is None:
+            return
+        tombstones = Tombstone.changes(
+            Account.__tablename__, since, until, batch_size
+        )
+        for record_id, deleted_at in tombstones:
+            yield {"op": "delete", "id": record_id, "deleted_at": deleted_at}
+
+    response = _stream_response(changes(), _stream_format() or "json")
+    response.headers["X-Watermark"] = until.isoformat()
+    return response
+
+
+def _parse_watermark(value):
+    """Returns the naive UTC datetime of a watermark, or None for none"""
+    if not value:
+        return None
+    try:
+        watermark = datetime.fromisoformat(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, f"Invalid watermark: {value}")
+    if watermark.tzinfo is not None:
+        watermark = watermark.astimezone(timezone.utc).replace(tzinfo=None)
+    return watermark
+
+
+######################################################################
+# READ AN ACCOUNT
+######################################################################
+
+
+@api.route("/accounts/<int:account_id>", methods=["GET"])
+@cache_control("private, no-cache")
+def read_account(account_id):
+    """Reads an Account by its id
+
+    ``fields`` selects a sparse fieldset, fetching only those columns. A
+    matching If-None-Match gets 304 Not Modified after checking only the
+    version, without loading or serializing the Account.
+    """
+    fields = _requested_fields()
+    if request.if_none_match:
+        version = Account.find_version(account_id)
+        etag = _etag(account_id, version, fields)
+        if version is not None and request.if_none_match.contains_weak(etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            response.set_etag(etag)
+            return response
+
+    if fields:
+        data = Account.find_fields(account_id, fields)
+        if data is None:
+            _not_found(account_id)
+        version = data.pop("version")
+        response = json_response(data, status.HTTP_200_OK)
+        response.set_etag(_etag(account_id, version, fields))
+        return response
+
+    account = _find_or_404(account_id)
+    return _account_response(account, status.HTTP_200_OK)
+
+
+######################################################################
+# LOOK UP MANY ACCOUNTS
+######################################################################
+
+
+@api.route("/accounts/lookup", methods=["POST"])
+def lookup_accounts():
+    """Reads many Accounts by id in one request
+
+    Takes ``{"ids": [...]}`` and returns the Accounts found, in the order
+    their ids were given, with the ids that were not found listed under
+    ``missing``. Cached Accounts are not queried again.
+    """
+    if not request.is_json:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    body = request.get_json()
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not all(
+        isinstance(value, int) and not isinstance(value, bool) for value in ids
+    ):
+        abort(status.HTTP_400_BAD_REQUEST, "ids must be a list of integers")
+    limit = current_app.config["LOOKUP_MAX_IDS"]
+    if len(ids) > limit:
+        abort(status.HTTP_400_BAD_REQUEST, f"At most {limit} ids per lookup")
+
+    ids = list(dict.fromkeys(ids))
+    records = Account.find_many(
+        ids, chunk_size=current_app.config["FIND_MANY_CHUNK_SIZE"]
+    )
+    return json_response(
+        {
+            "accounts": [
+                record.serialize() for record in records if record is not None
+            ],
+            "missing": [
+                account_id
+                for account_id, record in zip(ids, records)
+                if record is None
+            ],
+        },
+        status.HTTP_200_OK,
+    )
+
+
+######################################################################
+# UPDATE AN ACCOUNT
+######################################################################
+
+
+@api.route("/accounts/<int:account_id>", methods=["PUT", "PATCH"])
+def update_account(account_id):
+    """Updates an Account, replacing it on PUT and merging it on PATCH
+
+    If-Match is honored: a stale ETag, or a concurrent update that lands
+    first, gets 412 Precondition Failed. The Account is read from the
+    primary rather than the cache, so its version is the current one.
+    """
+    if not request.is_json:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    account = Account.find_latest(account_id)
+    if not account:
+        _not_found(account_id)
+    _check_if_match(account)
+    account.deserialize(request.get_json(), partial=request.method == "PATCH")
+    try:
+        account.update()
+    except StaleDataError:
+        _conflict(account_id)
+    return _account_response(account, status.HTTP_200_OK)
+
+
+######################################################################
+# DELETE AN ACCOUNT
+######################################################################
+
+
+@api.route("/accounts/<int:account_id>", methods=["DELETE"])
+def delete_account(account_id):
+    """Deletes an Account, honoring If-Match like updates do"""
+    account = Account.find_latest(account_id)
+    if account:
+        _check_if_match(account)
+        try:
+            account.delete()
+        except StaleDataError:
+            _conflict(account_id)
+    elif request.if_match:
+        abort(status.HTTP_412_PRECONDITION_FAILED, "Account does not exist")
+    return "", status.HTTP_204_NO_CONTENT
+
+
+def _etag(account_id, version, fields=None):
+    """Returns the strong ETag for a version of an Account
+
+    Each sparse fieldset is a different representation, so it gets its
+    own tag.
+    """
+    if fields:
+        return f"{account_id}-{version}-{','.join(fields)}"
+    return f"{account_id}-{version}"
+
+
+def _requested_fields():
+    """Returns the validated sparse fieldset asked for, or None for all"""
+    fields = [
+        name.strip()
+        for name in request.args.get("fields", "").split(",")
+        if name.strip()
+    ]
+    return Account.check_fields(fields) if fields else None
+
+
+def _find_or_404(account_id):
+    """Returns the Account with account_id or aborts with 404"""
+    account = Account.find(account_id)
+    if not account:
+        _not_found(account_id)
+    return account
+
+
+def _not_found(account_id):
+    """Aborts with 404 for a missing Account"""
+    abort(
+        status.HTTP_404_NOT_FOUND,
+        f"Account with id [{account_id}] could not be found.",
+    )
+
+
+def _check_if_match(account):
+    """Aborts with 412 when If-Match does not match the current ETag
+
+    Compression weakens the ETag a client sees, but the tag still names
+    the version, so a weak tag matches too.
+    """
+    if request.if_match and not request.if_match.contains_weak(
+        _etag(account.id, account.version)
+    ):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Account with id [{account.id}] has been modified.",
+        )
+
+
+def _conflict(account_id):
+    """Aborts a write that lost the race against a concurrent update"""
+    code = (
+        status.HTTP_412_PRECONDITION_FAILED
+        if request.if_match
+        else status.HTTP_409_CONFLICT
+    )
+    abort(code, f"Account with id [{account_id}] was modified concurrently.")
+
+
+def _account_response(account, status_code):
+    """Returns a JSON response for one Account, tagged with its ETag"""
+    response = json_response(account.serialize(), status_code)
+    response.set_etag(_etag(account.id, account.version))
+    return response
+
+
+######################################################################
+# CREATE MANY ACCOUNTS
+######################################################################
+
+
+@api.route("/accounts/bulk", methods=["POST"])
+def create_accounts_bulk():
+    """Creates many Accounts in a single transaction
+
+    Accepts a JSON array or an NDJSON stream (one account per line) and
+    returns a result for every item in the order it was received. Valid
+    items are inserted even when others fail validation.
+    """
+    items = _read_bulk_items()
+    results = []
+    accounts = []
+    for index, data in enumerate(items):
+        try:
+            accounts.append(Account().deserialize(data))
+            results.append({"index": index, "status": status.HTTP_201_CREATED})
+        except DataValidationError as error:
+            results.append(
+                {
+                    "index": index,
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "error": str(error),
+                }
+            )
+
+    Account.create_many(
+        accounts, chunk_size=current_app.config["BULK_CHUNK_SIZE"]
+    )
+    created = iter(accounts)
+    for result in results:
+        if result["status"] == status.HTTP_201_CREATED:
+            result["id"] = next(created).id
+
+    if len(accounts) == len(results):
+        return json_response(results, status.HTTP_201_CREATED)
+    return json_response(results, status.HTTP_207_MULTI_STATUS)
+
+
+def _read_bulk_items():
+    """Returns the list of items in the body of a bulk request"""
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = []
+        for number, line in enumerate(request.stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                abort(
+                    status.HTTP_400_BAD_REQUEST,
+                    f"Invalid JSON on line {number}",
+                )
+        return items
+
+    if not request.is_json:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a JSON array")
+    return items
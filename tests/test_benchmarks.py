@@ -0,0 +1,34 @@
+"""
+Test cases for comparing benchmark runs
+"""
+
+from unittest import TestCase
+
+from benchmarks.common import compare
+
+
+class TestCompare(TestCase):
+    """Benchmark regression checks"""
+
+    def test_regression(self):
+        """It should flag a p95 that grew beyond the threshold"""
+        baseline = {"read [client]": {"p95_ms": 2.0}}
+        current = {"read [client]": {"p95_ms": 2.5}}
+        regressions = compare(baseline, current, threshold=10)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn("read [client]: p95 2.0ms -> 2.5ms", regressions[0])
+        self.assertEqual(compare(baseline, current, threshold=30), [])
+
+    def test_noise_floor(self):
+        """It should ignore growth under min_delta_ms"""
+        baseline = {"read [client]": {"p95_ms": 0.2}}
+        current = {"read [client]": {"p95_ms": 0.4}}
+        self.assertEqual(
+            compare(baseline, current, threshold=10, min_delta_ms=0.5), []
+        )
+
+    def test_new_and_removed(self):
+        """It should only compare benchmarks present in both runs"""
+        baseline = {"old": {"p95_ms": 1.0}}
+        current = {"new": {"p95_ms": 100.0}, "bytes": {"bytes": 10}}
+        self.assertEqual(compare(baseline, current, threshold=0), [])
@@ -0,0 +1,223 @@
+"""
+Test cases for the cache backends
+"""
+
+from unittest import TestCase
+
+from service.common.cache import LRUCache, NullCache, SharedCache, make_cache
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    """Local stand-in for the subset of the Redis client used by the cache"""
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def setex(self, key, ttl, value):  # pylint: disable=unused-argument
+        self.store[key] = value
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        return self
+
+    def transaction(self, func, *watches):  # pylint: disable=unused-argument
+        func(self)
+
+    def multi(self):
+        pass
+
+    def execute(self):
+        return []
+
+    def delete(self, key):
+        self.store.pop(key, None)
+
+    def incr(self, key):
+        self.store[key] = str(int(self.store.get(key, 0)) + 1).encode()
+
+    def expire(self, key, ttl):  # pylint: disable=unused-argument
+        pass
+
+    def scan_iter(self, pattern):
+        prefix = pattern.rstrip("*")
+        return [key for key in list(self.store) if key.startswith(prefix)]
+
+
+class BrokenRedis:
+    """Stand-in for a Redis server that is down"""
+
+    def __getattr__(self, name):
+        def fail(*args):
+            raise ConnectionError("redis is down")
+
+        return fail
+
+
+class TestLRUCache(TestCase):
+    """In-process LRU cache tests"""
+
+    def test_hit_and_miss(self):
+        """It should count hits and misses"""
+        cache = LRUCache()
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"name": "foo"})
+        self.assertEqual(cache.get(1), {"name": "foo"})
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_evicts_least_recently_used(self):
+        """It should evict the least recently used entry when full"""
+        cache = LRUCache(max_size=2)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_expires_entries(self):
+        """It should treat entries older than the TTL as misses"""
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set(1, "one")
+        clock.now = 9
+        self.assertEqual(cache.get(1), "one")
+        clock.now = 10
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_many(self):
+        """It should read and fill many entries at once"""
+        clock = FakeClock()
+        cache = LRUCache(max_size=2, ttl=10, clock=clock)
+        cache.set_many({1: "one", 2: "two", 3: "three"})
+        self.assertEqual(cache.get_many([1, 2, 3]), {2: "two", 3: "three"})
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+        clock.now = 10
+        self.assertEqual(cache.get_many([2, 3]), {})
+
+    def test_delete_and_clear(self):
+        """It should delete single entries and clear everything"""
+        cache = LRUCache()
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        cache.clear()
+        self.assertIsNone(cache.get(2))
+
+    def test_fill_after_delete(self):
+        """It should not store values loaded before a delete of their key"""
+        cache = LRUCache()
+        since = cache.generations([1, 2])
+        cache.delete(1)
+        cache.set(1, "stale", since=since)
+        cache.set_many({1: "stale", 2: "two"}, since=since)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), "two")
+        cache.set(1, "one", since=cache.generations([1]))
+        self.assertEqual(cache.get(1), "one")
+        since = cache.generations([2])
+        cache.clear()
+        cache.set(2, "stale", since=since)
+        self.assertIsNone(cache.get(2))
+
+    def test_forgotten_deletes(self):
+        """It should refuse old fills once their deletes are forgotten"""
+        cache = LRUCache(max_size=1)
+        since = cache.generations([1])
+        cache.delete(1)
+        cache.delete(2)
+        cache.set(1, "stale", since=since)
+        self.assertIsNone(cache.get(1))
+
+
+class TestSharedCache(TestCase):
+    """Shared cache tests"""
+
+    def test_round_trip(self):
+        """It should store values in the shared client under a prefix"""
+        client = FakeRedis()
+        cache = SharedCache(client, prefix="account:")
+        cache.set(1, {"name": "foo"})
+        self.assertIn("account:1", client.store)
+        self.assertEqual(cache.get(1), {"name": "foo"})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_many(self):
+        """It should read and fill many keys in one round trip"""
+        client = FakeRedis()
+        cache = SharedCache(client, prefix="account:")
+        cache.set_many({1: "one", 2: "two"})
+        self.assertEqual(cache.get_many([1, 2, 3]), {1: "one", 2: "two"})
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_fill_after_delete(self):
+        """It should not store values loaded before a delete of their key"""
+        client = FakeRedis()
+        cache = SharedCache(client, prefix="account:")
+        since = cache.generations([1, 2])
+        cache.delete(1)
+        cache.set_many({1: "stale", 2: "two"}, since=since)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2), "two")
+        cache.set(1, "one", since=cache.generations([1]))
+        self.assertEqual(cache.get(1), "one")
+
+    def test_clear(self):
+        """It should only clear keys under its own prefix"""
+        client = FakeRedis()
+        client.store["other:1"] = b"keep"
+        cache = SharedCache(client, prefix="account:")
+        cache.set(1, "one")
+        cache.clear()
+        self.assertEqual(list(client.store), ["other:1"])
+
+    def test_store_errors(self):
+        """It should treat store errors as misses"""
+        cache = SharedCache(BrokenRedis())
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+        cache.set_many({1: "one"})
+        self.assertEqual(cache.get_many([1]), {})
+        self.assertEqual(cache.generations([1]), {})
+        cache.set(1, "one", since={})
+        cache.delete(1)
+        cache.clear()
+
+
+class TestMakeCache(TestCase):
+    """Cache factory tests"""
+
+    def test_backends(self):
+        """It should build the configured backend"""
+        cache = make_cache({"CACHE_BACKEND": "memory"}, "a:")
+        self.assertIsInstance(cache, LRUCache)
+        cache = make_cache({}, "a:")
+        self.assertIsInstance(cache, NullCache)
+        self.assertIsNone(cache.get(1))
+        self.assertRaises(
+            ValueError, make_cache, {"CACHE_BACKEND": "bogus"}, "a:"
+        )
@@ -1,9 +1,14 @@
 """
 Tests for CLI Commands
 """
-from unittest import TestCase
+import os
+import tempfile
+from unittest import TestCase, mock
 
-from service import create_app
+from flask import _app_ctx_stack
+
+from service import config, create_app
+from service.models import db
 
 
 class TestCLICommands(TestCase):
@@ -13,9 +18,83 @@ class TestCLICommands(TestCase):
         """Create app instance for CLI runner"""
         self.app = create_app()
         self.runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            db.create_all()
 
     def test_db_create(self):
         """It should call the db-create command successfully"""
         result = self.runner.invoke(args=["db-create"])
         self.assertEqual(result.exit_code, 0)
         self.assertIn("Database created", result.output)
+
+    def test_boot_creates_no_tables(self):
+        """It should leave creating the tables to db-create"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "boot.db")
+            with mock.patch.object(
+                config, "SQLALCHEMY_DATABASE_URI", f"sqlite:///{path}"
+            ):
+                app = create_app()
+            _app_ctx_stack.top.pop()
+            self.assertFalse(os.path.exists(path))
+            result = app.test_cli_runner().invoke(args=["db-create"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertTrue(os.path.exists(path))
+            with app.app_context():
+                db.get_engine(app).dispose()
+
+    def test_db_migrate(self):
+        """It should apply the migrations and then list them as applied"""
+        result = self.runner.invoke(args=["db-migrate"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Applied", result.output)
+        result = self.runner.invoke(args=["db-migrate", "--list"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotIn("pending", result.output)
+
+    def test_db_migrate_unknown_target(self):
+        """It should reject a target version that does not exist"""
+        result = self.runner.invoke(args=["db-migrate", "--target", "9999"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Unknown migration version 9999", result.output)
+
+    def test_accounts_partition_refused(self):
+        """It should refuse a partitioning it cannot do"""
+        result = self.runner.invoke(
+            args=["accounts-partition", "hash", "--count", "1"]
+        )
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("needs", result.output)
+
+    def test_outbox_relay_once(self):
+        """It should drain the outbox once and report the events sent"""
+        self.app.config["OUTBOX_SINK"] = "queue"
+        result = self.runner.invoke(args=["outbox-relay", "--once"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Delivered", result.output)
+
+    def test_accounts_export_import(self):
+        """It should export Accounts and import them back"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "accounts.csv")
+            result = self.runner.invoke(
+                args=["accounts-export", path, "--workers", "2", "--quiet"]
+            )
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Exported", result.output)
+            result = self.runner.invoke(
+                args=["accounts-import", path, "--no-copy", "--quiet"]
+            )
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("skipped 0", result.output)
+
+    def test_accounts_export_usage(self):
+        """It should not export to stdout with several workers"""
+        result = self.runner.invoke(
+            args=["accounts-export", "-", "--workers", "2"]
+        )
+        self.assertNotEqual(result.exit_code, 0)
+        result = self.runner.invoke(
+            args=["accounts-export", "-", "--checkpoint", "export.json"]
+        )
+        self.assertNotEqual(result.exit_code, 0)
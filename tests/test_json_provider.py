@@ -0,0 +1,58 @@
+"""
+Test cases for the JSON providers
+"""
+
+from datetime import date
+from unittest import TestCase, mock, skipIf
+
+from flask import Flask
+
+from service.common import json_provider
+from service.common.json_provider import (
+    OrjsonProvider,
+    StdlibJSONProvider,
+    init_json,
+    json_response,
+    make_provider,
+)
+
+PAYLOAD = {"id": 1, "name": "Jo", "date_joined": date(2020, 1, 2)}
+ENCODED = '{"id":1,"name":"Jo","date_joined":"2020-01-02"}'
+
+
+class TestJSONProvider(TestCase):
+    """JSON provider tests"""
+
+    def test_stdlib_provider(self):
+        """It should encode dates compactly with the standard library"""
+        provider = StdlibJSONProvider()
+        self.assertEqual(provider.dumps(PAYLOAD), ENCODED)
+        self.assertEqual(provider.loads(ENCODED)["date_joined"], "2020-01-02")
+        self.assertRaises(TypeError, provider.dumps, {"bad": object()})
+
+    @skipIf(json_provider.orjson is None, "orjson is not installed")
+    def test_orjson_provider(self):
+        """It should encode the same JSON with orjson"""
+        provider = OrjsonProvider()
+        self.assertEqual(provider.dumps(PAYLOAD), ENCODED)
+        self.assertEqual(provider.loads(ENCODED)["id"], 1)
+        self.assertIsInstance(make_provider("auto"), OrjsonProvider)
+
+    def test_make_provider(self):
+        """It should fall back to the standard library without orjson"""
+        with mock.patch.object(json_provider, "orjson", None):
+            self.assertIsInstance(make_provider("auto"), StdlibJSONProvider)
+            self.assertRaises(ImportError, make_provider, "orjson")
+        self.assertIsInstance(make_provider("stdlib"), StdlibJSONProvider)
+        self.assertRaises(ValueError, make_provider, "bogus")
+
+    def test_json_response(self):
+        """It should build responses with the app's provider"""
+        app = Flask(__name__)
+        app.config["JSON_PROVIDER"] = "stdlib"
+        init_json(app)
+        with app.app_context():
+            response = json_response(PAYLOAD, 201)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(response.get_data(as_text=True), ENCODED)
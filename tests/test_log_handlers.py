@@ -2,10 +2,21 @@
 Test cases for log handlers
 """
 
+import io
+import json
+import logging
+import queue
 import unittest
 from unittest.mock import MagicMock
 
-from service.common.log_handlers import init_logging
+from flask import Flask
+
+from service.common import log_handlers
+from service.common.log_handlers import (
+    NonBlockingQueueHandler,
+    SamplingFilter,
+    init_logging,
+)
 
 
 class TestLogHandlers(unittest.TestCase):
@@ -14,6 +25,7 @@ class TestLogHandlers(unittest.TestCase):
     def test_init_logging(self):
         """It should initialize logging with formatter"""
         mock_app = MagicMock()
+        mock_app.config = {"LOG_QUEUE": False}
         mock_logger = MagicMock()
         mock_handler = MagicMock()
 
@@ -30,3 +42,138 @@ class TestLogHandlers(unittest.TestCase):
         # Assertions
         mock_app.logger.setLevel.assert_called_with(20)
         mock_handler.setFormatter.assert_called()
+
+
+class TestLogPipeline(unittest.TestCase):
+    """Test the queued, structured log pipeline"""
+
+    def setUp(self):
+        """Sends the logs of a small app to a stream"""
+        self.stream = io.StringIO()
+        self.source = logging.getLogger("test.log_pipeline")
+        self.source.handlers = [logging.StreamHandler(self.stream)]
+        self.source.setLevel(logging.INFO)
+        self.models_logger = logging.getLogger("flask.app")
+        self.saved = (
+            self.models_logger.handlers,
+            self.models_logger.level,
+            self.models_logger.propagate,
+        )
+        self.app = Flask("log_pipeline")
+
+        @self.app.route("/hello")
+        def hello():
+            self.app.logger.info("Saying hello")
+            return "hello"
+
+    def tearDown(self):
+        """Stops the pipeline and restores the models logger"""
+        if log_handlers._pipeline is not None:
+            log_handlers._pipeline.stop()
+            log_handlers._pipeline = None
+        (
+            self.models_logger.handlers,
+            self.models_logger.level,
+            self.models_logger.propagate,
+        ) = self.saved
+
+    def _init(self, **config):
+        self.app.config.update(config)
+        init_logging(self.app, "test.log_pipeline")
+
+    def _records(self):
+        """Flushes the queue and returns the JSON records written"""
+        if log_handlers._pipeline is not None:
+            log_handlers._pipeline.stop()
+        return [
+            json.loads(line) for line in self.stream.getvalue().splitlines()
+        ]
+
+    def test_json_through_queue(self):
+        """It should write JSON records from a background thread"""
+        self._init()
+        self.assertIsInstance(
+            self.app.logger.handlers[0], NonBlockingQueueHandler
+        )
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.app.logger.exception("Failed %s", "here")
+        records = self._records()
+        self.assertEqual(records[-1]["message"], "Failed here")
+        self.assertEqual(records[-1]["level"], "ERROR")
+        self.assertIn("ValueError: boom", records[-1]["exception"])
+
+    def test_request_id_and_timing(self):
+        """It should tag records with the request ID and log each request"""
+        self._init(LOG_QUEUE=False)
+        client = self.app.test_client()
+        response = client.get("/hello", headers={"X-Request-ID": "abc"})
+        self.assertEqual(response.headers["X-Request-ID"], "abc")
+        response = client.get("/hello")
+        generated = response.headers["X-Request-ID"]
+        self.assertEqual(len(generated), 32)
+
+        records = self._records()
+        hello, access = records[-4:-2]
+        self.assertEqual(hello["message"], "Saying hello")
+        self.assertEqual(hello["request_id"], "abc")
+        self.assertEqual(access["status"], 200)
+        self.assertEqual(access["path"], "/hello")
+        self.assertGreaterEqual(access["duration_ms"], 0)
+        self.assertEqual(records[-1]["request_id"], generated)
+
+    def test_text_format(self):
+        """It should write text lines when asked to"""
+        self._init(LOG_FORMAT="text", LOG_QUEUE=False)
+        self.app.logger.warning("Plain")
+        self.assertIn("[WARNING]", self.stream.getvalue())
+        self.assertIn("Plain", self.stream.getvalue())
+
+    def test_sampling(self):
+        """It should drop the INFO records of requests not sampled"""
+        self._init(LOG_SAMPLE_RATE=0.0, LOG_QUEUE=False)
+        self.stream.truncate(0)
+        self.stream.seek(0)
+        self.app.test_client().get("/hello")
+        self.assertEqual(self.stream.getvalue(), "")
+        with self.app.test_request_context():
+            log_handlers.g.log_sampled = False
+            self.app.logger.warning("Kept")
+        self.assertIn("Kept", self.stream.getvalue())
+
+    def test_rate_limit(self):
+        """It should write each message at most rate_limit times a second"""
+        now = [100.0]
+        sampling = SamplingFilter(rate_limit=2, clock=lambda: now[0])
+        record = logging.LogRecord(
+            "test", logging.INFO, __file__, 1, "Hot %s", (1,), None
+        )
+        passed = [sampling.filter(record) for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertEqual(sampling.suppressed, 3)
+        now[0] += 1
+        self.assertTrue(sampling.filter(record))
+        record.levelno = logging.WARNING
+        self.assertTrue(all(sampling.filter(record) for _ in range(5)))
+
+    def test_full_queue_drops(self):
+        """It should drop records rather than wait for room in the queue"""
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        record = logging.LogRecord(
+            "test", logging.INFO, __file__, 1, "Hot", None, None
+        )
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_restart_after_fork(self):
+        """It should give a forked child a fresh queue and thread"""
+        self._init()
+        pipeline = log_handlers._pipeline
+        old_queue = pipeline.handler.queue
+        pipeline.stop()
+        pipeline.restart_after_fork()
+        self.assertIsNot(pipeline.handler.queue, old_queue)
+        self.app.logger.warning("After fork")
+        self.assertEqual(self._records()[-1]["message"], "After fork")
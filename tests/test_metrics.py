@@ -0,0 +1,116 @@
+"""
+Test cases for the metrics subsystem
+"""
+
+import logging
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from flask import Flask
+
+from service import create_app
+from service.common.metrics import init_metrics
+from service.common import status
+from service.models import Account, db
+from tests.factories import AccountFactory
+
+HTTPS_ENVIRON = {"wsgi.url_scheme": "https"}
+
+
+class TestMetrics(TestCase):
+    """Metrics endpoint tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        cls.app = create_app()
+        cls.app.config["TESTING"] = True
+        cls.app.logger.setLevel(logging.CRITICAL)
+        cls.client = cls.app.test_client()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        """Run before each test"""
+        with self.app.app_context():
+            db.session.query(Account).delete()
+            db.session.commit()
+        Account.cache.clear()
+
+    def _get(self, url):
+        return self.client.get(url, environ_overrides=HTTPS_ENVIRON)
+
+    def test_request_metrics(self):
+        """It should count requests and time them per endpoint"""
+        self._get("/health")
+        response = self._get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn(
+            'http_requests_total{endpoint="api.health",method="GET",'
+            'status="200"}',
+            text,
+        )
+        self.assertIn(
+            'http_request_duration_seconds_bucket{endpoint="api.health",'
+            'le="0.005",method="GET"}',
+            text,
+        )
+
+    def test_database_metrics(self):
+        """It should count the SQL statements issued by a request"""
+        account = AccountFactory()
+        response = self.client.post(
+            "/accounts",
+            json=account.serialize(),
+            environ_overrides=HTTPS_ENVIRON,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        text = self._get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'db_queries_per_request_count{endpoint="api.create_account"}',
+            text,
+        )
+        self.assertIn(
+            'db_query_duration_seconds_count{endpoint="api.create_account"}',
+            text,
+        )
+
+    def test_disabled(self):
+        """It should not time SQL statements when metrics are off"""
+        app = Flask(__name__)
+        app.config["METRICS_ENABLED"] = False
+        with mock.patch(
+            "service.common.metrics._listen_for_queries"
+        ) as listen:
+            init_metrics(app)
+            listen.assert_not_called()
+            init_metrics(Flask(__name__))
+            listen.assert_called_once()
+        self.assertNotIn("metrics", app.view_functions)
+
+    def test_stats_metrics(self):
+        """It should export the cache and pool counters of this worker"""
+        text = self._get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            f'cache_hits_total{{cache="account",pid="{os.getpid()}"}}', text
+        )
+        self.assertIn("db_pool_checked_out", text)
+        self.assertIn(
+            f'single_flight_leaders_total{{flight="account",'
+            f'pid="{os.getpid()}"}}',
+            text,
+        )
+        self.assertIn("single_flight_coalescing_ratio", text)
+
+    def test_multiprocess_mode(self):
+        """It should aggregate worker files when running multiprocess"""
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(
+                os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}
+            ):
+                response = self._get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("cache_hits_total", response.get_data(as_text=True))
@@ -0,0 +1,210 @@
+"""
+Test cases for the schema migrations
+"""
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+
+from service.common.migrations import (
+    LOCK_NOT_AVAILABLE,
+    MIGRATIONS,
+    Migration,
+    MigrationError,
+    Migrator,
+)
+from service.models import db
+
+# The account table as it was before any migration
+BASELINE = """
+CREATE TABLE account (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(64),
+    email VARCHAR(64),
+    address VARCHAR(256),
+    phone_number VARCHAR(32),
+    date_joined DATE NOT NULL
+)
+"""
+
+
+def lock_timeout():
+    """Returns the error Postgres raises when lock_timeout expires"""
+    orig = Exception("canceling statement due to lock timeout")
+    orig.pgcode = LOCK_NOT_AVAILABLE
+    return OperationalError("ALTER TABLE account", {}, orig)
+
+
+class TestMigrations(TestCase):
+    """Schema migration tests"""
+
+    def setUp(self):
+        """Run before each test"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmpdir.name, "migrate.db")
+        self.engine = create_engine(f"sqlite:///{path}")
+        self.messages = []
+
+    def tearDown(self):
+        """Run after each test"""
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def migrator(self, **kwargs):
+        """Returns a Migrator for the scratch database"""
+        return Migrator(self.engine, progress=self.messages.append, **kwargs)
+
+    def seed_baseline(self, count):
+        """Creates the baseline account table holding count rows"""
+        with self.engine.begin() as conn:
+            conn.execute(text(BASELINE))
+            for number in range(1, count + 1):
+                conn.execute(
+                    text(
+                        "INSERT INTO account (id, name, date_joined) "
+                        "VALUES (:id, :name, '2020-01-01')"
+                    ),
+                    {"id": number, "name": f"Name{number}"},
+                )
+
+    def test_upgrade_baseline(self):
+        """It should bring a baseline database up to the models"""
+        self.seed_baseline(5)
+        done = self.migrator(batch_size=2).migrate()
+        self.assertEqual(
+            [migration.version for migration in done],
+            [migration.version for migration in MIGRATIONS],
+        )
+        inspector = inspect(self.engine)
+        self.assertTrue(
+            {"outbox_event", "tombstone", "idempotency_key"}.issubset(
+                inspector.get_table_names()
+            )
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text("SELECT version, updated_at FROM account")
+            ).all()
+            indexes = conn.execute(
+                text(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE type = 'index' AND tbl_name = 'account'"
+                )
+            ).scalars()
+            self.assertTrue(
+                {
+                    "ix_account_name",
+                    "ix_account_name_lower",
+                    "ix_account_email_lower",
+                    "ix_account_updated_at_id",
+                }.issubset(indexes)
+            )
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(row.version == 1 for row in rows))
+        self.assertTrue(all(row.updated_at for row in rows))
+        self.assertIn("Backfilled 4 account rows", self.messages)
+        self.assertIn("Backfilled 5 account rows", self.messages)
+
+    def test_added_columns_default(self):
+        """It should add columns with defaults for rows old code inserts"""
+        self.seed_baseline(1)
+        self.migrator().migrate()
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO account (id, name, date_joined) "
+                    "VALUES (2, 'Old pod', '2020-01-01')"
+                )
+            )
+            version = conn.execute(
+                text("SELECT version FROM account WHERE id = 2")
+            ).scalar()
+        self.assertEqual(version, 1)
+        statements = []
+        migrator = mock.Mock(dialect=postgresql.dialect())
+        migrator.column.return_value = None
+        migrator.execute.side_effect = lambda *sql: statements.extend(sql)
+        for migration in (MIGRATIONS[2], MIGRATIONS[4]):
+            migration.steps[0].run(migrator)
+        self.assertIn("version INTEGER DEFAULT '1'", statements[0])
+        self.assertIn(
+            "updated_at TIMESTAMP WITHOUT TIME ZONE "
+            "DEFAULT timezone('utc', now())",
+            statements[1],
+        )
+
+    def test_migrations_cover_models(self):
+        """It should migrate a baseline database to every column and index
+
+        db.create_all() never alters an existing table, so a change to a
+        model only reaches deployed databases through a migration.
+        """
+        self.seed_baseline(1)
+        self.migrator().migrate()
+        inspector = inspect(self.engine)
+        with self.engine.connect() as conn:
+            indexes = set(
+                conn.execute(
+                    text("SELECT name FROM sqlite_master WHERE type = 'index'")
+                ).scalars()
+            )
+        for table in db.metadata.sorted_tables:
+            with self.subTest(table=table.name):
+                self.assertEqual(
+                    {col["name"] for col in inspector.get_columns(table.name)},
+                    set(table.columns.keys()),
+                )
+                self.assertLessEqual(
+                    {index.name for index in table.indexes}, indexes
+                )
+
+    def test_fresh_and_repeated(self):
+        """It should create a new database and then have nothing to do"""
+        migrator = self.migrator()
+        self.assertEqual(len(migrator.migrate()), len(MIGRATIONS))
+        self.assertEqual(migrator.migrate(), [])
+        self.assertEqual(
+            set(migrator.applied()),
+            {"0001", "0002", "0003", "0004", "0005", "0006"},
+        )
+
+    def test_target(self):
+        """It should stop after the target version"""
+        migrator = self.migrator()
+        done = migrator.migrate(target="0002")
+        self.assertEqual([m.version for m in done], ["0001", "0002"])
+        self.assertEqual(migrator.pending()[0].version, "0003")
+        with self.assertRaises(MigrationError):
+            migrator.migrate(target="9999")
+
+    def test_versions_increase(self):
+        """It should refuse migrations out of order"""
+        with self.assertRaises(MigrationError):
+            Migrator(
+                self.engine,
+                migrations=(Migration("0002", "b"), Migration("0001", "a")),
+            )
+
+    def test_lock_timeout_retries(self):
+        """It should retry DDL that timed out waiting for a lock"""
+        work = mock.Mock(side_effect=[lock_timeout(), lock_timeout(), "done"])
+        migrator = self.migrator(lock_retries=2, retry_delay=0)
+        self.assertEqual(migrator.guarded(work), "done")
+        self.assertEqual(work.call_count, 3)
+
+        work = mock.Mock(side_effect=lock_timeout())
+        with self.assertRaises(OperationalError):
+            migrator.guarded(work)
+        self.assertEqual(work.call_count, 3)
+
+    def test_other_errors_not_retried(self):
+        """It should not retry errors other than lock timeouts"""
+        error = OperationalError("SELECT 1", {}, Exception("gone"))
+        work = mock.Mock(side_effect=error)
+        with self.assertRaises(OperationalError):
+            self.migrator(retry_delay=0).guarded(work)
+        self.assertEqual(work.call_count, 1)
@@ -4,10 +4,23 @@ Test cases for Account Model
 
 import logging
 import os
+import threading
+import time
 import unittest
+from datetime import date
+from unittest.mock import patch
+
+from sqlalchemy.orm.exc import StaleDataError
 
 from service import create_app
-from service.models import Account, DataValidationError, db
+from service.models import (
+    Account,
+    DataValidationError,
+    Tombstone,
+    db,
+    dispose_engines,
+    transaction_time,
+)
 from tests.factories import AccountFactory
 
 DATABASE_URI = os.getenv(
@@ -29,8 +42,10 @@ class TestAccount(unittest.TestCase):
         app.config["TESTING"] = True
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["CACHE_BACKEND"] = "memory"
         app.logger.setLevel(logging.CRITICAL)
         Account.init_db(app)
+        db.create_all()
 
     @classmethod
     def tearDownClass(cls):
@@ -39,7 +54,9 @@ class TestAccount(unittest.TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Account).delete()
+        db.session.query(Tombstone).delete()
         db.session.commit()
+        Account.cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -164,3 +181,306 @@ class TestAccount(unittest.TestCase):
         account.id = None
         with self.assertRaises(DataValidationError):
             account.update()
+
+    def test_create_many_accounts(self):
+        """It should Create many Accounts in one transaction"""
+        accounts = AccountFactory.build_batch(7)
+        Account.create_many(accounts, chunk_size=3)
+        self.assertTrue(all(account.id for account in accounts))
+        self.assertEqual(len(Account.all()), 7)
+
+    def test_deserialize_with_bad_date(self):
+        """It should not Deserialize an account with a bad date_joined"""
+        data = AccountFactory().serialize()
+        data["date_joined"] = "not-a-date"
+        account = Account()
+        self.assertRaises(DataValidationError, account.deserialize, data)
+
+    def test_page_accounts(self):
+        """It should page through Accounts by ID"""
+        accounts = AccountFactory.build_batch(5)
+        Account.create_many(accounts)
+        ids = [account.id for account in accounts]
+        page = Account.page(limit=3)
+        self.assertEqual([account.id for account in page], ids[:3])
+        page = Account.page(after=ids[2], limit=3)
+        self.assertEqual([account.id for account in page], ids[3:])
+
+    def test_stream_accounts(self):
+        """It should stream Accounts in ID order"""
+        accounts = AccountFactory.build_batch(5)
+        Account.create_many(accounts)
+        ids = [account.id for account in accounts]
+        streamed = Account.stream(after=ids[0], batch_size=2)
+        self.assertEqual([account.id for account in streamed], ids[1:])
+
+    def test_find_reads_through_cache(self):
+        """It should serve repeated lookups from the cache"""
+        account = AccountFactory()
+        account.create()
+        account_id = account.id
+        # A session that wrote reads around the cache, so start another
+        db.session.remove()
+        hits = Account.cache.stats()["hits"]
+        first = Account.find(account_id)
+        db.session.expunge_all()
+        second = Account.find(account_id)
+        self.assertEqual(Account.cache.stats()["hits"], hits + 1)
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(second.email, first.email)
+        self.assertEqual(second.date_joined, first.date_joined)
+
+    def test_find_fill_after_update(self):
+        """It should not cache values loaded before an update committed"""
+        account = AccountFactory()
+        account.create()
+        account_id = account.id
+        db.session.expunge_all()
+        cache_values = Account._cache_values
+
+        def racing_update(record):
+            values = cache_values(record)
+            Account.cache.delete(record.id)
+            return values
+
+        with patch.object(Account, "_cache_values", racing_update):
+            self.assertEqual(Account.find(account_id).id, account_id)
+        self.assertIsNone(Account.cache.get(account_id))
+
+    def test_update_cached_account(self):
+        """It should invalidate the cache when an Account is updated"""
+        account = AccountFactory()
+        account.create()
+        account_id = account.id
+        Account.find(account_id)
+        db.session.expunge_all()
+        account = Account.find(account_id)
+        account.email = "cached@change.me"
+        account.update()
+        db.session.expunge_all()
+        self.assertEqual(Account.find(account_id).email, "cached@change.me")
+
+    def test_delete_cached_account(self):
+        """It should invalidate the cache when an Account is deleted"""
+        account = AccountFactory()
+        account.create()
+        Account.find(account.id)
+        account.delete()
+        self.assertIsNone(Account.find(account.id))
+
+    def test_find_by_email(self):
+        """It should Find an Account by email, ignoring case"""
+        account = AccountFactory(email="Mixed.Case@Example.com")
+        account.create()
+        found = Account.find_by_email("mixed.case@example.COM").all()
+        self.assertEqual([row.id for row in found], [account.id])
+
+    def test_find_by_prefix(self):
+        """It should Find Accounts by name and email prefix"""
+        for name, email in [
+            ("Alice Smith", "alice@example.com"),
+            ("alfred jones", "al_fred@example.com"),
+            ("Bob Alston", "bob@example.com"),
+        ]:
+            AccountFactory(name=name, email=email).create()
+        names = {row.name for row in Account.find_by_name_prefix("AL")}
+        self.assertEqual(names, {"Alice Smith", "alfred jones"})
+        emails = [row.email for row in Account.find_by_email_prefix("al_")]
+        self.assertEqual(emails, ["al_fred@example.com"])
+        self.assertEqual(Account.find_by_name_prefix("%").all(), [])
+
+    def test_find_joined_between(self):
+        """It should Find Accounts that joined within a date range"""
+        for joined in ("2020-12-31", "2021-01-01", "2021-06-30", "2021-07-01"):
+            AccountFactory(date_joined=date.fromisoformat(joined)).create()
+        found = Account.find_joined_before(
+            "2021-07-01", query=Account.find_joined_from(date(2021, 1, 1))
+        )
+        self.assertEqual(
+            sorted(row.date_joined.isoformat() for row in found),
+            ["2021-01-01", "2021-06-30"],
+        )
+        self.assertRaises(DataValidationError, Account.find_joined_from, "x")
+
+    def test_search_indexes(self):
+        """It should declare indexes for name and email search"""
+        indexes = {index.name for index in Account.__table__.indexes}
+        self.assertIn("ix_account_name", indexes)
+        self.assertIn("ix_account_name_lower", indexes)
+        self.assertIn("ix_account_email_lower", indexes)
+
+    def test_serialize_rows(self):
+        """It should serialize column rows like Accounts"""
+        account = AccountFactory()
+        account.create()
+        row = Account.column_query().filter(Account.id == account.id).one()
+        data = Account.serialize_row(row)
+        expected = account.serialize()
+        expected["date_joined"] = account.date_joined
+        self.assertEqual(data, expected)
+
+    def test_account_version(self):
+        """It should bump the version of an Account on every update"""
+        account = AccountFactory()
+        account.create()
+        self.assertEqual(account.version, 1)
+        account.name = "Renamed"
+        account.update()
+        self.assertEqual(account.version, 2)
+        self.assertEqual(Account.find_version(account.id), 2)
+        self.assertIsNone(Account.find_version(0))
+
+    def test_version_server_default(self):
+        """It should start rows inserted without a version at 1"""
+        db.session.execute(
+            Account.__table__.insert(),
+            {"name": "Raw", "email": "raw@example.com", "address": "Here"},
+        )
+        db.session.commit()
+        self.assertEqual(Account.find_by_name("Raw").first().version, 1)
+
+    def test_update_stale_account(self):
+        """It should refuse to overwrite a concurrent update"""
+        account = AccountFactory()
+        account.create()
+        db.session.execute(
+            Account.__table__.update()
+            .where(Account.__table__.c.id == account.id)
+            .values(version=Account.__table__.c.version + 1)
+        )
+        account.name = "Lost update"
+        self.assertRaises(StaleDataError, account.update)
+
+    def test_deserialize_partial(self):
+        """It should keep missing fields on a partial Deserialize"""
+        account = AccountFactory()
+        name = account.name
+        account.deserialize({"email": "partial@example.com"}, partial=True)
+        self.assertEqual(account.name, name)
+        self.assertEqual(account.email, "partial@example.com")
+
+    def test_check_fields(self):
+        """It should validate and order sparse fieldsets"""
+        self.assertEqual(
+            Account.check_fields(["email", "name"]), ("id", "name", "email")
+        )
+        self.assertRaises(DataValidationError, Account.check_fields, ["x"])
+
+    def test_find_fields(self):
+        """It should Find some fields of an Account from the DB or cache"""
+        account = AccountFactory()
+        account.create()
+        expected = {"id": account.id, "email": account.email, "version": 1}
+        db.session.remove()
+        self.assertEqual(Account.find_fields(account.id, ["email"]), expected)
+        Account.find(account.id)
+        hits = Account.cache.stats()["hits"]
+        self.assertEqual(Account.find_fields(account.id, ["email"]), expected)
+        self.assertEqual(Account.cache.stats()["hits"], hits + 1)
+        self.assertIsNone(Account.find_fields(0, ["email"]))
+
+    def test_updated_at(self):
+        """It should stamp updated_at on create and every update"""
+        account = AccountFactory()
+        account.create()
+        created = account.updated_at
+        self.assertIsNotNone(created)
+        account.name = "Changed"
+        account.update()
+        self.assertGreaterEqual(account.updated_at, created)
+
+    def test_changes(self):
+        """It should list changes and tombstones on either side of a horizon"""
+        first, second = AccountFactory.build_batch(2)
+        first.create()
+        horizon = Account.changes_horizon()
+        db.session.commit()
+        second.create()
+        self.assertEqual(
+            [row.id for row in Account.changes()], [first.id, second.id]
+        )
+        before = [row.id for row in Account.changes(until=horizon)]
+        after = [row.id for row in Account.changes(since=horizon)]
+        self.assertNotIn(second.id, before)
+        self.assertEqual(sorted(before + after), [first.id, second.id])
+        second_id = second.id
+        second.delete()
+        tombstones = list(Tombstone.changes("account", since=horizon))
+        self.assertEqual([row.record_id for row in tombstones], [second_id])
+        self.assertEqual(list(Tombstone.changes("account", until=horizon)), [])
+
+    def test_changes_horizon_lag(self):
+        """It should hold the horizon lag seconds back off PostgreSQL"""
+        if db.engine.dialect.name == "postgresql":
+            self.skipTest("PostgreSQL stops at the oldest open transaction")
+        horizon = Account.changes_horizon(lag=60)
+        account = AccountFactory()
+        account.create()
+        self.assertLess(horizon, account.updated_at)
+        self.assertEqual(list(Account.changes(until=horizon)), [])
+
+    def test_changes_horizon_open_transaction(self):
+        """It should stop the horizon before a transaction still open"""
+        if db.engine.dialect.name != "postgresql":
+            self.skipTest("Only PostgreSQL keeps transaction start times")
+        with db.engine.connect() as other:
+            transaction = other.begin()
+            other.execute(
+                Account.__table__.insert(),
+                {"name": "Open", "date_joined": date.today(), "version": 1},
+            )
+            stamp = other.execute(db.select(transaction_time())).scalar()
+            self.assertLessEqual(Account.changes_horizon(), stamp)
+            db.session.commit()
+            transaction.commit()
+        self.assertGreater(Account.changes_horizon(), stamp)
+
+    def test_find_coalesces(self):
+        """It should share one query between concurrent finds of an id"""
+        account = AccountFactory()
+        account.create()
+        account_id = account.id
+        Account.cache.clear()
+        db.session.expunge_all()
+        shared = {}
+
+        def follower():
+            with app.app_context():
+                shared["found"] = Account.find(account_id)
+                shared["name"] = shared["found"].name
+                db.session.remove()
+
+        original = Account._load
+        thread = threading.Thread(target=follower)
+        stats = Account.flight.stats()
+
+        def load(by_id, fill):
+            thread.start()
+            while Account.flight.stats()["followers"] == stats["followers"]:
+                time.sleep(0.001)
+            return original(by_id, fill)
+
+        with patch.object(Account, "_load", side_effect=load):
+            found = Account.find(account_id)
+        thread.join()
+        self.assertEqual(shared["name"], found.name)
+        self.assertIsNot(shared["found"], found)
+        leaders = Account.flight.stats()["leaders"]
+        self.assertEqual(leaders, stats["leaders"] + 1)
+
+    def test_page_coalesces_rows(self):
+        """It should coalesce pages of rows but not of records"""
+        AccountFactory().create()
+        leaders = Account.flight.stats()["leaders"]
+        Account.page(limit=10, query=Account.column_query())
+        Account.page(limit=10)
+        self.assertEqual(Account.flight.stats()["leaders"], leaders + 1)
+
+    def test_dispose_engines(self):
+        """It should give a forked worker its own connection pool"""
+        AccountFactory().create()
+        db.session.remove()
+        pool = db.get_engine(app).pool
+        dispose_engines(app)
+        self.assertIsNot(db.get_engine(app).pool, pool)
+        self.assertEqual(len(Account.all()), 1)
@@ -0,0 +1,209 @@
+"""
+Test cases for rate limiting and load shedding
+"""
+
+import logging
+import time
+from unittest import TestCase, mock
+
+from service import create_app
+from service.common import status
+from service.common.db_pool import pool_stats
+from service.common.rate_limit import (
+    MemoryBucketStore,
+    SharedBucketStore,
+    make_bucket_store,
+    parse_limits,
+    queue_time,
+)
+from service.models import Account, db
+
+HTTPS_ENVIRON = {"wsgi.url_scheme": "https"}
+
+
+class FakeClock:
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestBucketStores(TestCase):
+    """Token bucket store tests"""
+
+    def test_memory_bucket(self):
+        """It should allow a burst and then refill at the rate"""
+        clock = FakeClock()
+        store = MemoryBucketStore(clock=clock)
+        self.assertEqual(store.take("a", 2, 3), 0)
+        self.assertEqual(store.take("a", 2, 3), 0)
+        self.assertEqual(store.take("a", 2, 3), 0)
+        self.assertAlmostEqual(store.take("a", 2, 3), 0.5)
+        self.assertEqual(store.take("b", 2, 3), 0)
+        clock.now = 0.5
+        self.assertEqual(store.take("a", 2, 3), 0)
+        self.assertAlmostEqual(store.take("a", 2, 3), 0.5)
+
+    def test_memory_bucket_bounded(self):
+        """It should drop the least recently used buckets"""
+        store = MemoryBucketStore(max_keys=2, clock=FakeClock())
+        store.take("a", 1, 1)
+        store.take("b", 1, 1)
+        store.take("c", 1, 1)
+        self.assertEqual(store.take("a", 1, 1), 0)
+        self.assertEqual(store.take("c", 1, 1), 1)
+
+    def test_shared_bucket(self):
+        """It should take tokens through a script on the shared store"""
+        client = mock.Mock()
+        client.eval.return_value = b"0.25"
+        store = SharedBucketStore(client, clock=lambda: 100.0)
+        self.assertEqual(store.take("a", 4, 8), 0.25)
+        args = client.eval.call_args.args
+        self.assertEqual(args[1:], (1, "ratelimit:a", 4, 8, 100.0))
+
+    def test_shared_bucket_unavailable(self):
+        """It should let requests through when the store is down"""
+        client = mock.Mock()
+        client.eval.side_effect = ConnectionError("down")
+        self.assertEqual(SharedBucketStore(client).take("a", 1, 1), 0)
+
+    def test_make_bucket_store(self):
+        """It should build the configured bucket store"""
+        self.assertIsInstance(make_bucket_store({}), MemoryBucketStore)
+        self.assertRaises(
+            ValueError, make_bucket_store, {"RATE_LIMIT_BACKEND": "disk"}
+        )
+
+    def test_parse_limits(self):
+        """It should parse per-endpoint limits"""
+        self.assertEqual(
+            parse_limits("api.a=2:10, api.b=5"),
+            {"api.a": (2.0, 10.0), "api.b": (5.0, 5.0)},
+        )
+        self.assertEqual(parse_limits(""), {})
+
+    def test_queue_time(self):
+        """It should read X-Request-Start in any unit"""
+        self.assertAlmostEqual(queue_time("t=99.5", 100.0), 0.5)
+        self.assertAlmostEqual(
+            queue_time("t=1600000000000", 1600000001.0), 1.0
+        )
+        self.assertAlmostEqual(
+            queue_time("t=1600000000000000", 1600000002.0), 2.0
+        )
+        self.assertEqual(queue_time(None, 100.0), 0)
+        self.assertEqual(queue_time("t=soon", 100.0), 0)
+
+
+class TestRateLimitMiddleware(TestCase):
+    """Rate limiting middleware tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        cls.app = create_app()
+        cls.app.config["TESTING"] = True
+        cls.app.logger.setLevel(logging.CRITICAL)
+        cls.client = cls.app.test_client()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        """Run before each test"""
+        self.limiter = self.app.extensions["rate_limiter"]
+        self.limiter.store = MemoryBucketStore()
+        self.limiter.enabled = True
+        self.limiter.limits = {"api.read_account": (1.0, 2.0)}
+        pool_stats.reset()
+
+    def tearDown(self):
+        """Run after each test"""
+        self.limiter.enabled = False
+        self.limiter.proxy_hops = 0
+        self.limiter.client_header = self.app.config[
+            "RATE_LIMIT_CLIENT_HEADER"
+        ]
+        pool_stats.reset()
+
+    def _get(self, url, **headers):
+        return self.client.get(
+            url, headers=headers, environ_overrides=HTTPS_ENVIRON
+        )
+
+    def test_rate_limited(self):
+        """It should answer 429 once a client used up its burst"""
+        with mock.patch.object(Account, "find", return_value=None) as find:
+            codes = [self._get("/accounts/1").status_code for _ in range(3)]
+            self.assertEqual(find.call_count, 2)
+        self.assertEqual(codes[2], status.HTTP_429_TOO_MANY_REQUESTS)
+        response = self._get("/accounts/1")
+        self.assertEqual(response.headers["Retry-After"], "1")
+        self.assertEqual(response.get_json()["error"], "Too Many Requests")
+
+    def test_clients_limited_apart(self):
+        """It should keep a bucket for every client and endpoint"""
+        self.limiter.client_header = "X-API-Key"
+        for _ in range(3):
+            self._get("/accounts/1", **{"X-API-Key": "one"})
+        response = self._get("/accounts/1", **{"X-API-Key": "two"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self._get("/", **{"X-API-Key": "one"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_client_header_ignored(self):
+        """It should not let a client escape its bucket with a new key"""
+        self.limiter.client_header = ""
+        for key in ("one", "two"):
+            self._get("/accounts/1", **{"X-API-Key": key})
+        response = self._get("/accounts/1", **{"X-API-Key": "three"})
+        self.assertEqual(
+            response.status_code, status.HTTP_429_TOO_MANY_REQUESTS
+        )
+
+    def test_client_behind_proxy(self):
+        """It should key on the address the trusted proxy appended"""
+        self.limiter.proxy_hops = 1
+        for spoofed in ("1.1.1.1", "2.2.2.2"):
+            self._get(
+                "/accounts/1", **{"X-Forwarded-For": f"{spoofed}, 10.0.0.1"}
+            )
+        response = self._get(
+            "/accounts/1", **{"X-Forwarded-For": "3.3.3.3, 10.0.0.1"}
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response = self._get("/accounts/1", **{"X-Forwarded-For": "10.0.0.2"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_exempt_endpoints(self):
+        """It should never turn away health checks"""
+        self.limiter.limits["api.health"] = (1.0, 1.0)
+        for _ in range(3):
+            response = self._get("/health", **{"X-Request-Start": "t=1"})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_shed_on_queue_time(self):
+        """It should shed requests that queued too long"""
+        started = f"t={int((time.time() - 10) * 1000)}"
+        with mock.patch.object(Account, "find") as find:
+            response = self._get("/accounts/1", **{"X-Request-Start": started})
+            find.assert_not_called()
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        self.assertIn("Retry-After", response.headers)
+
+    def test_shed_on_pool_wait(self):
+        """It should shed requests while pool checkouts wait too long"""
+        pool_stats.observe_wait(5.0)
+        response = self._get("/")
+        self.assertEqual(
+            response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+        pool_stats.observe_wait(5.0, clock=lambda: time.monotonic() - 2)
+        self.assertEqual(self._get("/").status_code, status.HTTP_200_OK)
@@ -6,13 +6,17 @@ Run with:
   coverage report -m
 """
 
+import json
 import logging
 import os
+from datetime import date
 from unittest import TestCase
+from unittest.mock import patch
 
 from service import create_app, talisman
 from service.common import status
-from service.models import Account, db
+from service.common.cache import LRUCache
+from service.models import Account, Tombstone, db
 from tests.factories import AccountFactory
 
 DATABASE_URI = os.getenv(
@@ -50,7 +54,9 @@ class TestAccountService(TestCase):
         """Run before each test"""
         with self.app.app_context():
             db.session.query(Account).delete()
+            db.session.query(Tombstone).delete()
             db.session.commit()
+        Account.cache.clear()
 
     def tearDown(self):
         """Run after each test"""
@@ -122,3 +128,407 @@ class TestAccountService(TestCase):
         self.assertEqual(
             response.headers.get("Access-Control-Allow-Origin"), "*"
         )
+
+    def test_create_accounts_bulk(self):
+        """It should Create many Accounts from a JSON array"""
+        accounts = [
+            account.serialize() for account in AccountFactory.build_batch(5)
+        ]
+        response = self.client.post(f"{BASE_URL}/bulk", json=accounts)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.get_json()
+        self.assertEqual(len(results), 5)
+        for index, result in enumerate(results):
+            self.assertEqual(result["index"], index)
+            self.assertEqual(result["status"], status.HTTP_201_CREATED)
+            self.assertIsNotNone(result["id"])
+        with self.app.app_context():
+            self.assertEqual(len(Account.all()), 5)
+
+    def test_create_accounts_bulk_ndjson(self):
+        """It should Create many Accounts from an NDJSON stream"""
+        lines = [
+            json.dumps(account.serialize())
+            for account in AccountFactory.build_batch(3)
+        ]
+        response = self.client.post(
+            f"{BASE_URL}/bulk",
+            data="\n".join(lines) + "\n",
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_create_accounts_bulk_partial(self):
+        """It should report per-item errors and create the valid Accounts"""
+        accounts = [
+            account.serialize() for account in AccountFactory.build_batch(2)
+        ]
+        accounts.insert(1, {"name": "missing email"})
+        response = self.client.post(f"{BASE_URL}/bulk", json=accounts)
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        results = response.get_json()
+        self.assertEqual(
+            [result["status"] for result in results], [201, 400, 201]
+        )
+        self.assertIn("email", results[1]["error"])
+        with self.app.app_context():
+            self.assertEqual(len(Account.all()), 2)
+
+    def test_create_accounts_bulk_bad_request(self):
+        """It should not Create Accounts from a bad bulk body"""
+        response = self.client.post(f"{BASE_URL}/bulk", json={"name": "x"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            f"{BASE_URL}/bulk",
+            data="{not json}\n",
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(
+            f"{BASE_URL}/bulk", data="[]", content_type="text/plain"
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        )
+
+    def test_list_accounts(self):
+        """It should List Accounts one page at a time"""
+        accounts = self._create_accounts(5)
+        response = self.client.get(BASE_URL, query_string={"limit": 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(
+            [row["id"] for row in data], [a.id for a in accounts[:2]]
+        )
+        self.assertIn('rel="next"', response.headers["Link"])
+
+        seen = list(data)
+        cursor = response.headers["X-Next-Cursor"]
+        while cursor:
+            response = self.client.get(
+                BASE_URL, query_string={"limit": 2, "after": cursor}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(response.get_json())
+            cursor = response.headers.get("X-Next-Cursor")
+        self.assertEqual([row["id"] for row in seen], [a.id for a in accounts])
+
+    def test_list_accounts_empty(self):
+        """It should List no Accounts when there are none"""
+        response = self.client.get(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), [])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+    def test_list_accounts_bad_paging(self):
+        """It should not List Accounts with a bad cursor or limit"""
+        response = self.client.get(BASE_URL, query_string={"after": "bogus"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string={"limit": 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_accounts_json(self):
+        """It should stream every Account as a JSON array"""
+        accounts = self._create_accounts(3)
+        with patch.dict(self.app.config, {"STREAM_BATCH_SIZE": 2}):
+            response = self.client.get(
+                BASE_URL, query_string={"stream": "json"}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.is_streamed)
+            data = json.loads(response.get_data())
+        self.assertEqual([row["id"] for row in data], [a.id for a in accounts])
+
+    def test_stream_accounts_ndjson(self):
+        """It should stream every Account as NDJSON"""
+        accounts = self._create_accounts(3)
+        response = self.client.get(
+            BASE_URL, headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.get_data().splitlines()]
+        self.assertEqual([row["id"] for row in rows], [a.id for a in accounts])
+
+    def test_read_account(self):
+        """It should Read a single Account"""
+        account = self._create_accounts(1)[0]
+        response = self.client.get(f"{BASE_URL}/{account.id}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["name"], account.name)
+        self.assertEqual(data["email"], account.email)
+
+    def test_account_not_found(self):
+        """It should not Read an Account that is not found"""
+        response = self.client.get(f"{BASE_URL}/0")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search_accounts(self):
+        """It should List Accounts matching search parameters"""
+        accounts = self._create_accounts(3)
+        target = accounts[1]
+        response = self.client.get(
+            BASE_URL, query_string={"email": target.email.upper()}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [row["id"] for row in response.get_json()], [target.id]
+        )
+
+        response = self.client.get(
+            BASE_URL,
+            query_string={
+                "name_prefix": target.name[:3].lower(),
+                "name": target.name,
+            },
+        )
+        self.assertIn(target.id, [row["id"] for row in response.get_json()])
+
+    def test_search_accounts_joined(self):
+        """It should List Accounts that joined within a date range"""
+        for joined in ("2020-12-31", "2021-01-01", "2022-01-01"):
+            account = AccountFactory(date_joined=date.fromisoformat(joined))
+            self.client.post(BASE_URL, json=account.serialize())
+        response = self.client.get(
+            BASE_URL,
+            query_string={
+                "joined_from": "2021-01-01",
+                "joined_before": "2022-01-01",
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [row["date_joined"] for row in response.get_json()],
+            ["2021-01-01"],
+        )
+        response = self.client.get(
+            BASE_URL, query_string={"joined_from": "last year"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_accounts_next_link(self):
+        """It should keep search parameters in the next page link"""
+        for account in AccountFactory.build_batch(3, name="Same Name"):
+            self.client.post(BASE_URL, json=account.serialize())
+        response = self.client.get(
+            BASE_URL, query_string={"name": "Same Name", "limit": 2}
+        )
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertIn("name=Same+Name", response.headers["Link"])
+
+    def test_read_account_etag(self):
+        """It should tag an Account and answer If-None-Match with 304"""
+        account = self._create_accounts(1)[0]
+        response = self.client.get(f"{BASE_URL}/{account.id}")
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, f'"{account.id}-1"')
+
+        response = self.client.get(
+            f"{BASE_URL}/{account.id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.get_data(), b"")
+        self.assertEqual(response.headers["ETag"], etag)
+
+        response = self.client.get(
+            f"{BASE_URL}/{account.id}", headers={"If-None-Match": '"other"'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_update_account(self):
+        """It should Update an Account and bump its ETag"""
+        account = self._create_accounts(1)[0]
+        data = account.serialize()
+        data["email"] = "new@example.com"
+        response = self.client.put(f"{BASE_URL}/{account.id}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["email"], "new@example.com")
+        self.assertEqual(response.headers["ETag"], f'"{account.id}-2"')
+
+    def test_patch_account(self):
+        """It should change only the fields sent in a PATCH"""
+        account = self._create_accounts(1)[0]
+        response = self.client.patch(
+            f"{BASE_URL}/{account.id}", json={"address": "1 New Street"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(data["address"], "1 New Street")
+        self.assertEqual(data["name"], account.name)
+
+    def test_update_account_if_match(self):
+        """It should reject an update with a stale If-Match"""
+        account = self._create_accounts(1)[0]
+        etag = self.client.get(f"{BASE_URL}/{account.id}").headers["ETag"]
+        response = self.client.patch(
+            f"{BASE_URL}/{account.id}",
+            json={"name": "First"},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(
+            f"{BASE_URL}/{account.id}",
+            json={"name": "Second"},
+            headers={"If-Match": etag},
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_412_PRECONDITION_FAILED
+        )
+        response = self.client.get(f"{BASE_URL}/{account.id}")
+        self.assertEqual(response.get_json()["name"], "First")
+
+    def test_update_account_cached(self):
+        """It should Update an Account whose cached copy is out of date"""
+        account = self._create_accounts(1)[0]
+        with patch.object(Account, "cache", LRUCache()):
+            self.client.get(f"{BASE_URL}/{account.id}")
+            with self.app.app_context():
+                # Changed by another worker, whose cache this one never sees
+                Account.query.filter(Account.id == account.id).update(
+                    {"name": "Elsewhere", "version": 2}
+                )
+                db.session.commit()
+            response = self.client.patch(
+                f"{BASE_URL}/{account.id}", json={"address": "1 New Street"}
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get_json()["name"], "Elsewhere")
+            self.assertEqual(response.headers["ETag"], f'"{account.id}-3"')
+            response = self.client.delete(
+                f"{BASE_URL}/{account.id}",
+                headers={"If-Match": f'"{account.id}-3"'},
+            )
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_update_account_errors(self):
+        """It should not Update a missing Account or one sent as text"""
+        response = self.client.put(f"{BASE_URL}/0", json={"name": "x"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        account = self._create_accounts(1)[0]
+        response = self.client.put(
+            f"{BASE_URL}/{account.id}", data="x", content_type="text/plain"
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        )
+
+    def test_delete_account(self):
+        """It should Delete an Account, honoring If-Match"""
+        account = self._create_accounts(1)[0]
+        response = self.client.delete(
+            f"{BASE_URL}/{account.id}", headers={"If-Match": '"stale"'}
+        )
+        self.assertEqual(
+            response.status_code, status.HTTP_412_PRECONDITION_FAILED
+        )
+        response = self.client.delete(f"{BASE_URL}/{account.id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.get(f"{BASE_URL}/{account.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.delete(f"{BASE_URL}/{account.id}")
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_list_accounts_fields(self):
+        """It should List only the requested fields"""
+        self._create_accounts(2)
+        response = self.client.get(
+            BASE_URL, query_string={"fields": "email, name"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for row in response.get_json():
+            self.assertEqual(set(row), {"id", "name", "email"})
+
+        response = self.client.get(
+            BASE_URL, query_string={"fields": "email", "stream": "ndjson"}
+        )
+        for line in response.get_data().splitlines():
+            self.assertEqual(set(json.loads(line)), {"id", "email"})
+
+    def test_read_account_fields(self):
+        """It should Read only the requested fields of an Account"""
+        account = self._create_accounts(1)[0]
+        url = f"{BASE_URL}/{account.id}"
+        response = self.client.get(url, query_string={"fields": "email"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.get_json(), {"id": account.id, "email": account.email}
+        )
+        etag = response.headers["ETag"]
+        self.assertNotEqual(etag, self.client.get(url).headers["ETag"])
+
+        response = self.client.get(
+            url,
+            query_string={"fields": "email"},
+            headers={"If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(
+            f"{BASE_URL}/0", query_string={"fields": "email"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_fields(self):
+        """It should not Read fields that do not exist"""
+        response = self.client.get(BASE_URL, query_string={"fields": "secret"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("secret", response.get_json()["message"])
+
+    def test_list_changes(self):
+        """It should stream only the changes since the last watermark"""
+        with patch.dict(self.app.config, {"CHANGES_LAG_SECONDS": 0}):
+            url = f"{BASE_URL}/changes"
+            first, second, third = self._create_accounts(3)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            data = response.get_json()
+            self.assertIn("updated_at", data[0])
+            watermark = response.headers["X-Watermark"]
+
+            # Changes stamped at the very horizon are left to the next sync
+            response = self.client.get(url, query_string={"since": watermark})
+            data += response.get_json()
+            self.assertEqual([row["op"] for row in data], ["upsert"] * 3)
+            self.assertEqual(
+                sorted(row["id"] for row in data),
+                sorted([first.id, second.id, third.id]),
+            )
+            watermark = response.headers["X-Watermark"]
+
+            self.client.patch(f"{BASE_URL}/{second.id}", json={"name": "New"})
+            self.client.delete(f"{BASE_URL}/{third.id}")
+            response = self.client.get(
+                url,
+                query_string={"since": watermark},
+                headers={"Accept": "application/x-ndjson"},
+            )
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            rows = [
+                json.loads(line) for line in response.get_data().splitlines()
+            ]
+            self.assertEqual(
+                [(row["op"], row["id"]) for row in rows],
+                [("upsert", second.id), ("delete", third.id)],
+            )
+            self.assertEqual(rows[0]["name"], "New")
+            self.assertNotIn(first.id, [row["id"] for row in rows])
+            self.assertGreater(response.headers["X-Watermark"], watermark)
+
+    def test_list_changes_bad_watermark(self):
+        """It should not list changes since an invalid watermark"""
+        response = self.client.get(
+            f"{BASE_URL}/changes", query_string={"since": "yesterday"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_changes_lag(self):
+        """It should hold back changes newer than the lag"""
+        self._create_accounts(1)
+        with patch.dict(self.app.config, {"CHANGES_LAG_SECONDS": 60}):
+            response = self.client.get(
+                f"{BASE_URL}/changes",
+                query_string={"since": "2000-01-01T00:00:00+00:00"},
+            )
+        self.assertEqual(response.get_json(), [])
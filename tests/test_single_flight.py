@@ -0,0 +1,96 @@
+"""
+Test cases for the single-flight lookups
+"""
+
+import threading
+from unittest import TestCase
+
+from service.common.single_flight import NullFlight, SingleFlight, make_flight
+
+
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def _run_concurrently(self, flight, key, func, count):
+        """Calls flight.do from count threads while func is blocked"""
+        results = [None] * count
+        errors = [None] * count
+
+        def call(index):
+            try:
+                results[index] = flight.do(key, func)
+            except ValueError as error:
+                errors[index] = error
+
+        threads = [
+            threading.Thread(target=call, args=(index,))
+            for index in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def _wait_for_followers(self, flight, count):
+        """Waits until count callers are waiting on the leader"""
+        for _ in range(1000):
+            if flight.stats()["followers"] == count:
+                return
+            threading.Event().wait(0.005)
+        self.fail("followers never arrived")
+
+    def test_coalesces_concurrent_calls(self):
+        """It should run one lookup for concurrent calls of a key"""
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            release.wait(5)
+            return {"id": 1}
+
+        threads, results, _ = self._run_concurrently(flight, 1, lookup, 5)
+        self._wait_for_followers(flight, 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"id": 1}] * 5)
+        self.assertEqual(flight.stats(), {"leaders": 1, "followers": 4})
+
+    def test_shares_errors(self):
+        """It should raise the error of the lookup in every caller"""
+        flight = SingleFlight()
+        release = threading.Event()
+
+        def lookup():
+            release.wait(5)
+            raise ValueError("down")
+
+        threads, _, errors = self._run_concurrently(flight, 1, lookup, 3)
+        self._wait_for_followers(flight, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+    def test_sequential_calls(self):
+        """It should not remember a result once the lookup returned"""
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.do("a", lambda: 2), 2)
+        self.assertEqual(flight.do("b", lambda: 3), 3)
+        self.assertEqual(flight.stats(), {"leaders": 3, "followers": 0})
+
+    def test_null_flight(self):
+        """It should run every lookup when coalescing is disabled"""
+        flight = NullFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.stats(), {"leaders": 0, "followers": 0})
+
+    def test_make_flight(self):
+        """It should build the single flight from the config"""
+        self.assertIsInstance(make_flight({}), SingleFlight)
+        self.assertIsInstance(
+            make_flight({"SINGLE_FLIGHT_ENABLED": False}), NullFlight
+        )